@@ -0,0 +1,83 @@
+""" Throughput of RGB vs. single channel (grayscale) loading and inference.
+
+Creates synthetic grayscale JPEGs like the converted BPS microscopy images and
+reports images/sec for DataLoader iteration and for the ResNet-50 forward pass in
+RGB mode and in both grayscale stems. Runs on CPU without network access.
+
+    python benchmarks/bench_grayscale.py --num-images 512 --batch-size 32
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from bps_labeler.dataloader.dataset import BPSTracksDataset
+from bps_labeler.model.resnet50 import ResNet50Classifier
+
+
+def write_synthetic_images(image_dir: str, num_images: int, size: int = 200) -> list:
+    rng = np.random.default_rng(0)
+    samples = []
+    for idx in range(num_images):
+        path = os.path.join(image_dir, f"synthetic_{idx:06d}.jpg")
+        Image.fromarray(rng.integers(0, 255, (size, size), dtype=np.uint8)).save(path, quality=100)
+        samples.append({"path": path, "label": "track"})
+    return samples
+
+
+def loader_throughput(samples: list, image_size: int, batch_size: int, num_workers: int, grayscale: bool) -> float:
+    transform = transforms.Compose([
+        transforms.Resize((image_size, image_size), interpolation=Image.LANCZOS),
+        transforms.ToTensor(),
+    ])
+    dataset = BPSTracksDataset(samples, transform, grayscale=grayscale)
+    start = time.perf_counter()
+    for _ in DataLoader(dataset, batch_size=batch_size, num_workers=num_workers):
+        pass
+    return len(samples) / (time.perf_counter() - start)
+
+
+def model_throughput(grayscale_stem, batch_size: int, image_size: int, num_batches: int) -> float:
+    model = ResNet50Classifier(2, "", grayscale_stem=grayscale_stem, pretrained=False).eval()
+    channels = 3 if grayscale_stem is None else 1
+    images = torch.rand(batch_size, channels, image_size, image_size)
+    with torch.inference_mode():
+        model(images)
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            model(images)
+    return batch_size * num_batches / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-images", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--num-batches", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as image_dir:
+        samples = write_synthetic_images(image_dir, args.num_images)
+        for mode, grayscale in (("rgb", False), ("grayscale", True)):
+            results[f"loader_{mode}_images_per_sec"] = loader_throughput(
+                samples, args.image_size, args.batch_size, args.num_workers, grayscale)
+    for mode, stem in (("rgb", None), ("grayscale_expand", "expand"), ("grayscale_sum", "sum")):
+        results[f"model_{mode}_images_per_sec"] = model_throughput(
+            stem, args.batch_size, args.image_size, args.num_batches)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
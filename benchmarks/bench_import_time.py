@@ -0,0 +1,130 @@
+""" Import time of the bps_labeler modules and startup time of the CLI.
+
+Every module is imported in a fresh interpreter, best of --repeats. The modules
+behind the lightweight commands (metadata generation, split, selection, uploads,
+downloads) and the scripts users run for them, loaded without running main(), must
+import within --budget-sec and without loading any of HEAVY_MODULES; the script exits
+with status 1 otherwise, so it can guard against an eager import creeping back in. Heavy modules are timed for reference only.
+
+    python benchmarks/bench_import_time.py --repeats 5 --budget-sec 0.5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ("torch", "torchvision", "pytorch_lightning", "wandb", "cv2", "lightly", "PIL", "boto3")
+
+LIGHT_MODULES = (
+    "bps_labeler.bps_utils.bps_tracks_config",
+    "bps_labeler.bps_utils.data_utils",
+    "bps_labeler.bps_utils.fetch_utils",
+    "bps_labeler.bps_utils.sync_utils",
+    "bps_labeler.bps_utils.download_utils",
+    "bps_labeler.bps_utils.lightly_utils",
+    "bps_labeler.bps_utils.label_studio_utils",
+    "bps_labeler.bps_utils.active_learning_utils",
+    "bps_labeler.bps_utils.coreset_utils",
+    "bps_labeler.bps_utils.prediction_store",
+    "bps_labeler.pipeline.services",
+    "bps_labeler.pipeline.round",
+    "bps_labeler.__main__",
+)
+
+LIGHT_SCRIPTS = (
+    "bps_labeler/scripts/a_data_setup/02_upload_training_set_Gyhi_4hr_to_s3_dest.py",
+    "bps_labeler/scripts/b_label_first_selection/03_run_first_selection.py",
+    "bps_labeler/scripts/b_label_first_selection/03_run_first_selection_local.py",
+    "bps_labeler/scripts/b_label_first_selection/04_download_samples.py",
+    "bps_labeler/scripts/c_train_model/06_upload_predictions_s3.py",
+    "bps_labeler/scripts/d_label_second_selection/07_run_second_selection.py",
+    "bps_labeler/scripts/d_label_second_selection/07_run_second_selection_local.py",
+)
+
+REFERENCE_MODULES = (
+    "bps_labeler.dataloader.dataset",
+    "bps_labeler.model.resnet50",
+    "bps_labeler.model.training",
+)
+
+_IMPORT_SNIPPET = """
+import importlib, json, runpy, sys, time
+start = time.perf_counter()
+if sys.argv[1].endswith(".py"):
+    runpy.run_path(sys.argv[1], run_name="__bench__")
+else:
+    importlib.import_module(sys.argv[1])
+print(json.dumps({"import_sec": time.perf_counter() - start,
+                  "heavy": [name for name in json.loads(sys.argv[2]) if name in sys.modules]}))
+"""
+
+
+def time_import(module: str, repeats: int) -> dict:
+    """Imports a module, or loads a script given by its path, in fresh interpreters,
+    returning the best import time and the heavy modules it loaded."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])))
+    best = None
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, "-c", _IMPORT_SNIPPET, module, json.dumps(HEAVY_MODULES)],
+                                   capture_output=True, text=True, cwd=REPO_DIR, env=env)
+        if completed.returncode != 0:
+            return {"error": completed.stderr.strip().splitlines()[-1]}
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if best is None or result["import_sec"] < best["import_sec"]:
+            best = result
+    return best
+
+
+def time_command(args: list, repeats: int) -> float:
+    """The best wall time of a command in a fresh interpreter, including startup."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, capture_output=True, cwd=REPO_DIR, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--budget-sec", type=float, default=0.5,
+                        help="the maximum import time of every lightweight module")
+    parser.add_argument("--skip-reference", action="store_true", help="do not time the torch based modules")
+    parser.add_argument("--output", default=None, help="write the results JSON here")
+    args = parser.parse_args()
+
+    results = {
+        "interpreter_startup_sec": time_command(["-c", "pass"], args.repeats),
+        "cli_help_sec": time_command(["-m", "bps_labeler", "--help"], args.repeats),
+        "budget_sec": args.budget_sec,
+        "light": {module: time_import(module, args.repeats) for module in LIGHT_MODULES + LIGHT_SCRIPTS},
+        "reference": {} if args.skip_reference else
+                     {module: time_import(module, args.repeats) for module in REFERENCE_MODULES},
+    }
+    failures = []
+    for module, result in results["light"].items():
+        if "error" in result:
+            failures.append(f"{module}: {result['error']}")
+        elif result["heavy"]:
+            failures.append(f"{module} imports {', '.join(result['heavy'])}")
+        elif result["import_sec"] > args.budget_sec:
+            failures.append(f"{module} takes {result['import_sec']:.2f}s to import")
+    results["failures"] = failures
+
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if failures:
+        print("\n".join(["Import budget exceeded:"] + failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+""" Throughput and accuracy of the CPU inference backends of ResNet50Classifier.
+
+Runs every backend in model/inference_backends.py on the same random batches and
+reports images/sec and the maximum absolute difference of the softmax probabilities
+from the eager backend, checked against BACKEND_TOLERANCES. Uses randomly
+initialized weights, so it runs without network access.
+
+    python benchmarks/bench_inference_backends.py --batch-size 32 --num-batches 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+import torch.nn.functional as F
+
+from bps_labeler.model.inference_backends import BACKEND_TOLERANCES, build_inference_backend
+from bps_labeler.model.resnet50 import ResNet50Classifier
+
+
+class _BackendConfig:
+    def __init__(self, name: str, threads: int):
+        self.inference_backend = name
+        self.onnx_model_path = None
+        self.ort_intra_op_threads = threads
+        self.ort_inter_op_threads = 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--num-batches", type=int, default=5)
+    parser.add_argument("--backends", nargs="+", default=list(BACKEND_TOLERANCES))
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = ResNet50Classifier(2, "", pretrained=False).eval()
+    batches = [torch.rand(args.batch_size, 3, args.image_size, args.image_size) for _ in range(args.num_batches)]
+    with torch.inference_mode():
+        reference = [F.softmax(model.resnet50(images), dim=1) for images in batches]
+
+    results = {}
+    for name in args.backends:
+        backend = build_inference_backend(model, _BackendConfig(name, torch.get_num_threads()))
+        with torch.inference_mode():
+            # warm up, this also traces or exports the model
+            backend(batches[0])
+            start = time.perf_counter()
+            probabilities = [F.softmax(backend(images), dim=1) for images in batches]
+            elapsed = time.perf_counter() - start
+        max_abs_diff = max(float((p - r).abs().max()) for p, r in zip(probabilities, reference))
+        results[name] = {
+            "images_per_sec": args.batch_size * args.num_batches / elapsed,
+            "max_abs_diff_vs_eager": max_abs_diff,
+            "tolerance": BACKEND_TOLERANCES[name],
+            "within_tolerance": max_abs_diff <= BACKEND_TOLERANCES[name],
+        }
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
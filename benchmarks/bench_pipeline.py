@@ -0,0 +1,204 @@
+""" Per-stage timings of the data -> train -> predict -> export pipeline.
+
+Creates a synthetic dataset per size: 16-bit TIFFs, a matching filtered_meta.csv
+and a Label Studio export labeling every training image. Then times each stage
+separately on it:
+
+    convert_16bit_tif_to_8bit_tif_to_jpg   every TIFF, one call per image
+    generate_meta_json_per_from_csv        one metadata JSON per image
+    setup_data                             train/val split and full_train.json
+    load_label_index                       parsing the Label Studio export
+    dataset_iteration                      BPSTracksDataset through a DataLoader
+    predict_active_learning                ResNet-50, at most --max-predict-images
+    dump_lightly_predictions               one prediction file per training image
+
+Uses randomly initialized weights and hides CUDA, so it runs CPU-only without
+network access. Results are written as JSON; pass an earlier result with
+--baseline to print the change of every stage, e.g. between two commits:
+
+    python benchmarks/bench_pipeline.py --sizes 1000 10000 --output bench_pipeline.json
+    python benchmarks/bench_pipeline.py --sizes 1000 10000 --baseline bench_pipeline.json
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from bps_labeler.bps_utils.data_utils import (convert_16bit_tif_to_8bit_tif_to_jpg, dump_lightly_predictions,
+                                              generate_meta_json_per_from_csv, setup_data)
+from bps_labeler.bps_utils.label_studio_utils import load_label_index
+from bps_labeler.dataloader.dataset import CLASSES, BPSTracksDataset
+from bps_labeler.model.resnet50 import ResNet50Classifier
+
+PARTICLE_TYPES = ("Fe", "X-ray")
+
+
+def write_synthetic_dataset(data_dir: str, num_images: int, tif_size: int, seed: int = 0) -> None:
+    """Writes 16-bit TIFFs with sparse bright foci and their filtered_meta.csv."""
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2000, (tif_size, tif_size), dtype=np.uint16)
+    with open(os.path.join(data_dir, "filtered_meta.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["filename", "dose_Gy", "particle_type", "hr_post_exposure"])
+        for idx in range(num_images):
+            filename = f"P{idx % 250:03d}_{idx:07d}.tif"
+            image = base.copy()
+            ys, xs = rng.integers(0, tif_size, (2, 8))
+            image[ys, xs] = rng.integers(20000, 65535, 8, dtype=np.uint16)
+            cv2.imwrite(os.path.join(data_dir, filename), image)
+            writer.writerow([filename, [0.0, 0.1, 1.0][idx % 3], PARTICLE_TYPES[idx % 2], [4, 24, 48][idx % 3]])
+
+
+def write_label_studio_export(annotation_fpath: str, image_names: list, seed: int = 0) -> None:
+    """Writes a Label Studio JSON-MIN export labeling every image."""
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, len(CLASSES), len(image_names))
+    export = [{"id": idx, "image": f"/data/local-files/?d=train_set/data/{name}", "choice": CLASSES[label]}
+              for idx, (name, label) in enumerate(zip(image_names, labels.tolist()))]
+    with open(annotation_fpath, "w") as f:
+        json.dump(export, f)
+
+
+def timed(stage_timings: dict, stage: str, num_items: int, fn, *args, **kwargs):
+    """Runs fn and records its wall time and throughput under stage."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    wall_sec = time.perf_counter() - start
+    stage_timings[stage] = {
+        "num_items": num_items,
+        "wall_sec": wall_sec,
+        "items_per_sec": num_items / wall_sec if wall_sec > 0 else None,
+    }
+    return result
+
+
+def convert_all(tif_paths: list) -> None:
+    for tif_path in tif_paths:
+        tif_dir, tif_name = os.path.split(tif_path)
+        convert_16bit_tif_to_8bit_tif_to_jpg(tif_dir, tif_name, tif_dir, f"{os.path.splitext(tif_name)[0]}.jpg")
+
+
+def iterate(dataloader: DataLoader) -> None:
+    for _ in dataloader:
+        pass
+
+
+def bench_size(work_dir: str, num_images: int, args) -> dict:
+    data_dir = os.path.join(work_dir, f"n{num_images}")
+    os.makedirs(data_dir)
+    write_synthetic_dataset(data_dir, num_images, args.tif_size)
+    stage_timings = {}
+
+    tif_paths = sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir) if name.endswith(".tif"))
+    timed(stage_timings, "convert_16bit_tif_to_8bit_tif_to_jpg", num_images, convert_all, tif_paths)
+    timed(stage_timings, "generate_meta_json_per_from_csv", num_images, generate_meta_json_per_from_csv,
+          "filtered_meta.csv", data_dir, data_dir)
+    # as in 01_local_data_setup_lightly.py
+    timed(stage_timings, "setup_data", num_images, setup_data, data_dir, stratify_by="particle_type")
+
+    with open(os.path.join(data_dir, "full_train.json")) as f:
+        full_train_list = json.load(f)
+    train_dir = os.path.join(data_dir, "train_set", "data")
+    annotation_fpath = os.path.join(data_dir, "annotation-0.json")
+    write_label_studio_export(annotation_fpath, [os.path.basename(sample["path"]) for sample in full_train_list])
+    timed(stage_timings, "load_label_index", len(full_train_list), load_label_index, [annotation_fpath], train_dir)
+
+    transform = transforms.Compose([
+        transforms.Resize((args.image_size, args.image_size), interpolation=Image.LANCZOS),
+        transforms.ToTensor(),
+    ])
+    dataset = BPSTracksDataset(full_train_list, transform, return_index=True)
+    timed(stage_timings, "dataset_iteration", len(dataset), iterate,
+          DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers))
+
+    predict_list = full_train_list[:args.max_predict_images]
+    predict_loader = DataLoader(BPSTracksDataset(predict_list, transform, return_index=True),
+                                batch_size=args.batch_size, num_workers=args.num_workers)
+    torch.manual_seed(0)
+    model = ResNet50Classifier(len(CLASSES), "", pretrained=False)
+    timed(stage_timings, "predict_active_learning", len(predict_list), model.predict_active_learning, predict_loader)
+
+    # predictions for every training image, so writing runs at full scale
+    probs = np.random.default_rng(0).dirichlet(np.ones(len(CLASSES)), len(full_train_list)).astype(np.float32)
+    filenames = [os.path.basename(sample["path"]) for sample in full_train_list]
+    timed(stage_timings, "dump_lightly_predictions", len(filenames), dump_lightly_predictions,
+          filenames, probs, os.path.join(data_dir, "lightly_predictions"))
+    return stage_timings
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results: dict, baseline: dict) -> None:
+    """Prints the change of the time per item of every stage, so runs with different
+    --max-predict-images stay comparable."""
+    print(f"{'size':>8} {'stage':<40}{'baseline ms':>13}{'now ms':>10}{'change':>9}")
+    for size, stage_timings in results["sizes"].items():
+        for stage, timing in stage_timings.items():
+            before = baseline.get("sizes", {}).get(size, {}).get(stage)
+            if before is None or not before["num_items"] or not timing["num_items"]:
+                continue
+            before_ms = 1000 * before["wall_sec"] / before["num_items"]
+            now_ms = 1000 * timing["wall_sec"] / timing["num_items"]
+            change = now_ms / before_ms - 1 if before_ms > 0 else float("nan")
+            print(f"{size:>8} {stage:<40}{before_ms:>13.3f}{now_ms:>10.3f}{change:>+9.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--tif-size", type=int, default=200)
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--max-predict-images", type=int, default=256,
+                        help="images to run ResNet-50 on per size, CPU inference is the slowest stage")
+    parser.add_argument("--work-dir", default=None,
+                        help="parent of the temporary data directory, which is deleted afterwards")
+    parser.add_argument("--output", default=None, help="write the results JSON here")
+    parser.add_argument("--baseline", default=None, help="an earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "args": vars(args),
+        "sizes": {},
+    }
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for num_images in args.sizes:
+            results["sizes"][str(num_images)] = bench_size(work_dir, num_images, args)
+
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+""" Training throughput and convergence of the ResNet50Classifier training modes.
+
+Trains a randomly initialized ResNet-50 with pl.Trainer on a synthetic, learnable
+task (class 0 images have a bright center square) in every mode and reports
+optimizer steps/sec, images/sec after --warmup-steps, and the wall time until the
+mean loss of the last 5 steps reaches --target-loss, compilation included. The
+"softmax_before_ce" mode reproduces the former training step, which applied
+softmax before F.cross_entropy. Runs on CPU without network access.
+
+    python benchmarks/bench_training_modes.py --max-steps 60 --image-size 64
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import pytorch_lightning as pl
+import torch
+import torch.nn.functional as F
+import wandb
+from torch.utils.data import DataLoader, Dataset
+
+from bps_labeler.model.resnet50 import ResNet50Classifier
+
+# mode -> (ResNet50Classifier kwargs, pl.Trainer kwargs, batch size divisor)
+MODES = {
+    "softmax_before_ce": ({}, {}, 1),
+    "fp32": ({}, {}, 1),
+    "bf16": ({}, {"precision": "bf16"}, 1),
+    "channels_last": ({"channels_last": True}, {}, 1),
+    "channels_last_bf16": ({"channels_last": True}, {"precision": "bf16"}, 1),
+    "compile": ({"compile": True}, {}, 1),
+    "accumulate_4": ({}, {"accumulate_grad_batches": 4}, 4),
+}
+
+
+class SyntheticTracks(Dataset):
+    def __init__(self, num_images: int, image_size: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.images = rng.random((num_images, 3, image_size, image_size), dtype=np.float32) * 0.5
+        self.labels = rng.integers(0, 2, num_images)
+        lo, hi = image_size // 4, 3 * image_size // 4
+        self.images[self.labels == 0, :, lo:hi, lo:hi] += 0.5
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(self.images[idx]), F.one_hot(torch.tensor(self.labels[idx]), 2).float(), idx
+
+
+class BenchClassifier(ResNet50Classifier):
+    """Keeps the loss of every batch; optionally trains like the former training step."""
+    def __init__(self, softmax_before_ce: bool = False, **kwargs):
+        super().__init__(2, "", pretrained=False, **kwargs)
+        self.softmax_before_ce = softmax_before_ce
+        self.losses = []
+
+    def training_step(self, batch, batch_idx):
+        if not self.softmax_before_ce:
+            loss = super().training_step(batch, batch_idx)
+        else:
+            image, label, _ = batch
+            loss = F.cross_entropy(F.softmax(self(image), dim=1), label)
+        self.losses.append(float(loss))
+        return loss
+
+    def training_epoch_end(self, outputs):
+        pass
+
+
+class StepClock(pl.Callback):
+    """Records the wall time after every batch."""
+    def __init__(self):
+        self.start = None
+        self.batch_ends = []
+
+    def on_train_start(self, trainer, pl_module):
+        self.start = time.perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.batch_ends.append(time.perf_counter() - self.start)
+
+
+def run_mode(name: str, dataset: Dataset, args) -> dict:
+    model_kwargs, trainer_kwargs, divisor = MODES[name]
+    accumulate = trainer_kwargs.get("accumulate_grad_batches", 1)
+    torch.manual_seed(0)
+    model = BenchClassifier(softmax_before_ce=name == "softmax_before_ce", lr=args.lr, **model_kwargs)
+    clock = StepClock()
+    trainer = pl.Trainer(devices=1, accelerator="cpu", max_steps=args.max_steps, callbacks=[clock], logger=False,
+                         enable_checkpointing=False, enable_progress_bar=False, enable_model_summary=False,
+                         **trainer_kwargs)
+    loader = DataLoader(dataset, batch_size=args.batch_size // divisor, shuffle=True,
+                        generator=torch.Generator().manual_seed(0))
+    trainer.fit(model, loader)
+
+    # one loss and wall time per optimizer step
+    step_losses = [float(np.mean(model.losses[i:i + accumulate])) for i in range(0, len(model.losses), accumulate)]
+    step_ends = clock.batch_ends[accumulate - 1::accumulate]
+    num_steps = len(step_ends)
+    warmup = min(args.warmup_steps, num_steps - 1)
+    timed_sec = step_ends[-1] - step_ends[warmup]
+    steps_per_sec = (num_steps - 1 - warmup) / timed_sec if timed_sec > 0 else None
+    time_to_target = None
+    for step in range(num_steps):
+        if np.mean(step_losses[max(0, step - 4):step + 1]) <= args.target_loss:
+            time_to_target = step_ends[step]
+            break
+    return {
+        "optimizer_steps": num_steps,
+        "effective_batch_size": args.batch_size,
+        "steps_per_sec": steps_per_sec,
+        "images_per_sec": steps_per_sec * args.batch_size if steps_per_sec else None,
+        "time_to_target_loss_sec": time_to_target,
+        "final_loss": float(np.mean(step_losses[-5:])),
+        "total_sec": step_ends[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--num-images", type=int, default=512)
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=32, help="the effective batch size of every mode")
+    parser.add_argument("--max-steps", type=int, default=60, help="optimizer steps per mode")
+    parser.add_argument("--warmup-steps", type=int, default=5, help="steps left out of steps/sec, e.g. compilation")
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--target-loss", type=float, default=0.3)
+    parser.add_argument("--output", default=None, help="write the results JSON here")
+    args = parser.parse_args()
+
+    wandb.init(mode="disabled")
+    dataset = SyntheticTracks(args.num_images, args.image_size)
+    results = {"args": vars(args), "torch": torch.__version__, "torch_threads": torch.get_num_threads(), "modes": {}}
+    for name in args.modes:
+        try:
+            results["modes"][name] = run_mode(name, dataset, args)
+        except Exception as e:
+            # e.g. torch.compile without a C++ compiler
+            results["modes"][name] = {"error": repr(e)}
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+""" Command line entry point running an active learning round as a pipeline:
+
+    python -m bps_labeler round 0            # first selection and download for labeling
+    python -m bps_labeler round 1            # train on annotation-0.json, predict, select, download
+    python -m bps_labeler round 1 --local    # Lightly and S3 replaced by local stand-ins
+    python -m bps_labeler status 1           # the last run of every step of round 1
+
+Steps whose inputs are unchanged since their last run are skipped, see
+bps_labeler/pipeline/dag.py. Step timings are appended to
+<pipeline_state_dir>/round-<k>/steps.jsonl.
+"""
+import argparse
+import json
+import os
+import sys
+
+from bps_labeler.bps_utils.bps_tracks_config import BPSTracksConfig
+from bps_labeler.bps_utils.project_root import root
+from bps_labeler.bps_utils.storage_utils import LocalDirectoryBackend, S3Backend
+from bps_labeler.pipeline.dag import STATE_FNAME, Pipeline
+from bps_labeler.pipeline.round import build_round_steps
+from bps_labeler.pipeline.services import AnnotationDirectory, LightlySelectionService, LocalSelectionService
+
+
+def run_round(args, config: BPSTracksConfig) -> int:
+    config.wandb_mode = args.wandb_mode
+    if config.wandb_mode is None and args.local and "WANDB_MODE" not in os.environ:
+        # the local stand-ins must run without a wandb login
+        config.wandb_mode = "offline"
+    if args.local:
+        selection = LocalSelectionService(config)
+        storage = LocalDirectoryBackend(args.local_bucket_dir)
+        destination_name = "local"
+    else:
+        selection = LightlySelectionService.from_environment(config, args.dataset_name,
+                                                             create_dataset=args.round == 0)
+        storage = S3Backend(args.bucket)
+        destination_name = args.bucket
+    steps = build_round_steps(config, args.round, selection, storage, destination_name,
+                              AnnotationDirectory(config.ls_annotation_dir), args.n_samples)
+    pipeline = Pipeline(steps, os.path.join(config.pipeline_state_dir, f"round-{args.round}"), args.max_workers)
+    results = pipeline.run(force=args.force)
+
+    print(f"{'step':<28}{'status':<10}{'wall time':>10}")
+    for result in results.values():
+        print(f"{result.name:<28}{result.status:<10}{result.wall_sec:>9.1f}s")
+    return 0 if all(result.status in ("ran", "skipped") for result in results.values()) else 1
+
+
+def show_status(args, config: BPSTracksConfig) -> int:
+    state_path = os.path.join(config.pipeline_state_dir, f"round-{args.round}", STATE_FNAME)
+    if not os.path.exists(state_path):
+        print(f"Round {args.round} has not run yet")
+        return 1
+    with open(state_path, "r") as f:
+        print(json.dumps(json.load(f), indent=4))
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="bps_labeler", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    round_parser = subparsers.add_parser("round", help="run an active learning round")
+    round_parser.add_argument("round", type=int, help="0 for the first selection, k to train on k label exports")
+    round_parser.add_argument("--n-samples", type=int, default=50, help="samples to select for labeling")
+    round_parser.add_argument("--local", action="store_true",
+                              help="select offline and upload to a local directory instead of Lightly and S3")
+    round_parser.add_argument("--local-bucket-dir", default=os.path.join(root, "local_bucket"),
+                              help="directory standing in for the S3 bucket with --local")
+    round_parser.add_argument("--bucket", default="ai4ls-bps-training-data", help="the Lightly datasource bucket")
+    round_parser.add_argument("--dataset-name", default="nasa-bps-microscopy", help="the Lightly dataset")
+    round_parser.add_argument("--force", nargs="*", default=[], help="steps to run even if their inputs are unchanged")
+    round_parser.add_argument("--max-workers", type=int, default=4, help="steps running at once")
+    round_parser.add_argument("--wandb-mode", choices=("online", "offline", "disabled"), default=None,
+                              help="the wandb mode of the train step, by default WANDB_MODE, or offline with --local")
+
+    status_parser = subparsers.add_parser("status", help="show the last run of every step of a round")
+    status_parser.add_argument("round", type=int)
+
+    args = parser.parse_args(argv)
+    config = BPSTracksConfig()
+    if args.command == "round":
+        return run_round(args, config)
+    return show_status(args, config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+""" Local active learning scores and selection over model predictions.
+Mirrors the classification scores of the Lightly worker (https://docs.lightly.ai/docs/active-learning-scorers)
+so an active learning round can be run offline from the output of
+ResNet50Classifier.predict_active_learning.
+"""
+import json
+import os
+import pathlib
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+SCORE_NAMES = (
+    "uncertainty_entropy",
+    "uncertainty_least_confidence",
+    "uncertainty_margin",
+    "uncertainty_ratio",
+)
+
+
+def compute_uncertainty_scores(probabilities: npt.NDArray, eps: float = 1e-12) -> Dict[str, npt.NDArray]:
+    """
+    Computes the Lightly uncertainty scores for every sample at once.
+
+    All scores are in [0, 1] and higher means more uncertain.
+
+    Args:
+        probabilities (npt.NDArray): The class probabilities of shape (N, num_classes).
+        eps (float): Guards the logarithm and the ratio against zero probabilities.
+    Returns:
+        Dict[str, npt.NDArray]: One score array of shape (N,) per name in SCORE_NAMES.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    num_classes = probabilities.shape[1]
+    # the two largest probabilities per row by partial selection instead of a full sort
+    top_two = np.partition(probabilities, num_classes - 2, axis=1)[:, -2:]
+    second, first = top_two[:, 0], top_two[:, 1]
+
+    entropy = -np.sum(probabilities * np.log2(probabilities + eps), axis=1)
+    return {
+        "uncertainty_entropy": entropy / np.log2(num_classes),
+        "uncertainty_least_confidence": (1.0 - first) / (1.0 - 1.0 / num_classes),
+        "uncertainty_margin": 1.0 - (first - second),
+        "uncertainty_ratio": second / np.maximum(first, eps),
+    }
+
+
+def select_top_k(scores: npt.NDArray, k: int) -> npt.NDArray:
+    """
+    Selects the indices of the k highest scores, highest first.
+
+    Only the k selected scores are sorted, the rest is partitioned in linear time.
+
+    Args:
+        scores (npt.NDArray): The scores of shape (N,).
+        k (int): The number of samples to select.
+    Returns:
+        npt.NDArray: The selected indices.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def select_weighted(scores: npt.NDArray, k: int, seed: Optional[int] = None) -> npt.NDArray:
+    """
+    Samples k indices without replacement with probability proportional to the scores,
+    like the Lightly WEIGHTS strategy.
+
+    Uses the Efraimidis-Spirakis keys log(u) / w so the sample is a top-k selection.
+
+    Args:
+        scores (npt.NDArray): The non-negative scores of shape (N,).
+        k (int): The number of samples to select.
+        seed (int): The seed of the random generator.
+    Returns:
+        npt.NDArray: The selected indices.
+    """
+    rng = np.random.default_rng(seed)
+    uniform = rng.random(len(scores))
+    with np.errstate(divide="ignore"):
+        keys = np.where(scores > 0, np.log(uniform) / np.maximum(scores, 1e-300), -np.inf)
+    return select_top_k(keys, k)
+
+
+def select_samples(
+    filenames: List[str],
+    probabilities: npt.NDArray,
+    n_samples: int,
+    score: str = "uncertainty_entropy",
+    strategy: str = "weights",
+    exclude: Optional[Iterable[str]] = None,
+    seed: Optional[int] = None
+    ) -> List[str]:
+    """
+    Selects the samples to label next from model predictions.
+
+    Args:
+        filenames (List[str]): The image filenames, one per row of probabilities.
+        probabilities (npt.NDArray): The class probabilities of shape (N, num_classes).
+        n_samples (int): The number of samples to select.
+        score (str): One of SCORE_NAMES.
+        strategy (str): "weights" to sample proportional to the score or "top_k" to
+        take the highest scores.
+        exclude (Iterable[str]): Filenames that must not be selected, e.g. samples
+        that are already labeled.
+        seed (int): The seed for the "weights" strategy.
+    Returns:
+        List[str]: The selected filenames.
+    """
+    if score not in SCORE_NAMES:
+        raise ValueError(f"Unknown score {score!r}, expected one of {SCORE_NAMES}")
+    scores = compute_uncertainty_scores(probabilities)[score]
+    # rank only the candidates, so excluded samples can never fill up the selection
+    candidates = np.arange(len(filenames))
+    if exclude is not None:
+        excluded = set(exclude)
+        candidates = np.flatnonzero([filename not in excluded for filename in filenames])
+    n_samples = min(n_samples, len(candidates))
+
+    if strategy == "top_k":
+        indices = select_top_k(scores[candidates], n_samples)
+    elif strategy == "weights":
+        indices = select_weighted(scores[candidates], n_samples, seed)
+    else:
+        raise ValueError(f"Unknown strategy {strategy!r}, expected 'weights' or 'top_k'")
+    return [filenames[idx] for idx in candidates[indices]]
+
+
+def to_filename_url_mappings(filenames: List[str], image_dir: str) -> List[Dict[str, str]]:
+    """
+    Converts selected filenames to the mappings returned by
+    export_filenames_and_urls, with local file URLs as read URLs.
+
+    Args:
+        filenames (List[str]): The selected filenames.
+        image_dir (str): The directory containing the images.
+    Returns:
+        List[Dict[str, str]]: [{"fileName": "image1.jpg", "readUrl": "file:///..."}, ...]
+    """
+    image_dir_path = pathlib.Path(image_dir).resolve()
+    return [
+        {"fileName": filename, "readUrl": (image_dir_path / filename).as_uri()}
+        for filename in filenames
+    ]
+
+
+def save_selection(filename_url_mappings: List[Dict[str, str]], selection_dir: str, tag_name: str) -> str:
+    """
+    Saves a local selection as `<tag_name>.json` for 04_download_samples.py.
+
+    Args:
+        filename_url_mappings (List[Dict[str, str]]): The selected samples.
+        selection_dir (str): The directory to save the selection to.
+        tag_name (str): The name of the selection, like a Lightly tag name.
+    Returns:
+        str: The path to the saved selection file.
+    """
+    os.makedirs(selection_dir, exist_ok=True)
+    selection_fpath = os.path.join(selection_dir, f"{tag_name}.json")
+    with open(selection_fpath, "w") as f:
+        json.dump(filename_url_mappings, f, indent=4)
+    return selection_fpath
@@ -3,11 +3,10 @@
 """
 import os
 import sys
-import pyprojroot
-root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+from bps_labeler.bps_utils.project_root import root
 sys.path.append(str(root))
-import torch
 from dataclasses import dataclass
+from typing import Optional, Tuple
 
 
 @dataclass
@@ -19,17 +18,62 @@ class BPSTracksConfig:
     ls_annotation_fname: str = 'annotation-0.json'
     save_model_dir: str = os.path.join(root, 'model_weights')
     save_pred_dir: str = os.path.join(root, 'lightly_predictions')
+    prediction_store_dir: str = os.path.join(root, 'prediction_store')  # see bps_utils/prediction_store.py
+    sync_manifest_dir: str = os.path.join(root, 'sync_manifests')  # see bps_utils/sync_utils.py
+    worker_run_log_path: str = os.path.join(root, 'logs', 'lightly_worker_runs.jsonl')  # see bps_utils/worker_monitor.py
+    pipeline_state_dir: str = os.path.join(root, 'pipeline_runs')  # step cache and timings of python -m bps_labeler
     save_wandb_dir: str = os.path.join(root, 'wandb')
     wandb_project_name: str = 'bps_labeler'
+    # 'online', 'offline' or 'disabled' to train without a wandb account; None defers to the WANDB_MODE variable
+    wandb_mode: Optional[str] = None
     image_size: int = 224
+    grayscale: bool = False  # load single channel images, see ResNet50Classifier
+    grayscale_stem: str = 'sum'  # 'sum' or 'expand', only used with grayscale
     num_classes: int = 2
     batch_size: int = 32
+    inference_batch_size: int = 256
+    prefetch_factor: int = 4
+    # 'eager', 'channels_last_bf16', 'torchscript', 'onnxruntime', 'int8_dynamic' or 'int8_static',
+    # see model/inference_backends.py; 'int8_dynamic' quantizes only the head, it is for agreement checks, not speed
+    inference_backend: str = 'eager'
+    num_calibration_images: int = 256  # images from full_train.json to calibrate 'int8_static'
+    quantization_engine: Optional[str] = None  # e.g. 'x86' or 'qnnpack' on ARM; None picks a supported one
+    onnx_model_path: Optional[str] = None
+    ort_intra_op_threads: int = 0  # 0 lets ONNX Runtime choose
+    ort_inter_op_threads: int = 0
     lr: float = 0.01
     momentum: float = 0.5
     decay: float = 0.01
     epochs: int = 5
+    # training performance, see ResNet50Classifier: precision 'bf16' autocasts on CPUs and recent GPUs,
+    # '16' on GPUs; the effective batch size is batch_size * accumulate_grad_batches
+    precision: str = '32'
+    accumulate_grad_batches: int = 1
+    channels_last: bool = False
+    compile_model: bool = False
     num_workers: int = 12
-    accelerator: str = 'gpu' if torch.cuda.is_available() else 'cpu'
+    image_cache_dir: Optional[str] = None  # e.g. os.path.join(data_dir, 'image_cache')
+    image_cache_max_bytes: Optional[int] = None
+    train_shard_dir: Optional[str] = None  # shards written by scripts/a_data_setup/pack_shards.py
+    active_learn_shard_dir: Optional[str] = None
+    # train only the classification head on cached backbone features, see model/feature_cache.py
+    frozen_backbone: bool = False
+    feature_cache_dir: str = os.path.join(data_dir, 'feature_cache')
+    # start from the newest compatible checkpoint in save_model_dir trained on fewer labels, never one trained on the
+    # same exports, training each epoch on the samples labeled since
+    # plus replay_ratio old samples per new one (None replays all), see model/checkpoint_registry.py
+    warm_start: bool = True
+    replay_ratio: Optional[float] = 1.0
+    # opt-in data wait / transfer / compute timings per step, see model/profiling.py
+    profile: bool = False
+    profile_sinks: Tuple[str, ...] = ('jsonl',)  # 'jsonl' and/or 'wandb'
+    profile_log_path: str = os.path.join(root, 'logs', 'profile.jsonl')
+    profile_log_every_n_steps: int = 10
+    # trace torch_profiler_num_steps training steps from this step with torch.profiler
+    torch_profiler_start_step: Optional[int] = None
+    torch_profiler_num_steps: int = 5
+    torch_profiler_dir: str = os.path.join(root, 'logs', 'torch_profiler')
+    accelerator: str = 'auto'  # the GPU if there is one, resolved by Lightning so the config does not import torch
     seed: int = 42
     train_stage: str = 'fit'
     active_learning_stage: str = 'active_learn'
\ No newline at end of file
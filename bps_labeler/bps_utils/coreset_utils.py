@@ -0,0 +1,194 @@
+""" Local diversity selection with metadata balancing.
+Runs k-center greedy (coreset) selection over image embeddings, mirroring the
+EMBEDDINGS/DIVERSITY strategy with a METADATA/BALANCE target of the Lightly worker.
+Distances are computed block by block so the pairwise distance matrix is never
+materialized and the embeddings may be a read-only np.memmap.
+"""
+import json
+import os
+import pathlib
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+
+def load_metadata_values(metadata_dir: str, filenames: Sequence[str], key: str = "particle_type") -> List[str]:
+    """
+    Reads a metadata value for each image from its Lightly metadata JSON file.
+
+    Args:
+        metadata_dir (str): The directory with one `<filestem>.json` per image.
+        filenames (Sequence[str]): The image filenames.
+        key (str): The metadata key to read.
+    Returns:
+        List[str]: The metadata value of each image.
+    """
+    values = []
+    for filename in filenames:
+        with open(os.path.join(metadata_dir, f"{pathlib.Path(filename).stem}.json"), "r") as f:
+            values.append(json.load(f)["metadata"][key])
+    return values
+
+
+def balance_quotas(n_samples: int, target: Dict[str, float], available: Dict[str, int]) -> Dict[str, int]:
+    """
+    Splits n_samples over metadata values according to target ratios.
+
+    Values with fewer available samples than their quota give the remainder to the
+    other values, in order of their target ratio.
+
+    Args:
+        n_samples (int): The total number of samples to select.
+        target (Dict[str, float]): The target ratio of each metadata value.
+        available (Dict[str, int]): The number of candidate samples of each value.
+    Returns:
+        Dict[str, int]: The number of samples to select per metadata value.
+    """
+    total_ratio = sum(target.values())
+    quotas = {value: min(int(round(n_samples * ratio / total_ratio)), available.get(value, 0))
+              for value, ratio in target.items()}
+    by_ratio = sorted(target, key=target.get, reverse=True)
+    remainder = n_samples - sum(quotas.values())
+    while remainder > 0:
+        room = [value for value in by_ratio if quotas[value] < available.get(value, 0)]
+        if not room:
+            break
+        for value in room[:remainder]:
+            quotas[value] += 1
+        remainder = n_samples - sum(quotas.values())
+    while remainder < 0:
+        largest = max(quotas, key=quotas.get)
+        quotas[largest] -= 1
+        remainder += 1
+    return quotas
+
+
+def _update_min_distances(
+    embeddings: npt.NDArray,
+    squared_norms: npt.NDArray,
+    center: int,
+    min_distances: npt.NDArray,
+    block_size: int
+    ) -> None:
+    """Lowers min_distances in place with the squared distances to a new center."""
+    center_embedding = np.asarray(embeddings[center], dtype=np.float32)
+    center_norm = squared_norms[center]
+    for start in range(0, len(embeddings), block_size):
+        stop = min(start + block_size, len(embeddings))
+        block = np.asarray(embeddings[start:stop], dtype=np.float32)
+        distances = squared_norms[start:stop] + center_norm - 2.0 * (block @ center_embedding)
+        np.minimum(min_distances[start:stop], distances, out=min_distances[start:stop])
+
+
+def k_center_greedy(
+    embeddings: npt.NDArray,
+    n_samples: int,
+    initial_indices: Optional[Sequence[int]] = None,
+    groups: Optional[npt.NDArray] = None,
+    group_quotas: Optional[Dict[int, int]] = None,
+    block_size: int = 8192,
+    seed: Optional[int] = None
+    ) -> npt.NDArray:
+    """
+    Greedily selects the samples farthest from all selected samples.
+
+    Memory use is O(N) plus one block of embeddings, independent of n_samples.
+
+    Args:
+        embeddings (npt.NDArray): The embeddings of shape (N, D), may be a memmap.
+        n_samples (int): The number of samples to select.
+        initial_indices (Sequence[int]): Already selected samples, e.g. labeled ones,
+        that new samples should be far from. They are not returned.
+        groups (npt.NDArray): An integer group id per sample, used with group_quotas.
+        group_quotas (Dict[int, int]): The maximum number of samples per group id.
+        block_size (int): The number of embeddings processed at a time.
+        seed (int): The seed used to pick the first center without initial_indices.
+    Returns:
+        npt.NDArray: The indices of the selected samples in selection order.
+    """
+    num_embeddings = len(embeddings)
+    squared_norms = np.empty(num_embeddings, dtype=np.float32)
+    for start in range(0, num_embeddings, block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        squared_norms[start:start + block_size] = np.einsum("ij,ij->i", block, block)
+
+    min_distances = np.full(num_embeddings, np.inf, dtype=np.float32)
+    eligible = np.ones(num_embeddings, dtype=bool)
+    remaining = None
+    if groups is not None and group_quotas is not None:
+        remaining = np.zeros(int(groups.max()) + 1, dtype=np.int64)
+        for group, quota in group_quotas.items():
+            remaining[group] = quota
+        eligible &= remaining[groups] > 0
+    for idx in initial_indices or []:
+        eligible[idx] = False
+        _update_min_distances(embeddings, squared_norms, idx, min_distances, block_size)
+
+    rng = np.random.default_rng(seed)
+    selected = []
+    while len(selected) < n_samples and eligible.any():
+        if np.isinf(min_distances[eligible]).all():
+            center = int(rng.choice(np.flatnonzero(eligible)))
+        else:
+            center = int(np.argmax(np.where(eligible, min_distances, -np.inf)))
+        selected.append(center)
+        eligible[center] = False
+        if remaining is not None:
+            remaining[groups[center]] -= 1
+            if remaining[groups[center]] == 0:
+                eligible &= groups != groups[center]
+        _update_min_distances(embeddings, squared_norms, center, min_distances, block_size)
+    return np.asarray(selected, dtype=np.int64)
+
+
+def select_diverse_balanced(
+    embeddings: npt.NDArray,
+    filenames: Sequence[str],
+    n_samples: int,
+    metadata_values: Optional[Sequence[str]] = None,
+    balance_target: Optional[Dict[str, float]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    block_size: int = 8192,
+    seed: Optional[int] = None
+    ) -> List[str]:
+    """
+    Selects diverse samples by k-center greedy while balancing a metadata value.
+
+    Args:
+        embeddings (npt.NDArray): The embeddings of shape (N, D), may be a memmap.
+        filenames (Sequence[str]): The image filenames, one per embedding.
+        n_samples (int): The number of samples to select.
+        metadata_values (Sequence[str]): The metadata value, e.g. the particle type,
+        of each image. See load_metadata_values.
+        balance_target (Dict[str, float]): The target ratio of each metadata value,
+        e.g. {"Fe": 0.5, "X-ray": 0.5}.
+        exclude (Sequence[str]): Filenames that are already labeled. They are not
+        selected and new samples are chosen far from them.
+        block_size (int): The number of embeddings processed at a time.
+        seed (int): The seed used to pick the first center.
+    Returns:
+        List[str]: The selected filenames.
+    """
+    groups = None
+    group_quotas = None
+    if balance_target is not None:
+        if metadata_values is None:
+            raise ValueError("metadata_values are required to balance the selection")
+        value_to_group = {value: group for group, value in enumerate(balance_target)}
+        # values without a target ratio get a group with a quota of zero
+        groups = np.asarray([value_to_group.get(value, len(value_to_group)) for value in metadata_values])
+        available = {value: int((groups == group).sum()) for value, group in value_to_group.items()}
+        quotas = balance_quotas(n_samples, balance_target, available)
+        group_quotas = {value_to_group[value]: quota for value, quota in quotas.items()}
+
+    filename_to_idx = {filename: idx for idx, filename in enumerate(filenames)}
+    initial_indices = [filename_to_idx[filename] for filename in exclude or [] if filename in filename_to_idx]
+
+    start = time.perf_counter()
+    indices = k_center_greedy(embeddings, n_samples, initial_indices, groups, group_quotas, block_size, seed)
+    elapsed = time.perf_counter() - start
+    print(f"Selected {len(indices)} of {len(filenames)} samples in {elapsed:.2f}s "
+          f"({elapsed / max(len(filenames), 1) * 10000:.3f}s per 10k samples)")
+    return [filenames[idx] for idx in indices]
@@ -3,15 +3,18 @@
 setup_data, dump_lightly_predictions, and generate_lightly_schema_json are based off of the work of @author Igor Susmelj
 """
 import csv
+import errno
+import hashlib
 import json
-import pyprojroot
-root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+from bps_labeler.bps_utils.project_root import root
 import os
 import shutil
 import pathlib
-from typing import List
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 import tqdm as tqdm
-import cv2
 import numpy as np
 import numpy.typing as npt
 
@@ -33,6 +36,9 @@ def convert_16bit_tif_to_8bit_tif_to_jpg(
     Returns:
         None
     """
+    # OpenCV is only needed for conversion, import it on first use
+    import cv2
+
     # open the 16-bit tif image as a numpy array
     tif_file_full_path = os.path.join(tif_file_path, tif_file_name)
     tif_image = cv2.imread(tif_file_full_path, cv2.IMREAD_ANYDEPTH)
@@ -40,9 +46,116 @@ def convert_16bit_tif_to_8bit_tif_to_jpg(
     # using opencv, normalize then scale to 255 and convert to uint8
     tif_image_8bit = cv2.normalize(tif_image, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
 
-    # save the jpg image
+    # encode in memory with the same encoder settings as cv2.imwrite, then write to a
+    # temporary file and rename it so an interrupted run never leaves a truncated jpg
+    # behind that looks up to date
+    _, jpg_buffer = cv2.imencode(".jpg", tif_image_8bit, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
     jpg_file_save_full_path = os.path.join(jpg_file_save_path, jpg_file_save_name)
-    cv2.imwrite(jpg_file_save_full_path, tif_image_8bit, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
+    tmp_file_path = f"{jpg_file_save_full_path}.{os.getpid()}.tmp"
+    with open(tmp_file_path, "wb") as jpg_file:
+        jpg_file.write(jpg_buffer.tobytes())
+    os.replace(tmp_file_path, jpg_file_save_full_path)
+
+def _is_output_up_to_date(source_full_path: str, output_full_path: str) -> bool:
+    """
+    Checks if an output file exists and is newer than the file it was generated from.
+
+    Args:
+        source_full_path (str): The path to the source file in full.
+        output_full_path (str): The path to the generated output file in full.
+    Returns:
+        bool: True if the output file is newer than the source file, False otherwise.
+    """
+    try:
+        output_mtime = os.stat(output_full_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return output_mtime > os.stat(source_full_path).st_mtime_ns
+
+def _init_conversion_worker() -> None:
+    """Keeps OpenCV single threaded inside each worker process so the pool does not
+    oversubscribe the cores."""
+    import cv2
+
+    cv2.setNumThreads(0)
+
+def _convert_tif_chunk(jobs: List[Tuple[str, str, str, str]]) -> int:
+    """
+    Converts a chunk of tif images to jpg in a worker process.
+
+    Args:
+        jobs (List[Tuple[str, str, str, str]]): The arguments for
+        convert_16bit_tif_to_8bit_tif_to_jpg, one tuple per image.
+    Returns:
+        int: The number of converted images.
+    """
+    for tif_file_path, tif_file_name, jpg_file_save_path, jpg_file_save_name in jobs:
+        convert_16bit_tif_to_8bit_tif_to_jpg(
+            tif_file_path=tif_file_path,
+            tif_file_name=tif_file_name,
+            jpg_file_save_path=jpg_file_save_path,
+            jpg_file_save_name=jpg_file_save_name
+        )
+    return len(jobs)
+
+def convert_tif_dir_to_jpg(
+    tif_dir: str,
+    jpg_dir: Optional[str] = None,
+    num_workers: Optional[int] = None,
+    chunksize: int = 64
+    ) -> Dict[str, float]:
+    """
+    Converts every 16-bit tif image in a directory to an 8-bit jpg using a process pool.
+
+    Work is submitted to the pool in chunks of `chunksize` images to amortize the
+    inter-process overhead. Images whose jpg already exists and is newer than the tif
+    are skipped, so an interrupted run resumes where it stopped. The jpg files are
+    byte-identical to the ones written by convert_16bit_tif_to_8bit_tif_to_jpg.
+
+    Args:
+        tif_dir (str): The directory containing the 16-bit tif images.
+        jpg_dir (str): The directory to save the jpg images to. Defaults to tif_dir.
+        num_workers (int): The number of worker processes. Defaults to os.cpu_count().
+        chunksize (int): The number of images submitted to a worker at a time.
+
+    Returns:
+        Dict[str, float]: The number of converted and skipped images, the elapsed
+        seconds and the conversion rate in files/sec.
+    """
+    jpg_dir = tif_dir if jpg_dir is None else jpg_dir
+    os.makedirs(jpg_dir, exist_ok=True)
+
+    jobs = []
+    num_skipped = 0
+    with os.scandir(tif_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".tif"):
+                continue
+            jpg_file_name = f'{os.path.splitext(entry.name)[0]}.jpg'
+            if _is_output_up_to_date(entry.path, os.path.join(jpg_dir, jpg_file_name)):
+                num_skipped += 1
+                continue
+            jobs.append((tif_dir, entry.name, jpg_dir, jpg_file_name))
+
+    chunks = [jobs[i:i + chunksize] for i in range(0, len(jobs), chunksize)]
+    start = time.perf_counter()
+    num_converted = 0
+    if chunks:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_conversion_worker) as executor:
+            with tqdm.tqdm(total=len(jobs), desc="Converting tif to jpg") as progress:
+                for num_done in executor.map(_convert_tif_chunk, chunks):
+                    num_converted += num_done
+                    progress.update(num_done)
+    elapsed = time.perf_counter() - start
+    files_per_sec = num_converted / elapsed if elapsed > 0 else 0.0
+    print(f'Converted {num_converted} tif files to jpg in {elapsed:.1f}s '
+          f'({files_per_sec:.1f} files/sec), skipped {num_skipped} up-to-date files.')
+    return {
+        'converted': num_converted,
+        'skipped': num_skipped,
+        'elapsed_sec': elapsed,
+        'files_per_sec': files_per_sec
+    }
 
 def is_jpg_file(filepath: str) -> bool:
     """
@@ -56,11 +169,162 @@ def is_jpg_file(filepath: str) -> bool:
         file_signature = file.read(3)
         return file_signature == b"\xFF\xD8\xFF"
 
+@dataclass(frozen=True)
+class MetadataColumn:
+    """Typed description of a metadata column in meta.csv and in the Lightly schema."""
+    path: str
+    name: str
+    dtype: type
+    default_value: Any
+    value_data_type: str
+
+# Single source of truth for the per-image metadata files and the Lightly schema.
+METADATA_COLUMNS: Tuple[MetadataColumn, ...] = (
+    MetadataColumn('dose_Gy', 'Dose (Gy)', np.float64, 0.0, 'NUMERIC_FLOAT'),
+    MetadataColumn('particle_type', 'Particle Type', np.str_, 'nothing', 'CATEGORICAL_STRING'),
+    MetadataColumn('hr_post_exposure', 'Hours Post Exposure', np.int64, 0, 'NUMERIC_INT'),
+)
+
+def _to_typed_array(values: List[str], column: MetadataColumn) -> npt.NDArray:
+    """
+    Converts the raw string values of a column to a typed array in bulk.
+
+    Args:
+        values (List[str]): The raw values of the column as read from the CSV file.
+        column (MetadataColumn): The column specification.
+    Returns:
+        npt.NDArray: The typed column.
+    Raises:
+        ValueError: If any value cannot be converted to the column dtype.
+    """
+    raw = np.asarray(values, dtype=np.str_)
+    if column.dtype is np.str_:
+        invalid = np.flatnonzero(np.char.str_len(np.char.strip(raw)) == 0)
+        if invalid.size == 0:
+            return raw
+    else:
+        try:
+            return raw.astype(column.dtype)
+        except ValueError:
+            invalid = []
+            for idx, value in enumerate(values):
+                try:
+                    np.asarray(value).astype(column.dtype)
+                except ValueError:
+                    invalid.append(idx)
+    raise ValueError(
+        f"{len(invalid)} invalid value(s) for column '{column.path}' "
+        f"(expected {np.dtype(column.dtype).name}), first at data row {invalid[0] + 1}: "
+        f"{values[invalid[0]]!r}"
+    )
+
+def iter_meta_csv_rows(csv_file) -> Iterator[List[str]]:
+    """
+    Yields the header and then the data rows of an open metadata CSV file, skipping
+    blank lines like csv.DictReader.
+
+    Args:
+        csv_file: The CSV file, opened with newline=''.
+    Returns:
+        Iterator[List[str]]: The header, followed by every non-blank data row.
+    Raises:
+        ValueError: If a data row has more or fewer fields than the header.
+    """
+    csv_reader = csv.reader(csv_file)
+    header = None
+    for row in csv_reader:
+        if not row:
+            continue
+        if header is None:
+            header = row
+        elif len(row) != len(header):
+            raise ValueError(f"{getattr(csv_file, 'name', 'CSV')} line {csv_reader.line_num} has {len(row)} "
+                             f"field(s), expected {len(header)}: {row!r}")
+        yield row
+
+def load_meta_csv_columns(csv_full_path: str) -> Dict[str, npt.NDArray]:
+    """
+    Loads the metadata CSV file once into typed column arrays.
+
+    Args:
+        csv_full_path (str): The path to the CSV file containing the metadata in full.
+    Returns:
+        Dict[str, npt.NDArray]: The `filename` column and one typed array per entry in
+        METADATA_COLUMNS, keyed by column name.
+    Raises:
+        ValueError: If a column is missing, a row has the wrong number of fields or a
+        column contains values of the wrong type.
+    """
+    with open(csv_full_path, 'r', newline='') as csv_file:
+        csv_rows = iter_meta_csv_rows(csv_file)
+        header = next(csv_rows)
+        rows = list(csv_rows)
+
+    required = ['filename'] + [column.path for column in METADATA_COLUMNS]
+    missing = [name for name in required if name not in header]
+    if missing:
+        raise ValueError(f"{csv_full_path} is missing column(s): {', '.join(missing)}")
+
+    raw_columns = list(zip(*rows)) if rows else [()] * len(header)
+    raw_by_name = {name: list(raw_columns[idx]) for idx, name in enumerate(header)}
+    columns = {'filename': np.asarray(raw_by_name['filename'], dtype=np.str_)}
+    for column in METADATA_COLUMNS:
+        columns[column.path] = _to_typed_array(raw_by_name[column.path], column)
+    return columns
+
+def write_meta_json_files(
+    columns: Dict[str, npt.NDArray],
+    json_file_path: str,
+    s3_bucket_data_dir: str = 'data',
+    manifest_file_name: Optional[str] = None
+    ) -> int:
+    """
+    Writes one Lightly metadata JSON file per image from typed metadata columns.
+
+    Each file is serialized in memory and written with a single write call. Optionally
+    all entries are also written to a single JSON-lines manifest.
+
+    Args:
+        columns (Dict[str, npt.NDArray]): The metadata columns as returned by
+        load_meta_csv_columns.
+        json_file_path (str): The path to the directory where the JSON files will
+        be saved.
+        s3_bucket_data_dir (str): The directory of the images in the S3 bucket.
+        manifest_file_name (str): The name of the JSON-lines manifest saved to
+        json_file_path. No manifest is written if None.
+    Returns:
+        int: The number of metadata files written.
+    """
+    filestems = [os.path.splitext(filename)[0] for filename in columns['filename'].tolist()]
+    # convert to python types once per column instead of once per value
+    values = [columns[column.path].tolist() for column in METADATA_COLUMNS]
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    manifest_lines = []
+    for idx, filestem in enumerate(filestems):
+        metadata_entry = {
+            'file_name': f'{s3_bucket_data_dir}/{filestem}.jpg',
+            'type': 'image',
+            'metadata': {column.path: value[idx] for column, value in zip(METADATA_COLUMNS, values)}
+        }
+        fd = os.open(os.path.join(json_file_path, f'{filestem}.json'), flags, 0o644)
+        try:
+            os.write(fd, json.dumps(metadata_entry, indent=4).encode())
+        finally:
+            os.close(fd)
+        if manifest_file_name is not None:
+            manifest_lines.append(json.dumps(metadata_entry))
+
+    if manifest_file_name is not None:
+        with open(os.path.join(json_file_path, manifest_file_name), 'w') as manifest_file:
+            manifest_file.write('\n'.join(manifest_lines) + '\n' if manifest_lines else '')
+    return len(filestems)
+
 def generate_meta_json_per_from_csv(
     csv_file_name: str = 'filtered_meta.csv',
     csv_file_path: str = os.path.join(root, "data_Gyhi_4hr"),
     json_file_path: str = os.path.join(root, "data_Gyhi_4hr"),
-    s3_bucket_data_dir: str = 'data'
+    s3_bucket_data_dir: str = 'data',
+    manifest_file_name: Optional[str] = None
     ) -> None :
     """
     Generates a metadata JSON file containing metadata for each image
@@ -71,45 +335,28 @@ def generate_meta_json_per_from_csv(
         csv_file_path (str): The path to the CSV file containing the metadata.
         json_file_path (str): The path to the directory where the JSON file will
         be saved.
+        s3_bucket_data_dir (str): The directory of the images in the S3 bucket.
+        manifest_file_name (str): The name of an optional JSON-lines manifest
+        containing every metadata entry, e.g. 'metadata.jsonl'.
     
     Returns:
         None
     """
-    # Open the csv file containing the metadata for each image as a row.
-    csv_full_path = os.path.join(csv_file_path, csv_file_name)
-    with open(csv_full_path, 'r') as csv_file:
-        # Parse the CSV file
-        csv_reader = csv.DictReader(csv_file)
-
-        # Iterate over each row in the CSV file
-        for row in csv_reader:
-            # Create a dictionary for the metadata entry
-            filestem = os.path.splitext(row['filename'])[0]
-            metadata_entry = {
-                'file_name': f'{s3_bucket_data_dir}/{filestem}.jpg',
-                'type': 'image',
-                'metadata': {
-                    'dose_Gy': float(row['dose_Gy']),
-                    'particle_type': row['particle_type'],
-                    'hr_post_exposure': int(row['hr_post_exposure'])
-                }
-            }
-
-            # Generate the metadata JSON file name
-            json_fname = os.path.splitext(row['filename'])[0]
-            json_file_name = json_fname + '.json'
-
-            # Write the metadata entry to the JSON file
-            json_full_path = os.path.join(json_file_path, json_file_name)
-            print(f'json_full_path: {json_full_path}')
-            with open(json_full_path, 'w') as json_file:
-                json.dump(metadata_entry, json_file, indent=4)
+    # Load the csv file once into typed columns, validating all values in bulk
+    columns = load_meta_csv_columns(os.path.join(csv_file_path, csv_file_name))
+    num_written = write_meta_json_files(
+        columns,
+        json_file_path,
+        s3_bucket_data_dir=s3_bucket_data_dir,
+        manifest_file_name=manifest_file_name
+    )
+    print(f'Wrote {num_written} metadata JSON files to {json_file_path}')
 
 def generate_lightly_schema_json(path_to_save_file: str = os.path.join(root, "data_Gyhi_4hr")):
     """
     This function generates the Lightly schema JSON file that is used to
     configure the Lightly dataset to read custom metadata from the individual
-    .tif files.
+    .tif files. The metadata entries are derived from METADATA_COLUMNS.
 
     Args:
         path_to_save_file (str): The path to the directory where the JSON file will
@@ -130,44 +377,132 @@ def generate_lightly_schema_json(path_to_save_file: str = os.path.join(root, "da
             "path": "type",
             "defaultValue": "undefined",
             "valueDataType": "CATEGORICAL_STRING"
-        },
-        {
-            "name": "Dose (Gy)",
-            "path": "dose_Gy",
-            "defaultValue": 0.0,
-            "valueDataType": "NUMERIC_FLOAT"
-        },
-        {
-            "name": "Particle Type",
-            "path": "particle_type",
-            "defaultValue": "nothing",
-            "valueDataType": "CATEGORICAL_STRING"
-        },
-        {
-            "name": "Hours Post Exposure",
-            "path": "hr_post_exposure",
-            "defaultValue": 0,
-            "valueDataType": "NUMERIC_INT"
         }
     ]
+    schema.extend(
+        {
+            "name": column.name,
+            "path": column.path,
+            "defaultValue": column.default_value,
+            "valueDataType": column.value_data_type
+        }
+        for column in METADATA_COLUMNS
+    )
     json_file_name = 'schema.json'
     json_full_path = os.path.join(path_to_save_file, json_file_name)
     with open(json_full_path, 'w') as json_file:
         json.dump(schema, json_file, indent=4)
 
-def setup_data(data_dir_str: str) -> None:
+def _stable_unit_hash(filestem: str, salt: str = '') -> float:
+    """
+    Maps a filestem to a reproducible number in [0, 1) independent of global RNG state.
+
+    Args:
+        filestem (str): The filestem to hash.
+        salt (str): A salt to draw a different, equally reproducible split.
+    Returns:
+        float: The hash of the filestem scaled to [0, 1).
+    """
+    digest = hashlib.blake2b(f'{salt}{filestem}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2**64
+
+def _scandir_names(dir_path: pathlib.Path, suffix: str) -> List[str]:
+    """Lists the names of the files in a directory ending with suffix in a single pass."""
+    with os.scandir(dir_path) as entries:
+        return [entry.name for entry in entries if entry.name.endswith(suffix) and entry.is_file()]
+
+def _move_file(src: pathlib.Path, dst_dir: pathlib.Path) -> None:
+    """
+    Moves a file with a same-filesystem rename, copying only across devices.
+
+    Args:
+        src (pathlib.Path): The path to the file to move.
+        dst_dir (pathlib.Path): The directory to move the file into.
+    """
+    dst = dst_dir / src.name
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(src, dst)
+        os.remove(src)
+
+def plan_train_val_split(
+    filestems: List[str],
+    val_fraction: float = 0.01,
+    strata: Optional[Dict[str, str]] = None,
+    existing_counts: Optional[Dict[str, Tuple[int, int]]] = None,
+    salt: str = ''
+    ) -> Dict[str, str]:
+    """
+    Assigns new samples to the training or validation set by a stable hash of their
+    filestem, so the split is reproducible and samples never change sides when new
+    images arrive.
+
+    Without strata a sample goes to the validation set if its hash is below
+    val_fraction. With strata the samples of each stratum are ranked by hash and the
+    lowest ranked ones fill the stratum's validation quota, taking into account the
+    samples that were already split in an earlier run.
+
+    Args:
+        filestems (List[str]): The filestems of the samples to split.
+        val_fraction (float): The fraction of samples in the validation set.
+        strata (Dict[str, str]): The stratum, e.g. the particle type, of each filestem.
+        existing_counts (Dict[str, Tuple[int, int]]): The number of (training,
+        validation) samples per stratum from earlier runs.
+        salt (str): A salt to draw a different, equally reproducible split.
+    Returns:
+        Dict[str, str]: "train" or "val" for each filestem.
+    """
+    hashes = {filestem: _stable_unit_hash(filestem, salt) for filestem in filestems}
+    if strata is None:
+        return {filestem: 'val' if h < val_fraction else 'train' for filestem, h in hashes.items()}
+
+    existing_counts = existing_counts or {}
+    by_stratum: Dict[str, List[str]] = {}
+    for filestem in filestems:
+        by_stratum.setdefault(strata[filestem], []).append(filestem)
+
+    plan = {}
+    for stratum, members in by_stratum.items():
+        num_train, num_val = existing_counts.get(stratum, (0, 0))
+        quota = round(val_fraction * (num_train + num_val + len(members))) - num_val
+        members.sort(key=hashes.__getitem__)
+        for rank, filestem in enumerate(members):
+            plan[filestem] = 'val' if rank < quota else 'train'
+    return plan
+
+def setup_data(
+    data_dir_str: str,
+    val_fraction: float = 0.01,
+    stratify_by: Optional[str] = None,
+    csv_file_name: str = 'filtered_meta.csv',
+    salt: str = ''
+    ) -> None:
     """Splits the full dataset into a training set and a validation set and
     places them in separate folders.
 
     The training set will have images that will be used to train the model. Even if
     they are already labelled, we will use them as unlabelled data and use Lightly
     to label them. The validation set will be used to evaluate the model's performance.
+
+    Membership is decided by plan_train_val_split, so rerunning after new images arrive
+    only moves the new images. `full_train.json` and `val.json` list both the newly
+    split and the previously split samples.
+
+    Args:
+        data_dir_str (str): The data directory containing the jpg and json files.
+        val_fraction (float): The fraction of samples in the validation set.
+        stratify_by (str): A metadata column, e.g. 'particle_type', to stratify the
+        split by. Values are read from csv_file_name in data_dir_str.
+        csv_file_name (str): The name of the metadata CSV file.
+        salt (str): A salt to draw a different, equally reproducible split.
+    Raises:
+        ValueError: If stratify_by is given and an image has no row in csv_file_name.
     """
     data_dir = pathlib.Path(data_dir_str)
-    files = os.listdir(data_dir)
 
-    # train_set_path = os.path.join(data_dir, "train_set")
-    # val_set_path = os.path.join(data_dir, "val_set")
     train_set_path = pathlib.Path(os.path.join(data_dir, "train_set"))
     print(f'train_set_path: {train_set_path}')
     val_set_path = pathlib.Path(os.path.join(data_dir, "val_set"))
@@ -189,62 +524,146 @@ def setup_data(data_dir_str: str) -> None:
     val_set_jpg_path.mkdir(exist_ok=True)
     val_set_json_path.mkdir(exist_ok=True)
 
-    for file in files:
-        if file.endswith(".jpg"):
-            # split on the . in the filename to get the filestem
-            filestem = file.split(".")[0]
-
-            if np.random.rand() < 0.99:
-                if os.path.exists(data_dir / f"{filestem}.json"):
-                    shutil.move(data_dir / file, train_set_jpg_path)
-                    shutil.move(data_dir / f"{filestem}.json", train_set_json_path)
-                else:
-                    raise FileNotFoundError(f"{filestem}.json not found")
-            else:
-                if os.path.exists(data_dir / f"{filestem}.json"):
-                    shutil.move(data_dir / file, val_set_jpg_path)
-                    shutil.move(data_dir / f"{filestem}.json", val_set_json_path)
-                else:
-                    raise FileNotFoundError(f"{filestem}.json not found")
+    # list every directory once
+    with os.scandir(data_dir) as entries:
+        names = {entry.name for entry in entries if entry.is_file()}
+    filestems = sorted(os.path.splitext(name)[0] for name in names if name.endswith(".jpg"))
+    missing = [filestem for filestem in filestems if f"{filestem}.json" not in names]
+    if missing:
+        raise FileNotFoundError(f"{missing[0]}.json not found ({len(missing)} metadata files missing)")
+    existing = {
+        'train': _scandir_names(train_set_jpg_path, ".jpg"),
+        'val': _scandir_names(val_set_jpg_path, ".jpg"),
+    }
+
+    strata = None
+    existing_counts = None
+    if stratify_by is not None:
+        columns = load_meta_csv_columns(os.path.join(data_dir, csv_file_name))
+        stem_to_value = {
+            os.path.splitext(filename)[0]: value
+            for filename, value in zip(columns['filename'].tolist(), columns[stratify_by].tolist())
+        }
+        unknown = [filestem for filestem in filestems if filestem not in stem_to_value]
+        if unknown:
+            raise ValueError(f"{len(unknown)} image(s) in {data_dir} have no row in {csv_file_name} to stratify "
+                             f"by {stratify_by!r}: {', '.join(unknown[:10])}{', ...' if len(unknown) > 10 else ''}")
+        strata = {filestem: stem_to_value[filestem] for filestem in filestems}
+        existing_counts = {}
+        for split, split_idx in (('train', 0), ('val', 1)):
+            for name in existing[split]:
+                value = stem_to_value.get(os.path.splitext(name)[0])
+                counts = existing_counts.setdefault(value, [0, 0])
+                counts[split_idx] += 1
+        existing_counts = {value: tuple(counts) for value, counts in existing_counts.items()}
+
+    plan = plan_train_val_split(filestems, val_fraction, strata, existing_counts, salt)
+    destinations = {
+        'train': (train_set_jpg_path, train_set_json_path),
+        'val': (val_set_jpg_path, val_set_json_path),
+    }
+    for filestem, split in plan.items():
+        jpg_dir, json_dir = destinations[split]
+        _move_file(data_dir / f"{filestem}.jpg", jpg_dir)
+        _move_file(data_dir / f"{filestem}.json", json_dir)
+
+    # build the manifests from the plan and the earlier listing instead of re-globbing
+    manifests = {split: list(names) for split, names in existing.items()}
+    for filestem, split in plan.items():
+        manifests[split].append(f"{filestem}.jpg")
+    num_new_val = sum(split == 'val' for split in plan.values())
+    print(f'Split {len(plan)} new samples: {len(plan) - num_new_val} train, {num_new_val} val')
+
     # create a json file in data_dir that records paths to all files in the train_set as a list of dictionaries
     # with a key called path and saved as full_train.json
     with open(data_dir / "full_train.json", "w") as f:
-        json.dump([{"path": str(path)} for path in train_set_jpg_path.glob("*.jpg")], f)
+        json.dump([{"path": str(train_set_jpg_path / name)} for name in sorted(manifests['train'])], f)
    
     # create a json file in data_dir that records paths to all files in the val_set called
     # val.json
     with open(data_dir / "val.json", "w") as f:
-        json.dump([{"path": str(path)} for path in val_set_jpg_path.glob("*.jpg")], f)
+        json.dump([{"path": str(val_set_jpg_path / name)} for name in sorted(manifests['val'])], f)
 
-def dump_lightly_predictions(filenames: List[str], predictions: npt.NDArray, predictions_dir: str) -> None:
-    """Dumps model predictions in the Lightly Prediction format.
+# Encoder reused for every prediction file, with the same output as json.dump defaults.
+_PREDICTION_ENCODER = json.JSONEncoder(check_circular=False)
+
+def _write_bytes(path: str, data: bytes) -> None:
+    """Writes bytes to a file with a single write call."""
+    with open(path, "wb") as f:
+        f.write(data)
+
+def encode_lightly_predictions(filenames: List[str], predictions: npt.NDArray) -> List[bytes]:
+    """Encodes a batch of model predictions in the Lightly Prediction format.
+
+    The probabilities are renormalized and the argmax is taken over the whole
+    `(N, num_classes)` array at once.
+
+    Args:
+        filenames (List[str]): The image filenames, one per row of predictions.
+        predictions (npt.NDArray): The class probabilities of shape (N, num_classes).
+    Returns:
+        List[bytes]: The encoded prediction file contents, one per image.
+    """
+    probabilities = np.asarray(predictions, dtype=np.float64)
+    # Normalise probabilities again because of precision loss of float32 predictions.
+    probabilities = probabilities / probabilities.sum(axis=1, keepdims=True)
+    category_ids = np.argmax(probabilities, axis=1).tolist()
+    return [
+        _PREDICTION_ENCODER.encode({
+            "file_name": filename,
+            "predictions": [
+                {
+                    "category_id": category_id,
+                    "probabilities": probs,
+                }
+            ],
+        }).encode()
+        for filename, category_id, probs in zip(filenames, category_ids, probabilities.tolist())
+    ]
+
+def dump_lightly_prediction_batches(
+    batches: Iterable[Tuple[List[str], npt.NDArray]],
+    predictions_dir: str,
+    max_workers: int = 8
+    ) -> int:
+    """Dumps batches of model predictions in the Lightly Prediction format.
 
     Each input image has its own prediction file. The filename is `<image_name>.json`.
+    Batches are consumed lazily, so an iterator from
+    ResNet50Classifier.iter_active_learning_predictions can be streamed to disk while
+    the files of the previous batch are written by a thread pool.
+
+    Args:
+        batches (Iterable[Tuple[List[str], npt.NDArray]]): (filenames, predictions) pairs.
+        predictions_dir (str): The directory to save the prediction files to.
+        max_workers (int): The number of threads writing files.
+    Returns:
+        int: The number of prediction files written.
     """
-    # set path based on predictions_dir
     pred_path = pathlib.Path(os.path.join(root, predictions_dir))
     print(f'pred_path: {pred_path}')
-    #pathlib.Path("lightly_predictions") #pass this in as an input parameter
     # if pred_path does not exist, create it
     pred_path.mkdir(exist_ok=True)
-    # os.mkdir(pred_path)
-    for filename, prediction in zip(filenames, predictions):
-        print(f'filename: {filename}, prediction: {prediction}')
-        preds_fname = str(pred_path / pathlib.Path(filename).stem) + ".json"
-        print(f'preds_fname: {preds_fname}')
-        with open(preds_fname, "w") as f:
-            pred_list = prediction.tolist()
-            # Normalise probabilities again because of precision loss in `to_list`.
-            pred_sum = sum(pred_list)
-            json.dump(
-                {
-                    "file_name": filename,
-                    "predictions": [
-                        {
-                            "category_id": int(np.argmax(prediction)),
-                            "probabilities": [p / pred_sum for p in pred_list],
-                        }
-                    ],
-                },
-                f,
-            )
+
+    num_written = 0
+    pending = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for filenames, predictions in batches:
+            paths = [str(pred_path / pathlib.Path(filename).stem) + ".json" for filename in filenames]
+            contents = encode_lightly_predictions(filenames, predictions)
+            # keep at most one batch in flight so memory stays bounded while streaming
+            for future in pending:
+                future.result()
+            pending = [executor.submit(_write_bytes, path, data) for path, data in zip(paths, contents)]
+            num_written += len(paths)
+        for future in pending:
+            future.result()
+    print(f'Wrote {num_written} prediction files to {pred_path}')
+    return num_written
+
+def dump_lightly_predictions(filenames: List[str], predictions: npt.NDArray, predictions_dir: str) -> None:
+    """Dumps model predictions in the Lightly Prediction format.
+
+    Each input image has its own prediction file. The filename is `<image_name>.json`.
+    """
+    dump_lightly_prediction_batches([(filenames, predictions)], predictions_dir)
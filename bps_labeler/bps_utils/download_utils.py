@@ -0,0 +1,203 @@
+""" Concurrent download of selected samples from their read URLs.
+A single pooled requests.Session is shared by a bounded thread pool, responses are
+streamed in large chunks to a temporary file that is renamed into place once its
+size, and its checksum where the server asserts one, is verified, and files already
+present are skipped. file:// URLs of local selections are copied.
+
+Checksums are taken from Content-MD5 and x-amz-checksum-{crc32,sha1,sha256}. A plain
+32-hex ETag is only an md5 of the content for unencrypted or SSE-S3 objects; SSE-KMS
+and SSE-C objects have 32-hex ETags that are not, so ETags are only checked with
+verify_etag=True.
+"""
+import base64
+import hashlib
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import requests
+import tqdm as tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class _Crc32:
+    """hashlib-like running CRC32, digesting to 4 big-endian bytes as S3 reports it."""
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data: bytes) -> None:
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self) -> bytes:
+        return self.value.to_bytes(4, "big")
+
+
+# headers asserting a base64 checksum of the whole content, see the S3 GetObject docs
+_CHECKSUM_HEADERS = {
+    "Content-MD5": hashlib.md5,
+    "x-amz-checksum-sha256": hashlib.sha256,
+    "x-amz-checksum-sha1": hashlib.sha1,
+    "x-amz-checksum-crc32": _Crc32,
+}
+
+
+def _expected_checksum(headers, verify_etag: bool) -> Tuple[Optional[str], Optional[bytes], Optional[Callable]]:
+    """The asserted checksum of a response as (header, digest bytes, hash constructor),
+    or Nones if the server asserts none."""
+    for header, constructor in _CHECKSUM_HEADERS.items():
+        value = headers.get(header)
+        # composite checksums of multipart uploads end in -<parts> and cover the parts only
+        if value and "-" not in value:
+            return header, base64.b64decode(value), constructor
+    etag_match = _MD5_ETAG.match(headers.get("ETag", "")) if verify_etag else None
+    if etag_match:
+        return "ETag", bytes.fromhex(etag_match.group(1)), hashlib.md5
+    return None, None, None
+
+
+def create_session(max_connections: int = 16, max_retries: int = 3, backoff_sec: float = 0.5) -> requests.Session:
+    """
+    Creates a requests.Session whose connection pool is shared by all download threads.
+
+    Args:
+        max_connections (int): The number of pooled connections per host.
+        max_retries (int): Retries on connection errors and 5xx responses.
+        backoff_sec (float): The backoff factor between retries.
+    Returns:
+        requests.Session: The session.
+    """
+    retry = Retry(total=max_retries, backoff_factor=backoff_sec, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_file(
+    session: Optional[requests.Session],
+    read_url: str,
+    local_path: str,
+    chunk_size: int = 1 << 20,
+    timeout_sec: float = 60.0,
+    verify_etag: bool = False
+    ) -> int:
+    """
+    Downloads a single file to a temporary file and renames it into place once verified.
+
+    Args:
+        session (requests.Session): The session to download with, unused for file:// URLs.
+        read_url (str): The URL to read the file from.
+        local_path (str): The path to save the file to.
+        chunk_size (int): The number of bytes read from the response at a time.
+        timeout_sec (float): The connect and read timeout.
+        verify_etag (bool): Whether to also treat a plain 32-hex ETag as the md5 of the
+        content, only correct for objects without SSE-KMS or SSE-C encryption.
+    Returns:
+        int: The number of bytes downloaded.
+    """
+    # unique per call, so threads downloading the same file name do not share it
+    tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            if read_url.startswith("file://"):
+                # local selections point at images already on disk
+                with open(url2pathname(urlparse(read_url).path), "rb") as src:
+                    shutil.copyfileobj(src, f, chunk_size)
+            else:
+                with session.get(read_url, stream=True, timeout=timeout_sec) as response:
+                    response.raise_for_status()
+                    header, expected_digest, constructor = _expected_checksum(response.headers, verify_etag)
+                    digest = constructor() if constructor is not None else None
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        if digest is not None:
+                            digest.update(chunk)
+                    expected_size = response.headers.get("Content-Length")
+                downloaded_size = f.tell()
+                # Content-Length is the encoded size, only comparable without Content-Encoding
+                if expected_size is not None and "Content-Encoding" not in response.headers \
+                        and int(expected_size) != downloaded_size:
+                    raise IOError(f"Size mismatch for {local_path}: expected {expected_size} bytes, "
+                                  f"got {downloaded_size}")
+                if digest is not None and digest.digest() != expected_digest:
+                    raise IOError(f"Checksum mismatch for {local_path}: {header} does not match the content")
+        num_bytes = os.path.getsize(tmp_path)
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return num_bytes
+
+
+def download_samples(
+    filename_url_mappings: List[Dict[str, str]],
+    output_path: str,
+    max_workers: int = 16,
+    chunk_size: int = 1 << 20,
+    overwrite: bool = False,
+    session: Optional[requests.Session] = None,
+    verify_etag: bool = False
+    ) -> Dict[str, float]:
+    """
+    Downloads samples concurrently over a pooled session.
+
+    Args:
+        filename_url_mappings (List[Dict[str, str]]): The samples as exported by Lightly,
+        [{"fileName": "image1.png", "readUrl": "https://..."}, ...].
+        output_path (str): The directory to save the samples to.
+        max_workers (int): The maximum number of concurrent downloads.
+        chunk_size (int): The number of bytes read from a response at a time.
+        overwrite (bool): Whether to download files that are already present.
+        session (requests.Session): The session to use, see create_session.
+        verify_etag (bool): Whether plain 32-hex ETags are checked as md5s, see
+        download_file.
+    Returns:
+        Dict[str, float]: The number of downloaded, skipped and failed files, the bytes
+        transferred, the elapsed seconds and the throughput in MB/s.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    session = session or create_session(max_connections=max_workers)
+    summary = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    pending: List[Tuple[str, str]] = []
+    for entry in filename_url_mappings:
+        local_path = os.path.join(output_path, entry["fileName"])
+        if not overwrite and os.path.exists(local_path):
+            summary["skipped"] += 1
+            continue
+        pending.append((entry["readUrl"], local_path))
+
+    errors = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_file, session, read_url, local_path, chunk_size, verify_etag=verify_etag):
+                local_path
+            for read_url, local_path in pending
+        }
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc="Downloading samples"):
+            try:
+                summary["bytes"] += future.result()
+                summary["downloaded"] += 1
+            except Exception as e:
+                summary["failed"] += 1
+                errors.append(f"{os.path.basename(futures[future])}: {e!r}")
+    summary["elapsed_sec"] = time.perf_counter() - start
+    summary["mb_per_sec"] = summary["bytes"] / 1e6 / max(summary["elapsed_sec"], 1e-9)
+    print(f"Downloaded {summary['downloaded']} files ({summary['bytes'] / 1e6:.1f} MB) in "
+          f"{summary['elapsed_sec']:.1f}s ({summary['mb_per_sec']:.1f} MB/s), skipped {summary['skipped']} "
+          f"present files, {summary['failed']} failed.")
+    if errors:
+        raise RuntimeError(f"{len(errors)} downloads failed, rerun to retry them:\n" + "\n".join(errors[:10]))
+    return summary
@@ -0,0 +1,211 @@
+""" Concurrent, resumable fetching of a filtered subset of the BPS dataset.
+The metadata CSV is filtered in memory with a simple expression such as
+"dose_Gy >= 0.82 and hr_post_exposure == 4" and the matching objects are downloaded
+through a StorageBackend with a bounded thread pool.
+"""
+import csv
+import operator
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import tqdm as tqdm
+
+from bps_labeler.bps_utils.data_utils import METADATA_COLUMNS, iter_meta_csv_rows, load_meta_csv_columns
+from bps_labeler.bps_utils.storage_utils import StorageBackend, md5_etag
+
+_OPERATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+}
+_CLAUSE_PATTERN = re.compile(r"^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*(.+?)\s*$")
+
+
+def parse_filter_expression(expression: str) -> List[Tuple[str, str, str]]:
+    """
+    Parses a filter expression made of comparisons joined by `and`.
+
+    Args:
+        expression (str): The filter expression, e.g.
+        "dose_Gy >= 0.82 and hr_post_exposure == 4 and particle_type == 'Fe'".
+    Returns:
+        List[Tuple[str, str, str]]: One (column, operator, value) tuple per comparison.
+    Raises:
+        ValueError: If a comparison cannot be parsed or references an unknown column.
+    """
+    known_columns = {column.path for column in METADATA_COLUMNS}
+    clauses = []
+    for clause in re.split(r"\s+and\s+", expression.strip()):
+        match = _CLAUSE_PATTERN.match(clause)
+        if match is None:
+            raise ValueError(f"Cannot parse filter clause: {clause!r}")
+        column, op, value = match.groups()
+        if column not in known_columns:
+            raise ValueError(f"Unknown metadata column in filter: {column!r}")
+        clauses.append((column, op, value.strip("'\"")))
+    return clauses
+
+
+def filter_mask(columns: Dict[str, npt.NDArray], expression: str) -> npt.NDArray:
+    """
+    Evaluates a filter expression over typed metadata columns.
+
+    Args:
+        columns (Dict[str, npt.NDArray]): The metadata columns as returned by
+        load_meta_csv_columns.
+        expression (str): The filter expression, see parse_filter_expression.
+    Returns:
+        npt.NDArray: A boolean mask selecting the matching rows.
+    """
+    mask = np.ones(len(columns["filename"]), dtype=bool)
+    for column, op, value in parse_filter_expression(expression):
+        values = columns[column]
+        mask &= _OPERATORS[op](values, values.dtype.type(value))
+    return mask
+
+
+def write_filtered_meta_csv(csv_full_path: str, mask: npt.NDArray, filtered_csv_full_path: str) -> None:
+    """
+    Writes the header and the selected rows of a metadata CSV file unchanged.
+
+    Args:
+        csv_full_path (str): The path to the source CSV file in full.
+        mask (npt.NDArray): A boolean mask selecting the rows to keep.
+        filtered_csv_full_path (str): The path to the filtered CSV file in full.
+    """
+    with open(csv_full_path, "r", newline="") as src, open(filtered_csv_full_path, "w", newline="") as dst:
+        # the same rows as load_meta_csv_columns, so the mask stays aligned across blank lines
+        rows = iter_meta_csv_rows(src)
+        writer = csv.writer(dst, lineterminator="\n")
+        writer.writerow(next(rows))
+        writer.writerows(row for row, keep in zip(rows, mask) if keep)
+
+
+def _fetch_object(backend: StorageBackend, key: str, local_dir: str, verify_etag: bool) -> Tuple[str, int]:
+    """
+    Downloads a single object unless an identical local copy already exists.
+
+    Returns:
+        Tuple[str, int]: The outcome ("downloaded" or "skipped") and the bytes transferred.
+    """
+    local_path = os.path.join(local_dir, os.path.basename(key))
+    info = backend.head(key)
+    if info is None:
+        raise FileNotFoundError(f"{key} not found in storage backend")
+    if os.path.exists(local_path) and os.path.getsize(local_path) == info.size:
+        # multipart ETags are not an md5 of the content, so only the size can be checked
+        if not verify_etag or "-" in info.etag or md5_etag(local_path) == info.etag:
+            return "skipped", 0
+
+    # unique per thread, so a key listed twice does not clobber its own temporary file
+    tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            backend.download(key, f)
+        downloaded_size = os.path.getsize(tmp_path)
+        if downloaded_size != info.size:
+            raise IOError(f"Size mismatch for {key}: expected {info.size} bytes, got {downloaded_size}")
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return "downloaded", downloaded_size
+
+
+def fetch_objects(
+    backend: StorageBackend,
+    keys: List[str],
+    local_dir: str,
+    max_workers: int = 16,
+    verify_etag: bool = False
+    ) -> Dict[str, float]:
+    """
+    Downloads objects concurrently, writing each to a temporary file that is renamed
+    into place once complete. Objects whose local copy already has the same size (and
+    ETag if `verify_etag`) are skipped, so an interrupted fetch can simply be rerun.
+
+    Args:
+        backend (StorageBackend): The storage backend to download from.
+        keys (List[str]): The keys of the objects to download.
+        local_dir (str): The directory to save the objects to.
+        max_workers (int): The maximum number of concurrent downloads.
+        verify_etag (bool): Whether to compare md5 checksums of existing local files.
+    Returns:
+        Dict[str, float]: The number of downloaded, skipped and failed objects, the bytes
+        transferred and the elapsed seconds.
+    Raises:
+        RuntimeError: If any object failed, after all others were fetched.
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    summary = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    errors = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_fetch_object, backend, key, local_dir, verify_etag): key for key in keys}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc="Fetching objects"):
+            try:
+                outcome, num_bytes = future.result()
+                summary[outcome] += 1
+                summary["bytes"] += num_bytes
+            except Exception as e:
+                summary["failed"] += 1
+                errors.append(f"{futures[future]}: {e!r}")
+    summary["elapsed_sec"] = time.perf_counter() - start
+    print(f"Downloaded {summary['downloaded']} objects ({summary['bytes'] / 1e6:.1f} MB) "
+          f"in {summary['elapsed_sec']:.1f}s, skipped {summary['skipped']} existing objects, "
+          f"{summary['failed']} failed.")
+    if errors:
+        raise RuntimeError(f"{len(errors)} objects failed, rerun to retry them:\n" + "\n".join(errors[:10]))
+    return summary
+
+
+def fetch_filtered_dataset(
+    backend: StorageBackend,
+    local_dir: str,
+    filter_expression: str,
+    meta_csv_key: str = "meta.csv",
+    max_workers: int = 16,
+    verify_etag: bool = False,
+    filtered_csv_name: Optional[str] = "filtered_meta.csv"
+    ) -> Dict[str, float]:
+    """
+    Downloads the metadata CSV, filters it in memory and fetches the matching images.
+
+    Writes `filtered_files.txt` and the filtered metadata CSV to local_dir, matching the
+    layout expected by 01_local_data_setup_lightly.py.
+
+    Args:
+        backend (StorageBackend): The storage backend holding meta.csv and the images.
+        local_dir (str): The directory to save the data to.
+        filter_expression (str): The filter expression, see parse_filter_expression.
+        meta_csv_key (str): The key of the metadata CSV file in the backend.
+        max_workers (int): The maximum number of concurrent downloads.
+        verify_etag (bool): Whether to compare md5 checksums of existing local files.
+        filtered_csv_name (str): The name of the filtered metadata CSV file.
+    Returns:
+        Dict[str, float]: The fetch summary, see fetch_objects.
+    """
+    fetch_objects(backend, [meta_csv_key], local_dir, max_workers=1, verify_etag=verify_etag)
+    csv_full_path = os.path.join(local_dir, os.path.basename(meta_csv_key))
+    columns = load_meta_csv_columns(csv_full_path)
+    mask = filter_mask(columns, filter_expression)
+    filenames = columns["filename"][mask].tolist()
+    print(f"{len(filenames)} of {len(mask)} images match '{filter_expression}'")
+
+    with open(os.path.join(local_dir, "filtered_files.txt"), "w") as f:
+        f.write("".join(f"{filename}\n" for filename in filenames))
+    if filtered_csv_name is not None:
+        write_filtered_meta_csv(csv_full_path, mask, os.path.join(local_dir, filtered_csv_name))
+
+    key_dir = os.path.dirname(meta_csv_key)
+    keys = [f"{key_dir}/{filename}" if key_dir else filename for filename in filenames]
+    return fetch_objects(backend, keys, local_dir, max_workers=max_workers, verify_etag=verify_etag)
@@ -1,20 +1,24 @@
 """ Utilities for reading LabelStudio output files.
 Taken from https://github.com/lightly-ai/Lightly_LabelStudio_AL
 """
+import hashlib
 import json
 import os
 import pathlib
-from typing import Dict, List, Tuple
+import posixpath
+import re
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
 import numpy.typing as npt
 
 
-from PIL import Image
-import pyprojroot
-root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+from bps_labeler.bps_utils.project_root import root
 #IMAGE_SIZE = 224  # Resize images
 
+_SEPARATORS = re.compile(r"[\s,]*")
+CONFLICT_POLICIES = ("last", "first", "error")
+
 
 def read_label_element(label_element: Dict) -> Tuple[str, str]:
     """Parses labels from LabelStudio output data structure."""
@@ -23,9 +27,129 @@ def read_label_element(label_element: Dict) -> Tuple[str, str]:
     return filepath.name, label
 
 
-def read_label_studio_annotation_file(filepath: str) -> Tuple[List[str], List[str]]:
+def _element_filename(label_element: Dict) -> str:
+    """The image filename of a LabelStudio output element, as read_label_element
+    returns it, without building a pathlib.Path."""
+    return posixpath.basename(label_element["image"].split("?d=")[-1].rstrip("/"))
+
+
+def iter_label_studio_annotations(filepath: str, chunk_size: int = 1 << 20) -> Iterator[Dict]:
+    """
+    Streams the elements of a LabelStudio JSON-MIN export without loading the whole file.
+
+    The top level array is read in chunks and every element is decoded with
+    json.JSONDecoder.raw_decode as soon as it is complete.
+
+    Args:
+        filepath (str): The path to the export, a JSON array of objects.
+        chunk_size (int): The number of characters read at a time.
+    Yields:
+        Dict: One annotated task per element.
+    """
+    decoder = json.JSONDecoder()
+    with open(filepath, "r") as f:
+        buffer = f.read(chunk_size).lstrip("\ufeff")
+        pos = _SEPARATORS.match(buffer).end()
+        if buffer[pos:pos + 1] != "[":
+            raise ValueError(f"{filepath} is not a JSON array")
+        pos += 1
+        eof = False
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            if pos < len(buffer):
+                try:
+                    element, pos = decoder.raw_decode(buffer, pos)
+                    yield element
+                    continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            elif eof:
+                raise ValueError(f"{filepath} ended before the closing bracket")
+            # the next element is incomplete, read more
+            more = f.read(chunk_size)
+            eof = not more
+            buffer = buffer[pos:] + more
+            pos = 0
+
+
+def read_label_studio_annotation_file(filepath: str) -> List[Tuple[str, str]]:
     """Reads labels from LabelStudio output files."""
-    # read the label file
-    with open(filepath, "r") as json_file:
-        data = json.load(json_file)
-    return [read_label_element(label_element) for label_element in data]
+    return [(_element_filename(label_element), label_element["choice"])
+            for label_element in iter_label_studio_annotations(filepath)]
+
+
+def _merge_annotation_files(filepaths: Sequence[str], conflict: str) -> Tuple[Dict[str, str], int]:
+    """Builds the filename to label index of several exports, see load_label_index."""
+    index: Dict[str, str] = {}
+    conflicts = []
+    for filepath in filepaths:
+        for filename, label in read_label_studio_annotation_file(filepath):
+            previous = index.get(filename)
+            if previous is not None and previous != label:
+                conflicts.append(f"{filename}: {previous!r} -> {label!r} in {os.path.basename(filepath)}")
+                if conflict == "first":
+                    continue
+            index[filename] = label
+    if conflicts and conflict == "error":
+        raise ValueError(f"{len(conflicts)} conflicting labels:\n" + "\n".join(conflicts[:10]))
+    return index, len(conflicts)
+
+
+def load_label_index(
+    filepaths: Sequence[str],
+    image_dir: Optional[str] = None,
+    conflict: str = "last",
+    cache_dir: Optional[str] = None
+    ) -> Dict[str, str]:
+    """
+    Builds a filename to label index from one or more LabelStudio exports.
+
+    Args:
+        filepaths (Sequence[str]): The exports in order, e.g. annotation-0.json,
+        annotation-1.json.
+        image_dir (str): If given, annotations of images missing from this directory
+        are dropped. The directory is listed once.
+        conflict (str): How to resolve an image labeled differently by several
+        exports: "last" keeps the label of the latest export, "first" the earliest
+        and "error" raises a ValueError.
+        cache_dir (str): If given, the merged index is cached there and reused while
+        the exports keep their modification times and sizes.
+    Returns:
+        Dict[str, str]: The label of every image filename, in order of first annotation.
+    """
+    if conflict not in CONFLICT_POLICIES:
+        raise ValueError(f"Unknown conflict policy {conflict!r}, expected one of {CONFLICT_POLICIES}")
+    filepaths = [os.path.abspath(filepath) for filepath in filepaths]
+    index = None
+    cache_path = None
+    if cache_dir is not None:
+        stats = [os.stat(filepath) for filepath in filepaths]
+        stamps = [[filepath, stat.st_mtime_ns, stat.st_size] for filepath, stat in zip(filepaths, stats)]
+        cache_key = hashlib.blake2b(json.dumps([filepaths, conflict]).encode(), digest_size=8).hexdigest()
+        cache_path = os.path.join(cache_dir, f".label_index-{cache_key}.json")
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                cached = json.load(f)
+            if cached["stamps"] == stamps:
+                index = cached["index"]
+
+    if index is None:
+        index, num_conflicts = _merge_annotation_files(filepaths, conflict)
+        print(f"Read {len(index)} labels from {len(filepaths)} annotation files, "
+              f"resolved {num_conflicts} conflicts keeping the {conflict} label")
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, "w") as f:
+                json.dump({"stamps": stamps, "index": index}, f)
+
+    if image_dir is not None:
+        with os.scandir(image_dir) as entries:
+            available = {entry.name for entry in entries}
+        missing = [filename for filename in index if filename not in available]
+        if missing:
+            print(f"Dropping {len(missing)} annotations of images missing from {image_dir}, e.g. {missing[:5]}")
+            index = {filename: label for filename, label in index.items() if filename in available}
+    return index
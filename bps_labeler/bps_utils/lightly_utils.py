@@ -1,28 +1,31 @@
 """ Lightly utilities for interacting with the Lightly API.
 @author Nadia Ahmed
 """
+# lightly and the client types are imported on first use, annotations stay strings
+from __future__ import annotations
 
-import pyprojroot
 import os
-import requests
+from typing import TYPE_CHECKING, Callable, Optional
 from dotenv import load_dotenv
-from lightly.api import ApiWorkflowClient
-from lightly.openapi_generated.swagger_client import (
-    DatasetType,
-    DatasourcePurpose
-)
+from bps_labeler.bps_utils.download_utils import create_session, download_file
+from bps_labeler.bps_utils.project_root import root
+from bps_labeler.bps_utils.worker_monitor import RunResult, run_worker_and_wait
+
+if TYPE_CHECKING:
+    from lightly.api import ApiWorkflowClient
 
 def load_environment_variables():
     """
     Loads environment variables from the `.env` file.
     """
-    root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
     load_dotenv(os.path.join(root, ".env"))
 
 def configure_lightly_client():
     """
     Configures the Lightly client to connect to the API
     """
+    from lightly.api import ApiWorkflowClient
+
     token = os.environ.get("MY_LIGHTLY_TOKEN")
     client = ApiWorkflowClient(token=token)
     return client
@@ -31,6 +34,8 @@ def create_lightly_dataset(client: ApiWorkflowClient, datasetname: str) -> None:
     """
     Creates a Lightly dataset if it does not exist yet.
     """
+    from lightly.openapi_generated.swagger_client import DatasetType
+
     dataset_name = datasetname
     dataset_type = DatasetType.IMAGES
     client.create_dataset(dataset_name=dataset_name, dataset_type=dataset_type)
@@ -48,6 +53,8 @@ def configure_input_datasource(client: ApiWorkflowClient) -> None:
     read raw input data from. Datasource must be configured with appropriate
     IAM delegated access.
     """
+    from lightly.openapi_generated.swagger_client import DatasourcePurpose
+
     resource_path = os.environ.get("S3_RESOURCE_PATH")
     region = os.environ.get("S3_REGION")
     role_arn = os.environ.get("S3_ROLE_ARN")
@@ -67,6 +74,8 @@ def configure_lightly_datasource(client: ApiWorkflowClient):
     for Lightly to read and write from. Datasource must be configured with appropriate
     IAM delegated access.
     """
+    from lightly.openapi_generated.swagger_client import DatasourcePurpose
+
     resource_path = os.environ.get("S3_LIGHTLY_PATH")
     region = os.environ.get("S3_REGION")
     role_arn = os.environ.get("S3_ROLE_ARN")
@@ -80,7 +89,8 @@ def configure_lightly_datasource(client: ApiWorkflowClient):
         purpose=purpose
     )
 
-def run_lightly_worker(client: ApiWorkflowClient, num_samples: int) -> None:
+def run_lightly_worker(client: ApiWorkflowClient, num_samples: int, log_path: Optional[str] = None,
+                       on_complete: Optional[Callable] = None, poll_interval_sec: float = 30.0) -> RunResult:
     """
     Runs a Lightly worker to select samples from the Lightly datasource to
     ensure diverse sampling of embeddings and balanced sampling of the metadata
@@ -89,6 +99,11 @@ def run_lightly_worker(client: ApiWorkflowClient, num_samples: int) -> None:
     Args:
         client (ApiWorkflowClient): The Lightly client to connect to the API.
         num_samples (int): The number of samples to select.
+        log_path (str): The JSON-lines file to log worker state timings to.
+        on_complete (Callable): Called with the RunResult once the run ended.
+        poll_interval_sec (float): The time between polls of the run state.
+    Returns:
+        RunResult: The final state and the time spent in every worker state.
     """
     selection_config = {
         "n_samples": num_samples,
@@ -116,24 +131,32 @@ def run_lightly_worker(client: ApiWorkflowClient, num_samples: int) -> None:
             },
         ]
     }
-    scheduled_run_id = client.schedule_compute_worker_run(selection_config=selection_config)
-    for run_info in client.compute_worker_run_info_generator(scheduled_run_id=scheduled_run_id):
-        print(f"Lightly Worker run is now in state='{run_info.state}' with message='{run_info.message}'")
-
-    if run_info.ended_successfully():
-        print("SUCCESS")
-    else:
-        print("FAILURE")
+    result = run_worker_and_wait(client, "first-selection", poll_interval_sec, log_path, on_complete,
+                                 selection_config=selection_config)
+    print("SUCCESS" if result.succeeded else "FAILURE")
+    return result
 
-def run_lightly_worker_active_learning(client: ApiWorkflowClient, num_samples: int) -> None:
+def run_lightly_worker_active_learning(client: ApiWorkflowClient, num_samples: int, log_path: Optional[str] = None,
+                                       on_complete: Optional[Callable] = None,
+                                       poll_interval_sec: float = 30.0) -> RunResult:
     """
     Runs a Lightly worker to select samples using active learning.
 
     Args:
         client (ApiWorkflowClient): The Lightly client to connect to the API.
         num_samples (int): The number of samples to select.
-    """
-    scheduled_run_id = client.schedule_compute_worker_run(
+        log_path (str): The JSON-lines file to log worker state timings to.
+        on_complete (Callable): Called with the RunResult once the run ended.
+        poll_interval_sec (float): The time between polls of the run state.
+    Returns:
+        RunResult: The final state and the time spent in every worker state.
+    """
+    result = run_worker_and_wait(
+        client,
+        "active-learning-selection",
+        poll_interval_sec,
+        log_path,
+        on_complete,
         worker_config={
             "datasource": {
                 "process_all": True,
@@ -154,17 +177,8 @@ def run_lightly_worker_active_learning(client: ApiWorkflowClient, num_samples: i
             ],
         },
     )
-    for run_info in client.compute_worker_run_info_generator(
-        scheduled_run_id=scheduled_run_id
-    ):
-        print(
-            f"Lightly Worker run is now in state='{run_info.state}' with message='{run_info.message}'"
-        )
-
-    if run_info.ended_successfully():
-        print("SUCCESS")
-    else:
-        print("FAILURE")
+    print("SUCCESS" if result.succeeded else "FAILURE")
+    return result
 
 def create_lightly_client(token:str, dataset_name:str) -> ApiWorkflowClient:
     """
@@ -177,6 +191,8 @@ def create_lightly_client(token:str, dataset_name:str) -> ApiWorkflowClient:
     Returns:
         ApiWorkflowClient: The Lightly client to connect to the API.
     """
+    from lightly.api import ApiWorkflowClient
+
     # Create the Lightly client to connect to the API.
     client = ApiWorkflowClient(token=token)
     client.set_dataset_id_by_name(dataset_name=dataset_name)
@@ -206,7 +222,8 @@ def export_filenames_and_urls(client: ApiWorkflowClient, tag_id: str) -> None:
 
 def download_files(read_url: str, filename: str, output_path: str) -> None:
     """
-    Downloads the files from the Lightly API.
+    Downloads a single file from the Lightly API, or copies it for local file:// URLs.
+    Use download_utils.download_samples to download many files concurrently.
 
     Args:
         read_url (str): The URL to read the file from.
@@ -216,7 +233,4 @@ def download_files(read_url: str, filename: str, output_path: str) -> None:
     Returns:
         None
     """
-    response = requests.get(read_url, stream=True)
-    with open(os.path.join(output_path, filename), 'wb') as f:
-        for data in response.iter_content():
-            f.write(data)
\ No newline at end of file
+    download_file(create_session(max_connections=1), read_url, os.path.join(output_path, filename))
@@ -0,0 +1,187 @@
+""" Hash-addressed store of model predictions over the full training set.
+
+Every (model checkpoint, dataset manifest) pair gets one entry directory named after
+the content hashes of the checkpoint file and of full_train.json. An entry holds one
+.npy file per column, so it can be memory-mapped:
+
+    <store_dir>/<checkpoint hash>-<manifest hash>/
+        filenames.npy   fixed width unicode, (N,)
+        probs.npy       float32, (N, num_classes)
+        argmax.npy      int64, (N,)
+        entropy.npy     float64, (N,) normalized like the Lightly uncertainty_entropy
+        meta.json       checkpoint path, hashes, number of samples and creation time
+
+`latest.json` in the store points at the most recently saved entry. Lightly
+prediction files are exported lazily from an entry by export_lightly_predictions,
+which only rewrites files whose predictions changed since the previous export.
+"""
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional
+
+import numpy as np
+import numpy.typing as npt
+from bps_labeler.bps_utils.project_root import root
+from bps_labeler.bps_utils.active_learning_utils import compute_uncertainty_scores
+from bps_labeler.bps_utils.data_utils import dump_lightly_prediction_batches
+
+LATEST_FNAME = "latest.json"
+EXPORT_STATE_FNAME = ".prediction_store_export.json"
+COLUMNS = ("filenames", "probs", "argmax", "entropy")
+
+
+@dataclass(frozen=True)
+class PredictionTable:
+    """ The columns of a prediction store entry, memory-mapped when loaded with mmap=True."""
+    entry_dir: str
+    filenames: npt.NDArray
+    probs: npt.NDArray
+    argmax: npt.NDArray
+    entropy: npt.NDArray
+    meta: Dict
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """Hashes the content of a file, e.g. a checkpoint or full_train.json."""
+    digest = hashlib.blake2b(digest_size=8)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_predictions(
+    store_dir: str,
+    filenames: list,
+    probabilities: npt.NDArray,
+    checkpoint_path: str,
+    manifest_path: str
+    ) -> str:
+    """
+    Saves predictions as a new store entry and marks it as the latest.
+
+    The entry is written to a temporary directory and renamed into place, so readers
+    never see a partially written entry. Saving the same checkpoint and manifest again
+    replaces the entry.
+
+    Args:
+        store_dir (str): The prediction store directory.
+        filenames (list): The image filenames, one per row of probabilities.
+        probabilities (npt.NDArray): The class probabilities of shape (N, num_classes).
+        checkpoint_path (str): The saved model weights the predictions were made with.
+        manifest_path (str): The dataset manifest predicted on, e.g. full_train.json.
+    Returns:
+        str: The entry directory.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    checkpoint_hash = file_hash(checkpoint_path)
+    manifest_hash = file_hash(manifest_path)
+    entry_dir = os.path.join(store_dir, f"{checkpoint_hash}-{manifest_hash}")
+    tmp_dir = f"{entry_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir)
+
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    columns = {
+        "filenames": np.asarray(filenames, dtype=np.str_),
+        "probs": probabilities,
+        "argmax": np.argmax(probabilities, axis=1).astype(np.int64),
+        "entropy": compute_uncertainty_scores(probabilities)["uncertainty_entropy"],
+    }
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), values)
+    meta = {
+        "checkpoint_path": os.path.abspath(checkpoint_path),
+        "checkpoint_hash": checkpoint_hash,
+        "manifest_path": os.path.abspath(manifest_path),
+        "manifest_hash": manifest_hash,
+        "num_samples": len(probabilities),
+        "created": datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+    if os.path.exists(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+    with open(os.path.join(store_dir, LATEST_FNAME), "w") as f:
+        json.dump({"entry": os.path.basename(entry_dir)}, f)
+    print(f"Saved {len(probabilities)} predictions to {entry_dir}")
+    return entry_dir
+
+
+def load_predictions(entry_dir: str, mmap: bool = True) -> PredictionTable:
+    """Loads a store entry, memory-mapping the columns unless mmap is False."""
+    mmap_mode = "r" if mmap else None
+    columns = {name: np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode=mmap_mode) for name in COLUMNS}
+    with open(os.path.join(entry_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    return PredictionTable(entry_dir=entry_dir, meta=meta, **columns)
+
+
+def latest_entry_dir(store_dir: str) -> str:
+    """Returns the entry directory most recently saved to the store."""
+    with open(os.path.join(store_dir, LATEST_FNAME), "r") as f:
+        return os.path.join(store_dir, json.load(f)["entry"])
+
+
+def _changed_rows(table: PredictionTable, previous: Optional[PredictionTable]) -> npt.NDArray:
+    """Returns the row indices of table whose filename is new or whose probabilities differ."""
+    if previous is None:
+        return np.arange(len(table.filenames))
+    previous_rows = {filename: idx for idx, filename in enumerate(previous.filenames.tolist())}
+    rows = np.asarray([previous_rows.get(filename, -1) for filename in table.filenames.tolist()], dtype=np.int64)
+    changed = rows < 0
+    known = ~changed
+    if previous.probs.shape[1:] != table.probs.shape[1:]:
+        changed[:] = True
+    elif known.any():
+        changed[known] = np.any(previous.probs[rows[known]] != table.probs[known], axis=1)
+    return np.flatnonzero(changed)
+
+
+def export_lightly_predictions(
+    entry_dir: str,
+    predictions_dir: str,
+    batch_size: int = 4096,
+    max_workers: int = 8
+    ) -> int:
+    """
+    Writes the Lightly prediction files of a store entry, skipping unchanged files.
+
+    The entry exported last to predictions_dir is recorded there. Files are only
+    written for filenames new to this entry or whose probabilities differ from that
+    entry, so unchanged files keep their contents and modification times and are not
+    re-uploaded by a diff-based sync.
+
+    Args:
+        entry_dir (str): The store entry, see save_predictions.
+        predictions_dir (str): The Lightly predictions directory, e.g. BPSTracksConfig.save_pred_dir.
+        batch_size (int): The number of files encoded per batch.
+        max_workers (int): The number of threads writing files.
+    Returns:
+        int: The number of prediction files written.
+    """
+    table = load_predictions(entry_dir)
+    state_path = os.path.join(root, predictions_dir, EXPORT_STATE_FNAME)
+    previous = None
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            previous_entry_dir = json.load(f)["entry_dir"]
+        if os.path.isdir(previous_entry_dir):
+            previous = load_predictions(previous_entry_dir)
+
+    changed = _changed_rows(table, previous)
+    print(f"{len(changed)} of {len(table.filenames)} predictions changed since the last export")
+    batches = (
+        (table.filenames[batch].tolist(), table.probs[batch])
+        for batch in np.array_split(changed, max(1, -(-len(changed) // batch_size)))
+        if len(batch)
+    )
+    num_written = dump_lightly_prediction_batches(batches, predictions_dir, max_workers)
+    with open(state_path, "w") as f:
+        json.dump({"entry_dir": os.path.abspath(entry_dir)}, f)
+    return num_written
@@ -0,0 +1,32 @@
+""" The project root, found once per process.
+
+The root is the closest directory at or above the working directory that contains a
+`.git` directory, the same directory pyprojroot.find_root(pyprojroot.has_dir(".git"))
+returns. Set BPS_LABELER_ROOT to use a directory without searching, e.g. in a
+container without the repository's `.git`.
+"""
+import functools
+import os
+import pathlib
+
+
+@functools.lru_cache(maxsize=None)
+def find_root() -> pathlib.Path:
+    """
+    Finds the project root, searching only on the first call.
+
+    Returns:
+        pathlib.Path: The project root.
+    Raises:
+        RuntimeError: If no directory at or above the working directory contains `.git`.
+    """
+    if os.environ.get("BPS_LABELER_ROOT"):
+        return pathlib.Path(os.environ["BPS_LABELER_ROOT"]).resolve()
+    cwd = pathlib.Path.cwd().resolve()
+    for path in (cwd, *cwd.parents):
+        if (path / ".git").is_dir():
+            return path
+    raise RuntimeError("Project root not found.")
+
+
+root = find_root()
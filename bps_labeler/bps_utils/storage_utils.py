@@ -0,0 +1,115 @@
+""" Storage backends for reading and writing dataset objects.
+The fetch and sync utilities only talk to the StorageBackend interface so they can
+run against AWS S3 or against a local directory standing in for a bucket.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO, Optional
+
+
+@dataclass(frozen=True)
+class ObjectInfo:
+    """ Size and ETag of a stored object."""
+    size: int
+    etag: str
+
+
+def md5_etag(file_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Computes the ETag S3 assigns to an object uploaded in a single part.
+
+    Args:
+        file_path (str): The path to the file in full.
+        chunk_size (int): The number of bytes read at a time.
+    Returns:
+        str: The hex md5 digest of the file.
+    """
+    digest = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StorageBackend:
+    """ Interface of an object store addressed by slash separated keys."""
+
+    def head(self, key: str) -> Optional[ObjectInfo]:
+        """Returns the size and ETag of an object, or None if it does not exist."""
+        raise NotImplementedError
+
+    def download(self, key: str, fileobj: BinaryIO) -> None:
+        """Writes the contents of an object to a binary file object."""
+        raise NotImplementedError
+
+    def upload(self, key: str, file_path: str) -> None:
+        """Stores the contents of a local file as an object, replacing it if it exists."""
+        raise NotImplementedError
+
+
+class LocalDirectoryBackend(StorageBackend):
+    """ Storage backend serving objects from a local directory, e.g. for tests."""
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root_dir, *key.split("/"))
+
+    def head(self, key: str) -> Optional[ObjectInfo]:
+        path = self._path(key)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        return ObjectInfo(size=size, etag=md5_etag(path))
+
+    def download(self, key: str, fileobj: BinaryIO) -> None:
+        with open(self._path(key), "rb") as f:
+            shutil.copyfileobj(f, fileobj, 1 << 20)
+
+    def upload(self, key: str, file_path: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.part{os.getpid()}-{threading.get_ident()}"
+        shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, path)
+
+
+class S3Backend(StorageBackend):
+    """ Storage backend for an AWS S3 bucket.
+
+    A single boto3 client is shared by all threads; its connection pool is sized with
+    `max_pool_connections` so concurrent transfers reuse connections.
+    """
+
+    def __init__(self, bucket_name: str, prefix: str = "", max_pool_connections: int = 32, client=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+        if client is None:
+            import boto3
+            from botocore.config import Config
+            client = boto3.client("s3", config=Config(max_pool_connections=max_pool_connections))
+        self.client = client
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def head(self, key: str) -> Optional[ObjectInfo]:
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.head_object(Bucket=self.bucket_name, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return ObjectInfo(size=response["ContentLength"], etag=response["ETag"].strip('"'))
+
+    def download(self, key: str, fileobj: BinaryIO) -> None:
+        self.client.download_fileobj(self.bucket_name, self._key(key), fileobj)
+
+    def upload(self, key: str, file_path: str) -> None:
+        self.client.upload_file(file_path, self.bucket_name, self._key(key))
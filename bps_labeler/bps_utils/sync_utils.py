@@ -0,0 +1,192 @@
+""" Incremental, diff-based upload of local files to a StorageBackend.
+A local JSON manifest records the size, modification time and md5 of every file as
+last uploaded to a destination. Files whose content is unchanged since then are
+skipped; the md5 is only recomputed for files whose size or modification time
+changed. New or changed files are uploaded concurrently with retries.
+"""
+import fnmatch
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Sequence, Tuple
+
+import tqdm as tqdm
+
+from bps_labeler.bps_utils.storage_utils import StorageBackend, md5_etag
+
+# Destination layout of the Lightly datasource bucket
+DATA_KEY_PREFIX = "data"
+METADATA_KEY_PREFIX = "lightly/.lightly/metadata"
+PREDICTIONS_KEY_PREFIX = "lightly/.lightly/predictions/bps-classification"
+
+
+def list_directory_files(local_dir: str, key_prefix: str, patterns: Sequence[str] = ("*",)) -> List[Tuple[str, str]]:
+    """
+    Lists the files of a directory matching any of the patterns, without subdirectories.
+    Hidden files, such as bookkeeping files written next to the data, are left out.
+
+    Args:
+        local_dir (str): The directory to list.
+        key_prefix (str): The destination key prefix, e.g. "lightly/.lightly/metadata".
+        patterns (Sequence[str]): fnmatch patterns of the files to include, e.g. ("*.json",).
+    Returns:
+        List[Tuple[str, str]]: (local path, destination key) pairs sorted by key.
+    """
+    files = []
+    with os.scandir(local_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            if any(fnmatch.fnmatch(entry.name, pattern) for pattern in patterns):
+                key = f"{key_prefix.strip('/')}/{entry.name}" if key_prefix.strip("/") else entry.name
+                files.append((entry.path, key))
+    return sorted(files, key=lambda item: item[1])
+
+
+def _load_manifest(manifest_path: str) -> Dict[str, List]:
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest_path: str, manifest: Dict[str, List]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def _upload_with_retry(
+    backend: StorageBackend,
+    key: str,
+    local_path: str,
+    max_retries: int,
+    backoff_sec: float
+    ) -> None:
+    """Uploads a file, retrying with exponential backoff and jitter on any error."""
+    for attempt in range(max_retries + 1):
+        try:
+            backend.upload(key, local_path)
+            return
+        except Exception:
+            if attempt == max_retries:
+                raise
+            time.sleep(backoff_sec * 2 ** attempt * (0.5 + random.random()))
+
+
+def sync_files(
+    backend: StorageBackend,
+    files: List[Tuple[str, str]],
+    manifest_path: str,
+    max_workers: int = 16,
+    max_retries: int = 5,
+    backoff_sec: float = 0.5
+    ) -> Dict[str, float]:
+    """
+    Uploads the files that are new or changed since the last sync to the same manifest.
+
+    The manifest is updated with every successful upload, also when other uploads
+    fail, so a failed sync can simply be rerun. Use one manifest per destination.
+
+    Args:
+        backend (StorageBackend): The storage backend to upload to.
+        files (List[Tuple[str, str]]): (local path, destination key) pairs, see
+        list_directory_files.
+        manifest_path (str): The path to the manifest JSON file.
+        max_workers (int): The maximum number of concurrent uploads.
+        max_retries (int): The number of retries per object after the first attempt.
+        backoff_sec (float): The delay before the first retry, doubled every retry.
+    Returns:
+        Dict[str, float]: The number and bytes of uploaded and skipped objects, the
+        number of failed objects and the elapsed seconds.
+    """
+    manifest = _load_manifest(manifest_path)
+    summary = {"uploaded": 0, "uploaded_bytes": 0, "skipped": 0, "skipped_bytes": 0, "failed": 0}
+    start = time.perf_counter()
+
+    pending = {}
+    for local_path, key in files:
+        stat = os.stat(local_path)
+        entry = manifest.get(key)
+        if entry is not None and entry[0] == stat.st_size and entry[1] != stat.st_mtime_ns:
+            # touched but maybe not modified, compare the content
+            if entry[2] == md5_etag(local_path):
+                manifest[key] = [stat.st_size, stat.st_mtime_ns, entry[2]]
+                entry = manifest[key]
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            summary["skipped"] += 1
+            summary["skipped_bytes"] += stat.st_size
+            continue
+        pending[key] = (local_path, stat)
+
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_upload_with_retry, backend, key, local_path, max_retries, backoff_sec): key
+                for key, (local_path, _) in pending.items()
+            }
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc="Uploading objects"):
+                key = futures[future]
+                local_path, stat = pending[key]
+                try:
+                    future.result()
+                except Exception as e:
+                    summary["failed"] += 1
+                    errors.append(f"{key}: {e!r}")
+                    continue
+                manifest[key] = [stat.st_size, stat.st_mtime_ns, md5_etag(local_path)]
+                summary["uploaded"] += 1
+                summary["uploaded_bytes"] += stat.st_size
+    finally:
+        _save_manifest(manifest_path, manifest)
+
+    summary["elapsed_sec"] = time.perf_counter() - start
+    print(f"Uploaded {summary['uploaded']} objects ({summary['uploaded_bytes'] / 1e6:.1f} MB) "
+          f"in {summary['elapsed_sec']:.1f}s, skipped {summary['skipped']} unchanged objects "
+          f"({summary['skipped_bytes'] / 1e6:.1f} MB), {summary['failed']} failed.")
+    if errors:
+        raise RuntimeError(f"{len(errors)} uploads failed, rerun to retry them:\n" + "\n".join(errors[:10]))
+    return summary
+
+
+def sync_training_set(backend: StorageBackend, config, destination_name: str) -> Dict[str, float]:
+    """
+    Uploads train_set/data, train_set/metadata and schema.json of config.data_dir to
+    the Lightly datasource layout.
+
+    Args:
+        backend (StorageBackend): The storage backend of the datasource bucket.
+        config (BPSTracksConfig): The configuration.
+        destination_name (str): Names the manifests in config.sync_manifest_dir, e.g.
+        the bucket name.
+    Returns:
+        Dict[str, float]: The combined sync summary, see sync_files.
+    """
+    local_train_dir = os.path.join(config.data_dir, "train_set")
+    data_summary = sync_files(
+        backend,
+        list_directory_files(os.path.join(local_train_dir, "data"), DATA_KEY_PREFIX, ("*.jpg",)),
+        os.path.join(config.sync_manifest_dir, f"{destination_name}-data.json")
+    )
+    metadata_files = list_directory_files(os.path.join(local_train_dir, "metadata"), METADATA_KEY_PREFIX, ("*.json",))
+    metadata_files.append((os.path.join(config.data_dir, "schema.json"), f"{METADATA_KEY_PREFIX}/schema.json"))
+    metadata_summary = sync_files(
+        backend,
+        metadata_files,
+        os.path.join(config.sync_manifest_dir, f"{destination_name}-metadata.json")
+    )
+    return {key: data_summary[key] + metadata_summary[key] for key in data_summary}
+
+
+def sync_predictions(backend: StorageBackend, config, destination_name: str) -> Dict[str, float]:
+    """Uploads the Lightly prediction files in config.save_pred_dir, see sync_training_set."""
+    return sync_files(
+        backend,
+        list_directory_files(config.save_pred_dir, PREDICTIONS_KEY_PREFIX, ("*.json",)),
+        os.path.join(config.sync_manifest_dir, f"{destination_name}-predictions.json")
+    )
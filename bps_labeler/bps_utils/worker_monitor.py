@@ -0,0 +1,195 @@
+""" Non-blocking tracking of Lightly worker runs.
+Runs are polled with asyncio so several scheduled runs can be awaited concurrently.
+Every state transition is appended to a JSON-lines log together with the time spent
+in the previous state, and callbacks let downstream steps, such as downloading the
+selected samples, start as soon as a run ends.
+
+Only the following methods of the Lightly ApiWorkflowClient are used, so the
+FakeWorkerClient below can stand in for it offline:
+- schedule_compute_worker_run(worker_config=..., selection_config=...) -> str
+- get_compute_worker_run_info(scheduled_run_id=...) -> run info with `state`,
+  `message`, `in_end_state()` and `ended_successfully()`
+"""
+import asyncio
+import inspect
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, Optional, Sequence
+
+
+@dataclass
+class RunResult:
+    """ Outcome and per-state timings of a tracked worker run."""
+    name: str
+    scheduled_run_id: str
+    state: str = ""
+    message: str = ""
+    succeeded: bool = False
+    state_durations_sec: Dict[str, float] = field(default_factory=dict)
+    total_sec: float = 0.0
+
+
+async def _maybe_await(result) -> None:
+    if inspect.isawaitable(result):
+        await result
+
+
+def _append_log(log_path: Optional[str], record: Dict) -> None:
+    if log_path is None:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+    with open(log_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def print_state_change(result: RunResult, run_info) -> None:
+    """The default state change callback, printing the new state."""
+    print(f"Lightly Worker run {result.name} is now in state='{run_info.state}' with message='{run_info.message}'")
+
+
+async def track_run(
+    client,
+    scheduled_run_id: str,
+    name: str = "",
+    poll_interval_sec: float = 30.0,
+    log_path: Optional[str] = None,
+    on_state_change: Optional[Callable] = print_state_change,
+    on_complete: Optional[Callable] = None
+    ) -> RunResult:
+    """
+    Polls a scheduled worker run until it ends, without blocking the event loop.
+
+    Args:
+        client (ApiWorkflowClient): The Lightly client, or a FakeWorkerClient.
+        scheduled_run_id (str): The id returned by schedule_compute_worker_run.
+        name (str): A name for the run in the log, e.g. "first-selection".
+        poll_interval_sec (float): The time between polls.
+        log_path (str): The JSON-lines file to append state transitions to.
+        on_state_change (Callable): Called as on_state_change(result, run_info) on
+        every new state; may be a coroutine function.
+        on_complete (Callable): Called as on_complete(result) once the run ended;
+        may be a coroutine function.
+    Returns:
+        RunResult: The final state and the seconds spent in every state.
+    """
+    result = RunResult(name=name or scheduled_run_id, scheduled_run_id=scheduled_run_id)
+    start = state_start = time.monotonic()
+    while True:
+        run_info = await asyncio.to_thread(client.get_compute_worker_run_info, scheduled_run_id=scheduled_run_id)
+        now = time.monotonic()
+        state = str(run_info.state)
+        if state != result.state:
+            previous_state = result.state
+            if previous_state:
+                result.state_durations_sec[previous_state] = (
+                    result.state_durations_sec.get(previous_state, 0.0) + now - state_start)
+            _append_log(log_path, {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "run": result.name,
+                "scheduled_run_id": scheduled_run_id,
+                "state": state,
+                "message": str(run_info.message),
+                "previous_state": previous_state or None,
+                "previous_state_sec": round(now - state_start, 3) if previous_state else None,
+            })
+            result.state, result.message, state_start = state, str(run_info.message), now
+            if on_state_change is not None:
+                await _maybe_await(on_state_change(result, run_info))
+        if run_info.in_end_state():
+            break
+        await asyncio.sleep(poll_interval_sec)
+
+    result.succeeded = bool(run_info.ended_successfully())
+    result.total_sec = time.monotonic() - start
+    _append_log(log_path, {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "run": result.name,
+        "scheduled_run_id": scheduled_run_id,
+        "state": result.state,
+        "succeeded": result.succeeded,
+        "total_sec": round(result.total_sec, 3),
+        "state_durations_sec": {state: round(sec, 3) for state, sec in result.state_durations_sec.items()},
+    })
+    if on_complete is not None:
+        await _maybe_await(on_complete(result))
+    return result
+
+
+async def schedule_and_track(
+    client,
+    runs: Dict[str, Dict],
+    poll_interval_sec: float = 30.0,
+    log_path: Optional[str] = None,
+    on_state_change: Optional[Callable] = print_state_change,
+    on_complete: Optional[Callable] = None
+    ) -> Dict[str, RunResult]:
+    """
+    Schedules several worker runs and awaits them concurrently.
+
+    Args:
+        client (ApiWorkflowClient): The Lightly client, or a FakeWorkerClient.
+        runs (Dict[str, Dict]): The keyword arguments of schedule_compute_worker_run
+        by run name, e.g. {"first-selection": {"selection_config": {...}}}.
+        poll_interval_sec (float): The time between polls of each run.
+        log_path (str): The JSON-lines file to append state transitions to.
+        on_state_change (Callable): See track_run.
+        on_complete (Callable): See track_run, called for each run as it ends.
+    Returns:
+        Dict[str, RunResult]: The result of every run by name.
+    """
+    scheduled_run_ids = [
+        await asyncio.to_thread(client.schedule_compute_worker_run, **run_kwargs) for run_kwargs in runs.values()
+    ]
+    results = await asyncio.gather(*(
+        track_run(client, scheduled_run_id, name, poll_interval_sec, log_path, on_state_change, on_complete)
+        for name, scheduled_run_id in zip(runs, scheduled_run_ids)
+    ))
+    return dict(zip(runs, results))
+
+
+def run_worker_and_wait(client, name: str, poll_interval_sec: float = 30.0, log_path: Optional[str] = None,
+                        on_complete: Optional[Callable] = None, **run_kwargs) -> RunResult:
+    """Schedules a single worker run and waits for it from synchronous code."""
+    results = asyncio.run(schedule_and_track(client, {name: run_kwargs}, poll_interval_sec, log_path,
+                                             on_complete=on_complete))
+    return results[name]
+
+
+@dataclass
+class FakeRunInfo:
+    """ Stand-in for the Lightly ComputeWorkerRunInfo."""
+    state: str
+    message: str = ""
+
+    def in_end_state(self) -> bool:
+        return self.state in FakeWorkerClient.END_STATES
+
+    def ended_successfully(self) -> bool:
+        return self.state == "COMPLETED"
+
+
+class FakeWorkerClient:
+    """ Offline stand-in for the worker run methods of the Lightly ApiWorkflowClient.
+
+    Every scheduled run steps through `states`, advancing one state per poll.
+    """
+    END_STATES = ("COMPLETED", "FAILED", "CANCELED", "CRASHED")
+
+    def __init__(self, states: Sequence[str] = ("OPEN", "EMBEDDING", "SAMPLING", "COMPLETED")):
+        self.states = list(states)
+        self.scheduled: Dict[str, Dict] = {}
+        self._polls: Dict[str, int] = {}
+
+    def schedule_compute_worker_run(self, **run_kwargs) -> str:
+        scheduled_run_id = f"fake-run-{len(self.scheduled)}"
+        self.scheduled[scheduled_run_id] = run_kwargs
+        self._polls[scheduled_run_id] = 0
+        return scheduled_run_id
+
+    def get_compute_worker_run_info(self, scheduled_run_id: str) -> FakeRunInfo:
+        step = min(self._polls[scheduled_run_id], len(self.states) - 1)
+        self._polls[scheduled_run_id] += 1
+        return FakeRunInfo(state=self.states[step], message=f"step {step}")
@@ -6,56 +6,207 @@ import os
 import pytorch_lightning as pl
 import torch
 from torchvision import transforms
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
 import json
 from datetime import datetime
-from typing import Dict, List
+from typing import Dict, Iterable, List, Union
 from PIL import Image
 import pathlib
-import pyprojroot
-root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
-from bps_labeler.bps_utils.label_studio_utils import read_label_studio_annotation_file
+from bps_labeler.bps_utils.project_root import root
+from bps_labeler.bps_utils.label_studio_utils import load_label_index
+from bps_labeler.dataloader.image_cache import DecodedImageCache
+from bps_labeler.dataloader.instrumentation import InstrumentedDataLoader, SampleTimer
+from bps_labeler.dataloader.shards import iter_shard, labels_hash, read_shard_index
+import io
+import time
 import numpy as np
+from typing import Optional
+
+CLASSES = ["track", "no track"]
+
+def encode_label(sample: Dict, class_to_idx: Dict[str, int]) -> torch.Tensor:
+    """One hot encodes the label of a sample, or returns a dummy label for unlabeled
+    samples since it will be ignored anyway."""
+    # Check if 'label is present, else return a default dummy label since it will
+    # be ignored anyway.
+    if "label" in sample:
+        label = sample["label"]
+        numerical_label = class_to_idx[label]
+
+        # One hot encode the label
+        one_hot_label = np.zeros(len(class_to_idx))
+        one_hot_label[numerical_label] = 1
+        return torch.tensor(one_hot_label, dtype=torch.float32)
+    # placeholder for dummy label
+    return torch.tensor([0, 0], dtype=torch.float32)
 
 class BPSTracksDataset(Dataset):
     """ Dataset class for BPSTracks data from Label Studio for
-    use with PyTorch DataLoader."""
-    def __init__(self,sample_list: List[Dict], transform=None):
+    use with PyTorch DataLoader.
+
+    If a DecodedImageCache is given, images are decoded and resized to the cache's
+    image size once and served from the cache afterwards; `transform` is then not
+    applied and images are converted to tensors as transforms.ToTensor would.
+
+    With `grayscale=True` images are decoded as single channel "L" images, so tensors
+    are 1xHxW instead of 3xHxW.
+
+    With `return_index=True` samples are returned as (image, label, index) so that
+    inference outputs can be placed by dataset position without passing filename
+    strings through the collate function; see `filenames`.
+
+    If a SampleTimer is given, the time spent loading and transforming every sample
+    is added to it, see model/profiling.py."""
+    def __init__(self,sample_list: List[Dict], transform=None, cache: Optional[DecodedImageCache] = None,
+                 grayscale: bool = False, return_index: bool = False, sample_timer: Optional[SampleTimer] = None):
         self.sample_list = sample_list
+        self.sample_timer = sample_timer
+        self.return_index = return_index
         self.transform = transform
-        self.classes = ["track", "no track"]
+        self.cache = cache
+        self.image_mode = "L" if grayscale else "RGB"
+        self.classes = CLASSES
         self.class_to_idx = {cls: idx for idx, cls in enumerate(self.classes)}
 
     def __len__(self):
         return len(self.sample_list)
 
+    @property
+    def filenames(self) -> List[str]:
+        """The image filename of every sample, by dataset index."""
+        if not hasattr(self, "_filenames"):
+            self._filenames = [pathlib.Path(sample["path"]).name for sample in self.sample_list]
+        return self._filenames
+
+    def _decode_resized(self, path: str) -> np.ndarray:
+        """Decodes and resizes an image exactly like the uncached transform."""
+        size = self.cache.image_size
+        image = Image.open(path).convert(self.image_mode).resize((size, size), Image.LANCZOS)
+        return np.asarray(image).reshape(size, size, -1)
+
     def __getitem__(self, idx):
+        start = time.perf_counter()
         sample = self.sample_list[idx]
-        image = Image.open(sample["path"]).convert("RGB")
-        if self.transform:
-            image = self.transform(image)
-
-        # Check if 'label is present, else return a default dummy label since it will
-        # be ignored anyway.
-        if "label" in sample:
-            label = sample["label"]
-            numerical_label = self.class_to_idx[label]
-
-            # One hot encode the label
-            one_hot_label = np.zeros(len(self.classes))
-            one_hot_label[numerical_label] = 1
-            one_hot_label = torch.tensor(one_hot_label, dtype=torch.float32)
+        if self.cache is not None:
+            image = transforms.functional.to_tensor(self.cache.get(idx, sample["path"], self._decode_resized))
         else:
-            label = "dummy"
-            # placeholder for dummy label
-            one_hot_label = torch.tensor([0, 0], dtype=torch.float32)
-        
+            image = Image.open(sample["path"]).convert(self.image_mode)
+            if self.transform:
+                image = self.transform(image)
+
+        one_hot_label = encode_label(sample, self.class_to_idx)
+        if self.sample_timer is not None:
+            self.sample_timer.add(time.perf_counter() - start)
+        if self.return_index:
+            return image, one_hot_label, idx
         filename = pathlib.Path(sample["path"]).name
         return image, one_hot_label, filename
 
+class BPSTracksShardDataset(IterableDataset):
+    """ Streams BPSTracks samples from tar shards written by shards.write_shards.
+
+    Shards are read sequentially. With `shuffle=True` the shard order is permuted
+    every epoch and samples pass through a shuffle buffer inside each worker. The
+    permutation is seeded with the DataLoader's per-epoch base seed, which is the same
+    for all workers of an epoch, so the workers split the shards without overlap and
+    the order is reproducible under pl.seed_everything.
+    """
+    def __init__(self, shard_dir: str, transform=None, grayscale: bool = False, shuffle: bool = False,
+                 shuffle_buffer_size: int = 1000):
+        self.shard_dir = shard_dir
+        self.index = read_shard_index(shard_dir)
+        self.transform = transform
+        self.image_mode = "L" if grayscale else "RGB"
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.classes = CLASSES
+        self.class_to_idx = {cls: idx for idx, cls in enumerate(self.classes)}
+
+    def __len__(self):
+        return self.index["num_samples"]
+
+    def _samples(self, shard_names: List[str]):
+        for shard_name in shard_names:
+            for image_bytes, record in iter_shard(os.path.join(self.shard_dir, shard_name)):
+                image = Image.open(io.BytesIO(image_bytes)).convert(self.image_mode)
+                if self.transform:
+                    image = self.transform(image)
+                yield image, encode_label(record, self.class_to_idx), record["filename"]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            epoch_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            epoch_seed = worker_info.seed - worker_info.id
+
+        shard_names = [shard["name"] for shard in self.index["shards"]]
+        rng = np.random.default_rng(epoch_seed % 2**63)
+        if self.shuffle:
+            shard_names = [shard_names[idx] for idx in rng.permutation(len(shard_names))]
+        samples = self._samples(shard_names[worker_id::num_workers])
+        if not self.shuffle:
+            yield from samples
+            return
+
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(sample)
+                continue
+            idx = int(rng.integers(len(buffer)))
+            buffer[idx], sample = sample, buffer[idx]
+            yield sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+class ReplaySampler(Sampler):
+    """ Samples every new sample and a random subset of the old ones each epoch.
+
+    Used to warm-start a round from the previous round's checkpoint, see
+    model/checkpoint_registry.py: the new samples are those labeled or relabeled since
+    the checkpoint, the old ones are replayed so the model does not forget them, while
+    an epoch only costs len(new_indices) * (1 + replay_ratio) samples. The replayed
+    subset and the order change every epoch.
+
+    Args:
+        new_indices (List[int]): Dataset indices of the new samples.
+        old_indices (List[int]): Dataset indices of the samples already trained on.
+        replay_ratio (Optional[float]): Old samples replayed per new sample every epoch,
+        None to replay all of them.
+        seed (int): Seeds the replayed subsets and the order.
+    """
+    def __init__(self, new_indices: List[int], old_indices: List[int], replay_ratio: Optional[float] = 1.0,
+                 seed: int = 42):
+        self.new_indices = np.asarray(new_indices, dtype=np.int64)
+        self.old_indices = np.asarray(old_indices, dtype=np.int64)
+        if replay_ratio is None:
+            self.num_replayed = len(self.old_indices)
+        else:
+            self.num_replayed = min(int(round(replay_ratio * len(self.new_indices))), len(self.old_indices))
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.new_indices) + self.num_replayed
+
+    def __iter__(self):
+        rng = np.random.default_rng((self.seed, self.epoch))
+        self.epoch += 1
+        replayed = rng.choice(self.old_indices, size=self.num_replayed, replace=False)
+        indices = np.concatenate([self.new_indices, replayed])
+        rng.shuffle(indices)
+        return iter(indices.tolist())
+
 class BPSTracksDataModule(pl.LightningDataModule):
     """ PyTorch Lightning DataModule class for BPSTracksDataset."""
-    def __init__(self, annotation_fpath: str, full_train_fpath: str, batch_size: int, train_path:str, image_size: int, num_workers: int):
+    def __init__(self, annotation_fpath: Union[str, List[str]], full_train_fpath: str, batch_size: int, train_path:str, image_size: int, num_workers: int,
+                 cache_dir: Optional[str] = None, cache_max_bytes: Optional[int] = None, grayscale: bool = False,
+                 train_shard_dir: Optional[str] = None, active_learn_shard_dir: Optional[str] = None,
+                 inference_batch_size: Optional[int] = None, prefetch_factor: int = 4,
+                 annotation_conflict: str = "last", profile: bool = False):
         super().__init__()
         self.annotation_filepath = annotation_fpath
         self.full_train_json_path = full_train_fpath
@@ -68,37 +219,154 @@ class BPSTracksDataModule(pl.LightningDataModule):
             transforms.ToTensor(),
         ])
         self.num_workers = num_workers
+        # opt-in decoded image cache, one subdirectory per stage
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        # keep the single channel microscopy images single channel through loading
+        self.grayscale = grayscale
+        # optional packed shards replacing the per-image reads, see shards.write_shards
+        self.train_shard_dir = train_shard_dir
+        self.active_learn_shard_dir = active_learn_shard_dir
+        # inference only settings for the active learning pass over the full training set
+        self.inference_batch_size = inference_batch_size or batch_size
+        self.prefetch_factor = prefetch_factor
+        # 'last', 'first' or 'error' for images labeled differently by several exports
+        self.annotation_conflict = annotation_conflict
+        # opt-in decode timings and queue depths read by model/profiling.py
+        self.sample_timer = SampleTimer(num_workers) if profile else None
+        self.loader_class = InstrumentedDataLoader if profile else DataLoader
+        self.loaders = {}
+        # set by configure_replay to warm-start from a previous round
+        self.replay = None
+        self.train_sampler = None
+
+    def _build_cache(self, stage: str, num_samples: int) -> Optional[DecodedImageCache]:
+        if self.cache_dir is None:
+            return None
+        return DecodedImageCache(os.path.join(self.cache_dir, stage), num_samples, self.image_size,
+                                 channels=1 if self.grayscale else 3, max_bytes=self.cache_max_bytes)
 
     def prepare_data(self):
         """Collects labels and filenames from LabelStudio output files.
 
+        `annotation_fpath` may be a list of exports, e.g. annotation-0.json and
+        annotation-1.json, which are merged with `annotation_conflict` deciding between
+        conflicting labels. Annotations of images missing from `train_path` are dropped.
+
         Images still stays in directory `train_set`. `train.json` only contains paths to
-        samples to be used for training. For instance,
+        samples to be used for training. It is saved next to `full_train.json`. For instance,
         [{"path": "/path/image1.png", "label": "cloudy"}]
 
         `train.json` will be picked up by the scripts for model training to load the
         actual images.
         """
-        for filename, label in read_label_studio_annotation_file(self.annotation_filepath):
-            self.sample_list.append({"path": os.path.join(self.train_path, filename), "label": label})
+        annotation_fpaths = ([self.annotation_filepath] if isinstance(self.annotation_filepath, str)
+                             else list(self.annotation_filepath))
+        # one pass over the exports and the image directory, cached while the exports are unchanged
+        label_index = load_label_index(annotation_fpaths, image_dir=self.train_path,
+                                       conflict=self.annotation_conflict,
+                                       cache_dir=os.path.dirname(os.path.abspath(annotation_fpaths[-1])))
+        # rebuilt rather than extended so calling prepare_data again does not duplicate samples
+        self.sample_list = [{"path": os.path.join(self.train_path, filename), "label": label}
+                            for filename, label in label_index.items()]
         now = datetime.now().strftime("%Y%m%d%H")
+        save_dir = os.path.dirname(os.path.abspath(self.full_train_json_path))
         fname = f"{now}_train.json"
-        print(f"Saving {fname} to {self.train_path}.")
+        print(f"Saving {fname} to {save_dir}.")
 
-        with open(fname, "w") as f:
+        with open(os.path.join(save_dir, fname), "w") as f:
             json.dump(self.sample_list, f)
-            print(f"{fname} is saved successfully to {self.train_path}.")
+            print(f"{fname} is saved successfully to {save_dir}.")
         
+    def configure_replay(self, new_filenames: Iterable[str], replay_ratio: Optional[float] = 1.0, seed: int = 42):
+        """
+        Trains on the new samples plus a replayed subset of the old ones each epoch, see
+        ReplaySampler. Call after prepare_data and before setup("fit").
+
+        Args:
+            new_filenames (Iterable[str]): The filenames of the samples labeled or
+            relabeled since the checkpoint training starts from.
+            replay_ratio (Optional[float]): Old samples replayed per new sample, None to
+            replay all of them.
+            seed (int): Seeds the replayed subsets and the order.
+        """
+        self.replay = (set(new_filenames), replay_ratio, seed)
+
+    def _build_train_sampler(self) -> Optional[ReplaySampler]:
+        if self.replay is None:
+            return None
+        new_filenames, replay_ratio, seed = self.replay
+        new_indices, old_indices = [], []
+        for idx, sample in enumerate(self.sample_list):
+            (new_indices if pathlib.Path(sample["path"]).name in new_filenames else old_indices).append(idx)
+        if not new_indices:
+            # nothing was labeled since the checkpoint, fine-tune on every sample
+            print("No samples labeled since the checkpoint, training on all of them.")
+            return None
+        return ReplaySampler(new_indices, old_indices, replay_ratio, seed)
+
     def setup(self, stage=None):
-        """ Instantiates the dataset based on the stage: training or active."""
-        if stage == "fit" or stage is None:
-            self.train_dataset = BPSTracksDataset(self.sample_list, self.transform)
+        """ Instantiates the dataset based on the stage: training or active.
+
+        Raises:
+            ValueError: If training from train_shard_dir and the labels packed there
+            differ from the sample_list built by prepare_data.
+        """
+        if (stage == "fit" or stage is None) and self.train_shard_dir is not None:
+            # the shards carry their own labels, which must be those of the current exports
+            packed_hash = read_shard_index(self.train_shard_dir).get("labels_hash")
+            if packed_hash != labels_hash(self.sample_list):
+                raise ValueError(f"The labels packed in {self.train_shard_dir} differ from those of "
+                                 f"{self.annotation_filepath}; repack the latest train.json with "
+                                 f"scripts/a_data_setup/pack_shards.py")
+            # shards are streamed in shard order, replay sampling does not apply
+            self.train_dataset = BPSTracksShardDataset(self.train_shard_dir, self.transform, self.grayscale, shuffle=True)
+        elif stage == "fit" or stage is None:
+            self.train_dataset = BPSTracksDataset(self.sample_list, self.transform,
+                                                  self._build_cache("fit", len(self.sample_list)), self.grayscale,
+                                                  sample_timer=self.sample_timer)
+            self.train_sampler = self._build_train_sampler()
+        elif stage == "active_learn" and self.active_learn_shard_dir is not None:
+            self.active_learn_dataset = BPSTracksShardDataset(self.active_learn_shard_dir, self.transform, self.grayscale)
         elif stage == "active_learn":
             self.full_train_list = json.load(open(self.full_train_json_path))
-            self.active_learn_dataset = BPSTracksDataset(self.full_train_list, self.transform)
+            self.active_learn_dataset = BPSTracksDataset(self.full_train_list, self.transform,
+                                                         self._build_cache("active_learn", len(self.full_train_list)),
+                                                         self.grayscale, return_index=True,
+                                                         sample_timer=self.sample_timer)
 
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.batch_size, num_workers=self.num_workers, shuffle=True)
+        # shard datasets and the replay sampler shuffle themselves
+        shuffle = not isinstance(self.train_dataset, IterableDataset) and self.train_sampler is None
+        self.loaders["train"] = self.loader_class(self.train_dataset, batch_size=self.batch_size,
+                                                  num_workers=self.num_workers, shuffle=shuffle,
+                                                  sampler=self.train_sampler)
+        return self.loaders["train"]
     
+    def calibration_dataloader(self, num_images: int = 256, seed: int = 42) -> DataLoader:
+        """DataLoader over a random subset of full_train.json, e.g. to calibrate a
+        quantized model."""
+        full_train_list = json.load(open(self.full_train_json_path))
+        rng = np.random.default_rng(seed)
+        subset = [full_train_list[idx] for idx in
+                  rng.choice(len(full_train_list), size=min(num_images, len(full_train_list)), replace=False)]
+        dataset = BPSTracksDataset(subset, self.transform, grayscale=self.grayscale, return_index=True)
+        return DataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers, shuffle=False)
+
+    def inference_dataloader(self, sample_list: List[Dict]) -> DataLoader:
+        """Uncached, unshuffled DataLoader over any samples returning dataset indices,
+        e.g. for feature_cache.extract_cached_features."""
+        dataset = BPSTracksDataset(sample_list, self.transform, grayscale=self.grayscale, return_index=True)
+        return DataLoader(dataset, batch_size=self.inference_batch_size, num_workers=self.num_workers,
+                          shuffle=False, pin_memory=torch.cuda.is_available())
+
     def active_learn_dataloader(self):
-        return DataLoader(self.active_learn_dataset, batch_size=self.batch_size, num_workers=self.num_workers, shuffle=True)
+        """DataLoader for the inference pass over the full training set: no shuffling,
+        a larger batch size, and workers kept alive with deeper prefetching."""
+        worker_kwargs = {}
+        if self.num_workers > 0:
+            worker_kwargs = {"persistent_workers": True, "prefetch_factor": self.prefetch_factor}
+        self.loaders["predict"] = self.loader_class(self.active_learn_dataset, batch_size=self.inference_batch_size,
+                                                    num_workers=self.num_workers, shuffle=False,
+                                                    pin_memory=torch.cuda.is_available(), **worker_kwargs)
+        return self.loaders["predict"]
@@ -0,0 +1,157 @@
+""" Memory-mapped cache of decoded and resized images for BPSTracksDataset."""
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+from typing import Callable, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+EMPTY_SLOT = 0
+# bumped when the cache files change, so caches of older layouts are recreated
+CACHE_VERSION = 2
+
+
+class DecodedImageCache:
+    """ Memory-mapped cache of preprocessed uint8 images, filled on first access.
+
+    The pixels live in a np.memmap on disk, so DataLoader workers share them through
+    the page cache without copying them between processes. Each slot records a hash
+    of the image path, mtime and image size, so edited or replaced images are
+    re-decoded. When the cache holds fewer slots than there are samples, the least
+    recently used slot is evicted. Slot allocation is guarded by a file lock, reads
+    are lock free. Slots are handed out from a shared counter until the cache is full
+    and the sample of an evicted slot is found through a reverse index, so a miss costs
+    O(1) until the cache is full.
+
+    One cache directory belongs to one sample list, since slots are looked up by
+    dataset index.
+    """
+
+    def __init__(self, cache_dir: str, num_samples: int, image_size: int, channels: int = 3,
+                 max_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.num_samples = num_samples
+        self.image_size = image_size
+        self.channels = channels
+        self.slot_shape = (image_size, image_size, channels)
+        slot_bytes = int(np.prod(self.slot_shape))
+        capacity = num_samples if max_bytes is None else min(num_samples, max_bytes // slot_bytes)
+        self.capacity = max(int(capacity), 1)
+        self._pid = None
+        self._create()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def _create(self) -> None:
+        """Creates the cache files, discarding a cache with a different layout."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        info = {
+            "version": CACHE_VERSION,
+            "num_samples": self.num_samples,
+            "image_size": self.image_size,
+            "channels": self.channels,
+            "capacity": self.capacity,
+        }
+        info_path = self._path("cache_info.json")
+        if os.path.exists(info_path):
+            with open(info_path, "r") as f:
+                if json.load(f) == info:
+                    return
+        arrays = {
+            "pixels.u8": (np.uint8, (self.capacity,) + self.slot_shape, 0),
+            "slot_keys.u64": (np.uint64, (self.capacity,), EMPTY_SLOT),
+            "slot_last_used.i64": (np.int64, (self.capacity,), 0),
+            "slot_of_index.i64": (np.int64, (self.num_samples,), -1),
+            "index_of_slot.i64": (np.int64, (self.capacity,), -1),
+            "slots_used.i64": (np.int64, (1,), 0),
+        }
+        for name, (dtype, shape, fill) in arrays.items():
+            array = np.memmap(self._path(name), dtype=dtype, mode="w+", shape=shape)
+            array[:] = fill
+            array.flush()
+            del array
+        with open(info_path, "w") as f:
+            json.dump(info, f)
+
+    def _open(self) -> None:
+        """Opens the memmaps and the lock file once per process, e.g. inside each
+        DataLoader worker."""
+        if self._pid == os.getpid():
+            return
+        self._pixels = np.memmap(self._path("pixels.u8"), dtype=np.uint8, mode="r+",
+                                 shape=(self.capacity,) + self.slot_shape)
+        self._slot_keys = np.memmap(self._path("slot_keys.u64"), dtype=np.uint64, mode="r+",
+                                    shape=(self.capacity,))
+        self._slot_last_used = np.memmap(self._path("slot_last_used.i64"), dtype=np.int64, mode="r+",
+                                         shape=(self.capacity,))
+        self._slot_of_index = np.memmap(self._path("slot_of_index.i64"), dtype=np.int64, mode="r+",
+                                        shape=(self.num_samples,))
+        self._index_of_slot = np.memmap(self._path("index_of_slot.i64"), dtype=np.int64, mode="r+",
+                                        shape=(self.capacity,))
+        self._slots_used = np.memmap(self._path("slots_used.i64"), dtype=np.int64, mode="r+", shape=(1,))
+        self._lock_file = open(self._path("lock"), "a")
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # memmaps and the lock file are reopened in the worker instead of being pickled
+        state = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        state["_pid"] = None
+        return state
+
+    def key(self, path: str) -> int:
+        """Hashes the image path, its mtime and the preprocessing settings."""
+        stat = os.stat(path)
+        digest = hashlib.blake2b(
+            f"{path}|{stat.st_mtime_ns}|{self.image_size}|{self.channels}".encode(), digest_size=8
+        ).digest()
+        return int.from_bytes(digest, "big") or 1
+
+    def get(self, idx: int, path: str, load: Callable[[str], npt.NDArray]) -> npt.NDArray:
+        """
+        Returns the cached image of a sample, loading and storing it on a miss.
+
+        Args:
+            idx (int): The dataset index of the sample.
+            path (str): The path to the image.
+            load (Callable[[str], npt.NDArray]): Decodes and resizes the image at a path
+            to a uint8 array of shape (image_size, image_size, channels).
+        Returns:
+            npt.NDArray: The uint8 image of shape (image_size, image_size, channels).
+        """
+        self._open()
+        key = np.uint64(self.key(path))
+        slot = int(self._slot_of_index[idx])
+        if slot >= 0 and self._slot_keys[slot] == key:
+            image = np.array(self._pixels[slot])
+            # the slot may have been evicted by another worker while it was copied
+            if self._slot_keys[slot] == key:
+                self._slot_last_used[slot] = time.time_ns()
+                return image
+
+        image = np.array(load(path), dtype=np.uint8).reshape(self.slot_shape)
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            slot = int(self._slot_of_index[idx])
+            if slot < 0:
+                if self._slots_used[0] < self.capacity:
+                    slot = int(self._slots_used[0])
+                    self._slots_used[0] += 1
+                else:
+                    slot = int(np.argmin(self._slot_last_used))
+                    previous = int(self._index_of_slot[slot])
+                    if previous >= 0:
+                        self._slot_of_index[previous] = -1
+            self._slot_keys[slot] = EMPTY_SLOT
+            self._pixels[slot] = image
+            self._slot_last_used[slot] = time.time_ns()
+            self._slot_keys[slot] = key
+            self._index_of_slot[slot] = idx
+            self._slot_of_index[idx] = slot
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        return image
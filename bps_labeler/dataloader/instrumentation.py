@@ -0,0 +1,64 @@
+""" Opt-in instrumentation of the input pipeline, read by model/profiling.py.
+
+SampleTimer accumulates the time BPSTracksDataset.__getitem__ spends decoding and
+transforming samples inside the DataLoader workers. InstrumentedDataLoader exposes
+the prefetch queue and the worker processes of its current iterator.
+"""
+from typing import List, Tuple
+
+import torch
+from torch.utils.data import DataLoader, get_worker_info
+
+
+class SampleTimer:
+    """ Decode seconds and sample counts per DataLoader worker.
+
+    The totals live in a shared memory tensor with one row per worker and one for the
+    main process, so every row has a single writer and workers need no locking.
+
+    Args:
+        num_workers (int): The number of DataLoader workers.
+    """
+    def __init__(self, num_workers: int):
+        self.totals = torch.zeros(num_workers + 1, 2, dtype=torch.float64).share_memory_()
+
+    def add(self, seconds: float) -> None:
+        """Adds the time spent on one sample, from the main process or a worker."""
+        worker_info = get_worker_info()
+        slot = 0 if worker_info is None else worker_info.id + 1
+        self.totals[slot, 0] += seconds
+        self.totals[slot, 1] += 1
+
+    def snapshot(self) -> Tuple[float, int]:
+        """Returns the decode seconds and the number of samples summed over all workers."""
+        seconds, count = self.totals.sum(dim=0).tolist()
+        return seconds, int(count)
+
+
+class InstrumentedDataLoader(DataLoader):
+    """ DataLoader remembering its latest iterator so its prefetch queue can be read
+    while iterating."""
+    def __iter__(self):
+        self._last_iterator = super().__iter__()
+        return self._last_iterator
+
+    def queue_depth(self) -> Tuple[int, int]:
+        """
+        Returns the batches requested from the workers but not yet consumed, and those
+        of them that are already decoded and waiting in the data queue. Both are 0
+        without workers; the second is -1 where the queue size is unavailable, e.g. on
+        macOS.
+        """
+        iterator = getattr(self, "_last_iterator", None)
+        in_flight = getattr(iterator, "_tasks_outstanding", 0)
+        data_queue = getattr(iterator, "_data_queue", None)
+        try:
+            ready = data_queue.qsize() if data_queue is not None else 0
+        except NotImplementedError:
+            ready = -1
+        return in_flight, ready
+
+    def worker_pids(self) -> List[int]:
+        """The process ids of the workers of the current iterator."""
+        iterator = getattr(self, "_last_iterator", None)
+        return [worker.pid for worker in getattr(iterator, "_workers", []) if worker.pid is not None]
@@ -0,0 +1,113 @@
+""" Packed tar shards of the BPS Tracks images for sequential reads.
+Each shard is an uncompressed tar file holding `<filestem>.jpg` followed by
+`<filestem>.json` per sample, where the JSON holds the filename, the label if the
+sample is labeled and the Lightly metadata if available. `index.json` lists the
+shards and their sample counts, and a hash of the filename -> label map packed, so
+training shards can be checked against the labels of the current exports.
+"""
+import hashlib
+import io
+import json
+import os
+import pathlib
+import tarfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+INDEX_FNAME = "index.json"
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def labels_hash(sample_list: List[Dict]) -> str:
+    """Hashes the filename -> label map of the labeled samples, independent of order."""
+    labels = sorted((pathlib.Path(sample["path"]).name, sample["label"]) for sample in sample_list
+                    if "label" in sample)
+    return hashlib.blake2b(json.dumps(labels).encode(), digest_size=16).hexdigest()
+
+
+def write_shards(
+    sample_list: List[Dict],
+    shard_dir: str,
+    metadata_dir: Optional[str] = None,
+    max_shard_bytes: int = 64 * 1024 * 1024,
+    shard_prefix: str = "shard"
+    ) -> Dict:
+    """
+    Packs samples into fixed-size tar shards and writes an index.
+
+    Args:
+        sample_list (List[Dict]): The samples, e.g. from full_train.json or train.json,
+        as [{"path": "/path/image1.jpg", "label": "track"}, ...]. Labels are optional.
+        shard_dir (str): The directory to write the shards and index to.
+        metadata_dir (str): The directory with the Lightly metadata JSON of each image.
+        max_shard_bytes (int): A new shard is started once a shard reaches this size.
+        shard_prefix (str): The filename prefix of the shards.
+    Returns:
+        Dict: The index, {"num_samples": int, "labels_hash": str,
+        "shards": [{"name", "num_samples", "num_bytes"}]}.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    tar = None
+    for sample in sample_list:
+        if tar is None or shards[-1]["num_bytes"] >= max_shard_bytes:
+            if tar is not None:
+                tar.close()
+            name = f"{shard_prefix}-{len(shards):06d}.tar"
+            tar = tarfile.open(os.path.join(shard_dir, name), "w")
+            shards.append({"name": name, "num_samples": 0, "num_bytes": 0})
+
+        path = pathlib.Path(sample["path"])
+        record = {"filename": path.name}
+        if "label" in sample:
+            record["label"] = sample["label"]
+        if metadata_dir is not None:
+            metadata_path = os.path.join(metadata_dir, f"{path.stem}.json")
+            if os.path.exists(metadata_path):
+                with open(metadata_path, "r") as f:
+                    record["metadata"] = json.load(f).get("metadata", {})
+        image_bytes = path.read_bytes()
+        record_bytes = json.dumps(record).encode()
+        _add_bytes(tar, f"{path.stem}.jpg", image_bytes)
+        _add_bytes(tar, f"{path.stem}.json", record_bytes)
+        shards[-1]["num_samples"] += 1
+        # tar pads every member to 512 byte blocks after a 512 byte header
+        shards[-1]["num_bytes"] += sum(512 + -(-len(data) // 512) * 512 for data in (image_bytes, record_bytes))
+    if tar is not None:
+        tar.close()
+
+    index = {"num_samples": sum(shard["num_samples"] for shard in shards), "labels_hash": labels_hash(sample_list),
+             "shards": shards}
+    with open(os.path.join(shard_dir, INDEX_FNAME), "w") as f:
+        json.dump(index, f, indent=4)
+    return index
+
+
+def read_shard_index(shard_dir: str) -> Dict:
+    """Reads the index written by write_shards."""
+    with open(os.path.join(shard_dir, INDEX_FNAME), "r") as f:
+        return json.load(f)
+
+
+def iter_shard(shard_path: str) -> Iterator[Tuple[bytes, Dict]]:
+    """
+    Streams the samples of a shard in order with a single sequential read.
+
+    Args:
+        shard_path (str): The path to the shard.
+    Yields:
+        Tuple[bytes, Dict]: The encoded image and its record.
+    """
+    image_bytes = None
+    with tarfile.open(shard_path, "r|") as tar:
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name.endswith(".json"):
+                yield image_bytes, json.loads(data)
+                image_bytes = None
+            else:
+                image_bytes = data
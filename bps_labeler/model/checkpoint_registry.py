@@ -0,0 +1,192 @@
+""" Registry of the trained checkpoints, for warm-starting later active learning rounds.
+
+Every training run saves its weights as before and, next to them, a training state
+file with the optimizer state and the labels it was trained on. The registry,
+registry.json in config.save_model_dir, records for every checkpoint the Label
+Studio exports and their content hashes, the hash of the full_train.json manifest
+and a compatibility key of the model. A later round starts from the newest
+checkpoint with the same compatibility key and manifest that was trained on a subset
+of its exports, and only has to learn the samples labeled or relabeled since. A
+checkpoint trained on exactly the same exports is never a starting point, so rerunning
+a round retrains it from its own parent, or from ImageNet weights for the first round,
+instead of compounding over reruns.
+"""
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import torch
+
+from bps_labeler.bps_utils.prediction_store import file_hash
+
+
+def compatibility_key(config) -> Dict:
+    """
+    The settings a checkpoint must share with the configuration to be loaded into
+    its model, see training.build_model.
+
+    Args:
+        config (BPSTracksConfig): The configuration.
+    Returns:
+        Dict: The architecture, number of classes and input channels of the stem.
+    """
+    return {
+        "architecture": "resnet50",
+        "num_classes": config.num_classes,
+        "input_channels": 1 if config.grayscale and config.grayscale_stem == "sum" else 3,
+    }
+
+
+@dataclass
+class CheckpointEntry:
+    """ A registered checkpoint.
+
+    Args:
+        weights_path (str): The model state_dict, as saved by training.train_and_predict.
+        training_state_path (str): The optimizer state and the labels trained on.
+        created (str): The time of registration, ISO 8601.
+        annotation_exports (List[Dict]): The `path` and content `hash` of every Label
+        Studio export trained on.
+        manifest_hash (Optional[str]): The content hash of full_train.json.
+        compatibility (Dict): See compatibility_key.
+        num_labeled (int): The number of labeled samples trained on.
+        num_new (int): The samples new or relabeled since the parent checkpoint.
+        parent (Optional[str]): The weights_path of the checkpoint training started from.
+    """
+    weights_path: str
+    training_state_path: str
+    created: str
+    annotation_exports: List[Dict] = field(default_factory=list)
+    manifest_hash: Optional[str] = None
+    compatibility: Dict = field(default_factory=dict)
+    num_labeled: int = 0
+    num_new: int = 0
+    parent: Optional[str] = None
+
+
+class CheckpointRegistry:
+    """ The checkpoints of a model directory, oldest first.
+
+    Args:
+        model_dir (str): The directory of the weights, see BPSTracksConfig.save_model_dir.
+    """
+    def __init__(self, model_dir: str):
+        self.model_dir = model_dir
+        self.registry_path = os.path.join(model_dir, "registry.json")
+
+    def entries(self) -> List[CheckpointEntry]:
+        """The registered checkpoints, oldest first."""
+        if not os.path.exists(self.registry_path):
+            return []
+        with open(self.registry_path, "r") as f:
+            return [CheckpointEntry(**entry) for entry in json.load(f)["checkpoints"]]
+
+    def register(self, entry: CheckpointEntry) -> None:
+        """Appends a checkpoint, replacing registry.json atomically."""
+        entries = self.entries() + [entry]
+        os.makedirs(self.model_dir, exist_ok=True)
+        tmp_path = f"{self.registry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"checkpoints": [asdict(e) for e in entries]}, f, indent=4)
+        os.replace(tmp_path, self.registry_path)
+
+    def latest_compatible(
+        self,
+        compatibility: Dict,
+        annotation_fpaths: List[str],
+        manifest_path: Optional[str] = None
+        ) -> Optional[CheckpointEntry]:
+        """
+        Finds the checkpoint to warm-start from.
+
+        Args:
+            compatibility (Dict): The compatibility key of the model to train.
+            annotation_fpaths (List[str]): The Label Studio exports to train on.
+            manifest_path (Optional[str]): The full_train.json of the round; if given,
+            checkpoints of another manifest are skipped.
+        Returns:
+            Optional[CheckpointEntry]: The newest checkpoint with the same compatibility
+            key and manifest, trained only on exports among annotation_fpaths but not on
+            exactly their current content, and whose files still exist, or None.
+        """
+        current = {os.path.abspath(path): file_hash(path) for path in annotation_fpaths}
+        manifest_hash = file_hash(manifest_path) if manifest_path and os.path.exists(manifest_path) else None
+        for entry in reversed(self.entries()):
+            if entry.compatibility != compatibility:
+                continue
+            if manifest_hash is not None and entry.manifest_hash not in (None, manifest_hash):
+                continue
+            trained_on = {export["path"]: export["hash"] for export in entry.annotation_exports}
+            # a rerun on the same labels must not fine-tune its own previous output
+            if not trained_on.keys() <= current.keys() or trained_on == current:
+                continue
+            if os.path.exists(entry.weights_path) and os.path.exists(entry.training_state_path):
+                return entry
+        return None
+
+
+def save_checkpoint(
+    registry: CheckpointRegistry,
+    model,
+    optimizer_state: Optional[Dict],
+    labels: Dict[str, str],
+    config,
+    annotation_fpaths: List[str],
+    manifest_path: str,
+    parent: Optional[CheckpointEntry] = None,
+    num_new: Optional[int] = None
+    ) -> CheckpointEntry:
+    """
+    Saves the weights and the training state of a model and registers them.
+
+    Args:
+        registry (CheckpointRegistry): The registry of config.save_model_dir.
+        model (ResNet50Classifier): The trained model.
+        optimizer_state (Optional[Dict]): The state_dict of its optimizer, None if it
+        was trained without one, e.g. with frozen_backbone.
+        labels (Dict[str, str]): The label per filename trained on.
+        config (BPSTracksConfig): The configuration.
+        annotation_fpaths (List[str]): The Label Studio exports trained on.
+        manifest_path (str): The full_train.json of the round.
+        parent (Optional[CheckpointEntry]): The checkpoint training started from.
+        num_new (Optional[int]): The samples new since parent, all of them by default.
+    Returns:
+        CheckpointEntry: The registered checkpoint.
+    """
+    now = datetime.now()
+    prefix = os.path.join(registry.model_dir, f"{now.strftime('%Y%m%d%H%M%S')}_resnet50")
+    os.makedirs(registry.model_dir, exist_ok=True)
+    torch.save(model.state_dict(), f"{prefix}.pth")
+    torch.save({"optimizer_state": optimizer_state, "labels": labels}, f"{prefix}_training_state.pt")
+    entry = CheckpointEntry(
+        weights_path=f"{prefix}.pth",
+        training_state_path=f"{prefix}_training_state.pt",
+        created=now.isoformat(timespec="seconds"),
+        annotation_exports=[{"path": os.path.abspath(path), "hash": file_hash(path)} for path in annotation_fpaths],
+        manifest_hash=file_hash(manifest_path) if os.path.exists(manifest_path) else None,
+        compatibility=compatibility_key(config),
+        num_labeled=len(labels),
+        num_new=len(labels) if num_new is None else num_new,
+        parent=parent.weights_path if parent is not None else None,
+    )
+    registry.register(entry)
+    return entry
+
+
+def load_checkpoint(entry: CheckpointEntry, model) -> Dict:
+    """
+    Loads the weights of a checkpoint into a model and attaches its optimizer state,
+    restored by ResNet50Classifier.configure_optimizers.
+
+    Args:
+        entry (CheckpointEntry): The checkpoint.
+        model (ResNet50Classifier): A model with the checkpoint's compatibility key.
+    Returns:
+        Dict: The training state, with the `labels` the checkpoint was trained on.
+    """
+    model.load_state_dict(torch.load(entry.weights_path, map_location="cpu"))
+    training_state = torch.load(entry.training_state_path, map_location="cpu")
+    model.initial_optimizer_state = training_state["optimizer_state"]
+    return training_state
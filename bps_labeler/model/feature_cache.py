@@ -0,0 +1,194 @@
+""" On-disk cache of pooled ResNet-50 backbone features for frozen-backbone training.
+
+With a frozen backbone the 2048-d pooled features of an image only depend on the
+image content, the backbone weights and the preprocessing. They are computed once
+and stored in a float16 np.memmap, so training the classification head and
+re-scoring the unlabeled pool become matrix operations over the cached features.
+Rows are keyed by a hash of the image file content; one cache directory is used per
+backbone weights hash and preprocessing, so new images are the only ones that ever
+need a forward pass.
+"""
+import hashlib
+import json
+import os
+import pathlib
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import numpy.typing as npt
+from torch.utils.data import DataLoader
+
+from bps_labeler.dataloader.dataset import CLASSES, encode_label
+
+
+def file_content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """Hashes the content of a file."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backbone_weights_hash(model) -> str:
+    """Hashes every parameter and buffer of the ResNet-50 except the classification head."""
+    digest = hashlib.blake2b(digest_size=16)
+    for name, tensor in sorted(model.resnet50.state_dict().items()):
+        if name.startswith("fc."):
+            continue
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """ float16 feature rows in a growable np.memmap, indexed by file content hash.
+
+    File hashes are remembered per (path, mtime, size) so unchanged files are not
+    re-read on later rounds.
+    """
+    def __init__(self, cache_dir: str, feature_dim: int = 2048):
+        self.cache_dir = cache_dir
+        self.feature_dim = feature_dim
+        os.makedirs(cache_dir, exist_ok=True)
+        self.features_path = os.path.join(cache_dir, "features.f16")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.rows: Dict[str, int] = {}
+        self.file_hashes: Dict[str, List] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            self.rows = index["rows"]
+            self.file_hashes = index["file_hashes"]
+        self.capacity = 0
+        self.features = None
+        self._ensure_capacity(max(len(self.rows), 1))
+
+    def _ensure_capacity(self, num_rows: int) -> None:
+        """Grows the memmap file to hold at least num_rows rows."""
+        if num_rows <= self.capacity:
+            return
+        capacity = max(num_rows, 2 * self.capacity)
+        with open(self.features_path, "ab") as f:
+            f.truncate(capacity * self.feature_dim * 2)
+        self.features = np.memmap(self.features_path, dtype=np.float16, mode="r+",
+                                  shape=(capacity, self.feature_dim))
+        self.capacity = capacity
+
+    def hash_files(self, paths: List[str]) -> List[str]:
+        """Returns the content hash of each file, re-reading only changed files."""
+        hashes = []
+        for path in paths:
+            stat = os.stat(path)
+            known = self.file_hashes.get(path)
+            if known is None or known[0] != stat.st_mtime_ns or known[1] != stat.st_size:
+                known = [stat.st_mtime_ns, stat.st_size, file_content_hash(path)]
+                self.file_hashes[path] = known
+            hashes.append(known[2])
+        return hashes
+
+    def add(self, file_hashes: List[str], features: npt.NDArray) -> None:
+        """Stores the features of new files."""
+        start = len(self.rows)
+        self._ensure_capacity(start + len(file_hashes))
+        self.features[start:start + len(file_hashes)] = features.astype(np.float16)
+        for offset, file_hash in enumerate(file_hashes):
+            self.rows[file_hash] = start + offset
+        self.flush()
+
+    def get(self, file_hashes: List[str]) -> npt.NDArray:
+        """Returns the float32 features of cached files."""
+        rows = np.asarray([self.rows[file_hash] for file_hash in file_hashes], dtype=np.int64)
+        return np.asarray(self.features[rows], dtype=np.float32)
+
+    def flush(self) -> None:
+        self.features.flush()
+        with open(self.index_path, "w") as f:
+            json.dump({"rows": self.rows, "file_hashes": self.file_hashes}, f)
+
+
+def extract_cached_features(
+    model,
+    sample_list: List[Dict],
+    cache_root: str,
+    make_dataloader: Callable[[List[Dict]], DataLoader],
+    preprocessing_key: str = ""
+    ) -> npt.NDArray:
+    """
+    Returns the pooled backbone features of every sample, computing only the missing ones.
+
+    Args:
+        model (ResNet50Classifier): The model with a frozen backbone.
+        sample_list (List[Dict]): The samples, [{"path": "/path/image1.jpg", ...}, ...].
+        cache_root (str): The directory holding one cache per weights hash.
+        make_dataloader (Callable[[List[Dict]], DataLoader]): Builds an inference
+        DataLoader over samples, returning dataset indices as keys, e.g.
+        BPSTracksDataModule.inference_dataloader.
+        preprocessing_key (str): Identifies the preprocessing, e.g. image size and
+        grayscale mode, so features of different preprocessing are not mixed.
+    Returns:
+        npt.NDArray: The float32 features of shape (len(sample_list), 2048).
+    """
+    key = hashlib.blake2b(f"{backbone_weights_hash(model)}|{preprocessing_key}".encode(), digest_size=16).hexdigest()
+    cache = FeatureCache(os.path.join(cache_root, key))
+    file_hashes = cache.hash_files([sample["path"] for sample in sample_list])
+
+    missing = {}
+    for sample, file_hash in zip(sample_list, file_hashes):
+        if file_hash not in cache.rows and file_hash not in missing:
+            missing[file_hash] = sample
+    if missing:
+        print(f"Computing backbone features for {len(missing)} of {len(sample_list)} images")
+        missing_hashes = list(missing)
+        features, _ = model.extract_embeddings(make_dataloader(list(missing.values())))
+        cache.add(missing_hashes, features)
+    else:
+        cache.flush()
+    return cache.get(file_hashes)
+
+
+def _preprocessing_key(datamodule) -> str:
+    return f"image_size={datamodule.image_size}|grayscale={datamodule.grayscale}"
+
+
+def train_head_with_cached_features(model, datamodule, cache_root: str, epochs: int, seed: int = 42) -> List[float]:
+    """
+    Freezes the backbone and trains the classification head on the cached features of
+    the labeled samples of a prepared BPSTracksDataModule.
+
+    Args:
+        model (ResNet50Classifier): The model to train.
+        datamodule (BPSTracksDataModule): The data module after prepare_data.
+        cache_root (str): The feature cache directory, see BPSTracksConfig.feature_cache_dir.
+        epochs (int): The number of passes over the labeled features.
+        seed (int): Seeds the minibatch order.
+    Returns:
+        List[float]: The average training loss per epoch.
+    """
+    model.freeze_backbone()
+    features = extract_cached_features(model, datamodule.sample_list, cache_root,
+                                       datamodule.inference_dataloader, _preprocessing_key(datamodule))
+    class_to_idx = {cls: idx for idx, cls in enumerate(CLASSES)}
+    labels = np.stack([encode_label(sample, class_to_idx).numpy() for sample in datamodule.sample_list])
+    return model.fit_head(features, labels, epochs, seed=seed)
+
+
+def predict_with_cached_features(model, datamodule, cache_root: str) -> Tuple[npt.NDArray, List[str]]:
+    """
+    Predicts class probabilities for every sample of full_train.json from cached
+    features, computing features only for images not seen before.
+
+    Args:
+        model (ResNet50Classifier): The model with a frozen backbone and trained head.
+        datamodule (BPSTracksDataModule): The data module.
+        cache_root (str): The feature cache directory, see BPSTracksConfig.feature_cache_dir.
+    Returns:
+        Tuple[npt.NDArray, List[str]]: The probabilities (N, num_classes) and filenames,
+        in the order of full_train.json like predict_active_learning.
+    """
+    with open(datamodule.full_train_json_path, "r") as f:
+        full_train_list = json.load(f)
+    features = extract_cached_features(model, full_train_list, cache_root,
+                                       datamodule.inference_dataloader, _preprocessing_key(datamodule))
+    filenames = [pathlib.Path(sample["path"]).name for sample in full_train_list]
+    return model.predict_from_features(features), filenames
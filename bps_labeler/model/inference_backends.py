@@ -0,0 +1,172 @@
+""" Pluggable CPU inference backends for the active learning prediction pass of ResNet50Classifier.
+
+Backends take a batch of images and return logits. They are built from a trained
+model by build_inference_backend, selected with BPSTracksConfig.inference_backend:
+
+- "eager": the model as is, in fp32.
+- "channels_last_bf16": a channels_last copy of the model run under bf16 autocast.
+- "torchscript": a traced and frozen TorchScript copy of the model.
+- "onnxruntime": the model exported to ONNX and run by ONNX Runtime with the
+  configured intra/inter-op thread counts.
+- "int8_dynamic" / "int8_static": an INT8 quantized copy of the model, see
+  quantization.py. Their agreement with fp32 is reported by
+  quantization.compare_selection_agreement rather than a fixed tolerance. Only
+  "int8_static" is faster; "int8_dynamic" quantizes the head alone and serves as an
+  agreement baseline.
+
+BACKEND_TOLERANCES documents the maximum absolute difference of the softmax
+probabilities from "eager" that each backend is expected to stay within.
+"""
+import copy
+import inspect
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+BACKEND_TOLERANCES = {
+    "eager": 0.0,
+    # bf16 keeps 8 bits of mantissa, probabilities shift by up to a few percent
+    "channels_last_bf16": 5e-2,
+    "torchscript": 1e-4,
+    "onnxruntime": 1e-4,
+}
+
+
+class _ClassifierNet(nn.Module):
+    """ Wraps the ResNet-50 of a ResNet50Classifier together with its input preparation."""
+    def __init__(self, model):
+        super().__init__()
+        self.resnet50 = copy.deepcopy(model.resnet50)
+        self.expand_grayscale = model.grayscale_stem == "expand"
+        self.eval()
+
+    def forward(self, x):
+        if self.expand_grayscale:
+            x = x.expand(-1, 3, -1, -1)
+        return self.resnet50(x)
+
+
+class InferenceBackend:
+    """ Eager fp32 inference with the model itself."""
+    name = "eager"
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        return self.model.resnet50(self.model._prepare_input(images))
+
+
+class ChannelsLastBf16Backend(InferenceBackend):
+    """ Inference on a channels_last copy of the model under bf16 autocast."""
+    name = "channels_last_bf16"
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.net = _ClassifierNet(model).to(memory_format=torch.channels_last)
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(device_type=images.device.type, dtype=torch.bfloat16):
+            logits = self.net(images.contiguous(memory_format=torch.channels_last))
+        return logits.float()
+
+
+class TorchScriptBackend(InferenceBackend):
+    """ Inference with a traced, frozen TorchScript copy of the model. The model is
+    traced on the first batch."""
+    name = "torchscript"
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.net = None
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        if self.net is None:
+            with torch.no_grad():
+                traced = torch.jit.trace(_ClassifierNet(self.model).to(images.device), images)
+            self.net = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        return self.net(images)
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """ Inference with ONNX Runtime on the model exported to ONNX. The model is
+    exported on the first batch, to onnx_model_path if given, otherwise to a temporary
+    directory removed once the session has loaded it."""
+    name = "onnxruntime"
+
+    def __init__(self, model, onnx_model_path: Optional[str] = None, intra_op_threads: int = 0,
+                 inter_op_threads: int = 0):
+        super().__init__(model)
+        self.onnx_model_path = onnx_model_path
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.session = None
+
+    def _export(self, images: torch.Tensor, onnx_model_path: str) -> None:
+        export_kwargs = {}
+        # newer torch versions default to the dynamo exporter, which needs onnxscript
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            export_kwargs["dynamo"] = False
+        torch.onnx.export(
+            _ClassifierNet(self.model).cpu(),
+            images[:1].cpu(),
+            onnx_model_path,
+            input_names=["images"],
+            output_names=["logits"],
+            dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+            **export_kwargs,
+        )
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        if self.session is None:
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = self.intra_op_threads
+            options.inter_op_num_threads = self.inter_op_threads
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if self.onnx_model_path is not None:
+                self._export(images, self.onnx_model_path)
+                self.session = ort.InferenceSession(self.onnx_model_path, options,
+                                                    providers=["CPUExecutionProvider"])
+            else:
+                # the session reads the whole model on creation, so the export can go right after
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    onnx_model_path = os.path.join(tmp_dir, "resnet50.onnx")
+                    self._export(images, onnx_model_path)
+                    self.session = ort.InferenceSession(onnx_model_path, options,
+                                                        providers=["CPUExecutionProvider"])
+        logits = self.session.run(["logits"], {"images": np.ascontiguousarray(images.cpu().numpy())})[0]
+        return torch.from_numpy(logits).to(images.device)
+
+
+def build_inference_backend(model, config, calibration_loader=None) -> InferenceBackend:
+    """
+    Builds the inference backend selected in the config for a trained model.
+
+    Args:
+        model (ResNet50Classifier): The trained model.
+        config (BPSTracksConfig): The configuration with `inference_backend`,
+        `onnx_model_path`, `ort_intra_op_threads` and `ort_inter_op_threads`.
+        calibration_loader (DataLoader): Calibration batches for "int8_static".
+    Returns:
+        InferenceBackend: The backend, called with a batch of images to get logits.
+    """
+    name = config.inference_backend
+    if name == "eager":
+        return InferenceBackend(model)
+    if name == "channels_last_bf16":
+        return ChannelsLastBf16Backend(model)
+    if name == "torchscript":
+        return TorchScriptBackend(model)
+    if name == "onnxruntime":
+        return OnnxRuntimeBackend(model, config.onnx_model_path, config.ort_intra_op_threads,
+                                  config.ort_inter_op_threads)
+    if name in ("int8_dynamic", "int8_static"):
+        from bps_labeler.model.quantization import quantize_classifier
+        return quantize_classifier(model, name[len("int8_"):], calibration_loader, config.quantization_engine)
+    raise ValueError(f"Unknown inference backend {name!r}, expected one of "
+                     f"{list(BACKEND_TOLERANCES) + ['int8_dynamic', 'int8_static']}")
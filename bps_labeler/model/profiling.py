@@ -0,0 +1,293 @@
+""" Opt-in step timings of training and prediction, and torch.profiler traces.
+
+With config.profile, every training and prediction step is split into:
+- data wait: waiting for the next batch from the DataLoader,
+- transfer: the host-to-device copy of the batch,
+- compute: forward, and for training backward and optimizer step.
+Windows of config.profile_log_every_n_steps steps are logged with images/sec, the
+DataLoader queue depth, the decode time per sample inside the workers, the peak RSS
+of the main process and the memory of the workers, to a JSON-lines file and/or wandb.
+Forked workers share copy-on-write pages with the main process, so summing their RSS
+counts those pages once per worker; the workers are reported as the sum of their
+proportional set size (PSS, shared pages split between the processes sharing them)
+and the largest peak RSS of a single worker.
+
+With config.torch_profiler_start_step, a torch.profiler trace of
+config.torch_profiler_num_steps training steps is written to config.torch_profiler_dir,
+viewable in TensorBoard or Perfetto.
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import pytorch_lightning as pl
+import torch
+
+from bps_labeler.dataloader.instrumentation import SampleTimer
+
+
+def synchronize(device: torch.device) -> None:
+    """Waits for queued CUDA work so that wall times include it."""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def peak_rss_mb(pid="self") -> Optional[float]:
+    """The peak resident set size of a process in MiB, None where unavailable."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != "self":
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 1024
+
+
+def pss_mb(pid) -> Optional[float]:
+    """The current proportional set size of a process in MiB, None where unavailable,
+    e.g. outside Linux or before Linux 4.14."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class JsonLinesSink:
+    """Appends every record as a line of JSON to a file."""
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+
+    def log(self, record: Dict) -> None:
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class WandbSink:
+    """Logs every record to the active wandb run as profile/<stage>/<metric>."""
+    def log(self, record: Dict) -> None:
+        import wandb
+
+        if wandb.run is None:
+            return
+        wandb.log({f"profile/{record['stage']}/{name}": value for name, value in record.items()
+                   if name not in ("stage", "time") and value is not None})
+
+
+class StepRecorder:
+    """ Accumulates step timings per stage and logs averages over windows of steps.
+
+    Args:
+        sinks (List): Objects with a `log(record)` method, e.g. JsonLinesSink, WandbSink.
+        log_every_n_steps (int): The number of steps per logged window.
+        sample_timer (SampleTimer): The decode timer of the datasets, if any.
+    """
+    def __init__(self, sinks: List, log_every_n_steps: int = 10, sample_timer: Optional[SampleTimer] = None):
+        self.sinks = sinks
+        self.log_every_n_steps = log_every_n_steps
+        self.sample_timer = sample_timer
+        self.steps: Dict[str, int] = {}
+        self.windows: Dict[str, Dict] = {}
+        # workers decode ahead of the steps, so decode times are taken between flushes
+        self._decode_mark = sample_timer.snapshot() if sample_timer is not None else (0.0, 0)
+
+    def _new_window(self) -> Dict:
+        return {"num_steps": 0, "data_wait_sec": 0.0, "transfer_sec": 0.0, "compute_sec": 0.0, "num_images": 0,
+                "batches_in_flight": 0, "batches_ready": 0, "worker_pids": []}
+
+    def record(
+        self,
+        stage: str,
+        data_wait_sec: float,
+        transfer_sec: float,
+        compute_sec: float,
+        num_images: int,
+        loader=None
+        ) -> None:
+        """
+        Records one step.
+
+        Args:
+            stage (str): E.g. "train" or "predict".
+            data_wait_sec (float): The time waiting for the batch.
+            transfer_sec (float): The time copying the batch to the device.
+            compute_sec (float): The time computing on the batch.
+            num_images (int): The batch size.
+            loader (DataLoader): The DataLoader of the batch; queue depths and worker
+            memory are only recorded for an InstrumentedDataLoader.
+        """
+        window = self.windows.setdefault(stage, self._new_window())
+        self.steps[stage] = self.steps.get(stage, 0) + 1
+        window["num_steps"] += 1
+        window["data_wait_sec"] += data_wait_sec
+        window["transfer_sec"] += transfer_sec
+        window["compute_sec"] += compute_sec
+        window["num_images"] += num_images
+        if hasattr(loader, "queue_depth"):
+            in_flight, ready = loader.queue_depth()
+            window["batches_in_flight"] += in_flight
+            window["batches_ready"] += ready
+            window["worker_pids"] = loader.worker_pids()
+        if window["num_steps"] >= self.log_every_n_steps:
+            self.flush(stage)
+
+    def flush(self, stage: str) -> None:
+        """Logs the open window of a stage, if it has any steps."""
+        window = self.windows.pop(stage, None)
+        if window is None or window["num_steps"] == 0:
+            return
+        num_steps = window["num_steps"]
+        wall_sec = window["data_wait_sec"] + window["transfer_sec"] + window["compute_sec"]
+        record = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "stage": stage,
+            "step": self.steps[stage],
+            "num_steps": num_steps,
+            "data_wait_ms": 1000 * window["data_wait_sec"] / num_steps,
+            "transfer_ms": 1000 * window["transfer_sec"] / num_steps,
+            "compute_ms": 1000 * window["compute_sec"] / num_steps,
+            "data_wait_fraction": window["data_wait_sec"] / wall_sec if wall_sec > 0 else None,
+            "images_per_sec": window["num_images"] / wall_sec if wall_sec > 0 else None,
+            "batches_in_flight": window["batches_in_flight"] / num_steps,
+            "batches_ready": window["batches_ready"] / num_steps,
+            "decode_ms_per_sample": None,
+            "peak_rss_mb": peak_rss_mb(),
+            "workers_pss_mb": None,
+            "worker_max_peak_rss_mb": None,
+        }
+        if self.sample_timer is not None:
+            decode_sec, num_samples = self.sample_timer.snapshot()
+            if num_samples > self._decode_mark[1]:
+                record["decode_ms_per_sample"] = \
+                    1000 * (decode_sec - self._decode_mark[0]) / (num_samples - self._decode_mark[1])
+            self._decode_mark = (decode_sec, num_samples)
+        worker_pss = [pss_mb(pid) for pid in window["worker_pids"]]
+        if worker_pss and None not in worker_pss:
+            record["workers_pss_mb"] = sum(worker_pss)
+        worker_rss = [peak_rss_mb(pid) for pid in window["worker_pids"]]
+        if worker_rss and None not in worker_rss:
+            record["worker_max_peak_rss_mb"] = max(worker_rss)
+        for sink in self.sinks:
+            sink.log(record)
+
+
+class StepTimingCallback(pl.Callback):
+    """ Records every training step with a StepRecorder.
+
+    The batch is fetched and copied to the device between on_train_batch_end of the
+    previous step and on_train_batch_start, so the copy timed by
+    ResNet50Classifier.transfer_batch_to_device is subtracted from that gap to get
+    the data wait.
+    """
+    def __init__(self, recorder: StepRecorder):
+        self.recorder = recorder
+        self._last_end = time.perf_counter()
+        self._start = self._last_end
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._last_end = time.perf_counter()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        synchronize(pl_module.device)
+        end = time.perf_counter()
+        transfer_sec = getattr(pl_module, "last_transfer_sec", 0.0)
+        loader = getattr(trainer.datamodule, "loaders", {}).get("train")
+        self.recorder.record("train", max(self._start - self._last_end - transfer_sec, 0.0), transfer_sec,
+                             end - self._start, len(batch[0]), loader)
+        self._last_end = end
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self.recorder.flush("train")
+
+
+class TorchProfilerCallback(pl.Callback):
+    """ Traces a window of training steps with torch.profiler.
+
+    Args:
+        trace_dir (str): The directory for the trace files.
+        start_step (int): The first traced step, counted over all epochs from 0.
+        num_steps (int): The number of traced steps.
+    """
+    def __init__(self, trace_dir: str, start_step: int, num_steps: int):
+        self.trace_dir = trace_dir
+        self.start_step = start_step
+        self.num_steps = num_steps
+        self.profiler = None
+
+    def on_train_start(self, trainer, pl_module):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=max(self.start_step - 1, 0), warmup=min(self.start_step, 1),
+                                             active=self.num_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+            record_shapes=True,
+            profile_memory=True,
+        )
+        self.profiler.start()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.profiler.step()
+
+    def _stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def on_train_end(self, trainer, pl_module):
+        self._stop()
+
+    def on_exception(self, trainer, pl_module, exception):
+        self._stop()
+
+
+def build_profiling_callbacks(config, datamodule, model) -> List[pl.Callback]:
+    """
+    Sets up the instrumentation enabled in the configuration.
+
+    With config.profile a StepRecorder is attached to the model, which then also
+    records its prediction passes, see ResNet50Classifier._predict_batches.
+
+    Args:
+        config (BPSTracksConfig): The configuration.
+        datamodule (BPSTracksDataModule): The data module, built with profile=config.profile.
+        model (ResNet50Classifier): The model.
+    Returns:
+        List[pl.Callback]: The callbacks to pass to the pl.Trainer, empty if nothing
+        is enabled.
+    """
+    callbacks = []
+    if config.profile:
+        sinks = []
+        if "jsonl" in config.profile_sinks:
+            sinks.append(JsonLinesSink(config.profile_log_path))
+        if "wandb" in config.profile_sinks:
+            sinks.append(WandbSink())
+        model.step_recorder = StepRecorder(sinks, config.profile_log_every_n_steps,
+                                           getattr(datamodule, "sample_timer", None))
+        callbacks.append(StepTimingCallback(model.step_recorder))
+    if config.torch_profiler_start_step is not None:
+        callbacks.append(TorchProfilerCallback(config.torch_profiler_dir, config.torch_profiler_start_step,
+                                               config.torch_profiler_num_steps))
+    return callbacks
@@ -0,0 +1,142 @@
+""" INT8 quantized inference for the active learning prediction pass of ResNet50Classifier.
+
+Two modes are supported:
+- "dynamic": only the classification head (nn.Linear) is quantized dynamically. It
+  needs no calibration but leaves the convolutional backbone, nearly all of the
+  compute, in fp32, so it brings no speedup; it is kept as an agreement baseline for
+  compare_selection_agreement.
+- "static": the whole network is quantized with FX graph mode post-training static
+  quantization, calibrated on a few hundred images from full_train.json.
+
+Uncertainty ranking only needs the relative order of the scores, so
+compare_selection_agreement reports how well the quantized predictions preserve the
+fp32 selection before the quantized model is used for a prediction sweep.
+"""
+from typing import Dict, Optional, Sequence
+
+# in order of preference when no engine is configured
+PREFERRED_ENGINES = ("x86", "fbgemm", "qnnpack")
+
+import numpy as np
+import numpy.typing as npt
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from bps_labeler.bps_utils.active_learning_utils import compute_uncertainty_scores, select_top_k
+from bps_labeler.model.inference_backends import InferenceBackend, _ClassifierNet
+
+
+def resolve_engine(engine: Optional[str] = None) -> str:
+    """
+    Picks the quantized engine for this CPU.
+
+    Args:
+        engine (str): The configured engine, e.g. "x86" on Intel/AMD or "qnnpack" on ARM.
+        None picks the first of PREFERRED_ENGINES this build of torch supports.
+    Returns:
+        str: The engine.
+    Raises:
+        ValueError: If the engine, or every preferred engine, is unsupported.
+    """
+    supported = torch.backends.quantized.supported_engines
+    if engine is not None:
+        if engine not in supported:
+            raise ValueError(f"Quantized engine {engine!r} is not supported here, expected one of {supported}")
+        return engine
+    for candidate in PREFERRED_ENGINES:
+        if candidate in supported:
+            return candidate
+    raise ValueError(f"None of the quantized engines {PREFERRED_ENGINES} is supported here: {supported}")
+
+
+class QuantizedBackend(InferenceBackend):
+    """ Inference with an INT8 quantized copy of the model on CPU."""
+    def __init__(self, model, net: nn.Module, mode: str):
+        super().__init__(model)
+        self.net = net
+        self.name = f"int8_{mode}"
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        return self.net(images.cpu()).to(images.device)
+
+
+def quantize_classifier(
+    model,
+    mode: str = "static",
+    calibration_loader: Optional[DataLoader] = None,
+    engine: Optional[str] = None
+    ) -> QuantizedBackend:
+    """
+    Builds an INT8 quantized copy of a trained ResNet50Classifier.
+
+    Args:
+        model (ResNet50Classifier): The trained fp32 model. It is not modified.
+        mode (str): "dynamic" to quantize the head only or "static" to quantize the
+        whole network.
+        calibration_loader (DataLoader): Batches of (images, labels, keys) used to
+        calibrate activation ranges, required for "static". See
+        BPSTracksDataModule.calibration_dataloader.
+        engine (str): The quantized engine of "static", see resolve_engine.
+    Returns:
+        QuantizedBackend: An inference backend running the quantized model.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    net = _ClassifierNet(model).cpu()
+    if mode == "dynamic":
+        return QuantizedBackend(model, quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8), mode)
+    if mode != "static":
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected 'dynamic' or 'static'")
+    if calibration_loader is None:
+        raise ValueError("Static quantization needs a calibration_loader")
+
+    engine = resolve_engine(engine)
+    torch.backends.quantized.engine = engine
+    example_images = next(iter(calibration_loader))[0]
+    prepared = prepare_fx(net, get_default_qconfig_mapping(engine), (example_images,))
+    with torch.inference_mode():
+        for images, _, _ in calibration_loader:
+            prepared(images)
+    return QuantizedBackend(model, convert_fx(prepared), mode)
+
+
+def _ranks(values: npt.NDArray) -> npt.NDArray:
+    """Ranks values from 0 to N - 1, used for the Spearman rank correlation."""
+    ranks = np.empty(len(values), dtype=np.float64)
+    ranks[np.argsort(values, kind="stable")] = np.arange(len(values))
+    return ranks
+
+
+def compare_selection_agreement(
+    reference_probabilities: npt.NDArray,
+    quantized_probabilities: npt.NDArray,
+    k_values: Sequence[int] = (50, 100, 500),
+    score: str = "uncertainty_entropy"
+    ) -> Dict[str, float]:
+    """
+    Compares quantized predictions with fp32 predictions of the same samples.
+
+    Args:
+        reference_probabilities (npt.NDArray): The fp32 probabilities (N, num_classes).
+        quantized_probabilities (npt.NDArray): The quantized probabilities, same order.
+        k_values (Sequence[int]): The selection sizes to compare.
+        score (str): The uncertainty score used for the ranking.
+    Returns:
+        Dict[str, float]: `top_<k>_overlap` (fraction of the fp32 top-k also in the
+        quantized top-k) per k, the Spearman rank correlation of the scores, the
+        argmax agreement and the maximum absolute probability difference.
+    """
+    reference_scores = compute_uncertainty_scores(reference_probabilities)[score]
+    quantized_scores = compute_uncertainty_scores(quantized_probabilities)[score]
+    report = {}
+    for k in k_values:
+        k = min(k, len(reference_scores))
+        overlap = np.intersect1d(select_top_k(reference_scores, k), select_top_k(quantized_scores, k))
+        report[f"top_{k}_overlap"] = len(overlap) / max(k, 1)
+    report[f"{score}_spearman"] = float(np.corrcoef(_ranks(reference_scores), _ranks(quantized_scores))[0, 1])
+    report["argmax_agreement"] = float(np.mean(
+        np.argmax(reference_probabilities, axis=1) == np.argmax(quantized_probabilities, axis=1)))
+    report["max_abs_diff"] = float(np.abs(reference_probabilities - quantized_probabilities).max())
+    return report
@@ -3,10 +3,11 @@
 """
 import datetime
 import gc
-from typing import List, Tuple, Mapping
+from typing import Iterator, List, Optional, Tuple, Mapping
 import os
 import json
 import pathlib
+import time
 
 import numpy as np
 import numpy.typing as npt
@@ -20,35 +21,192 @@ import wandb
 from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 from tqdm import tqdm
 
+from bps_labeler.model.profiling import synchronize
+
 class ResNet50Classifier(pl.LightningModule):
-    def __init__(self, num_classes: int, pred_path: str, lr: float = 0.01, momentum: float = 0.5, decay: float = 0.01):
+    """ ResNet-50 classifier.
+
+    Single channel (grayscale) inputs are supported in two ways, selected by
+    `grayscale_stem`:
+    - "expand": the 1xHxW input is broadcast to 3 channels as a view inside the model.
+    - "sum": the first convolution takes one channel with the pretrained RGB weights
+      summed over the input channels, which gives the same output as "expand" with a
+      third of the first layer's compute.
+
+    `forward` returns logits, which training_step passes to F.cross_entropy directly;
+    only the prediction methods apply softmax. For faster training the ResNet-50 can keep
+    its weights and inputs in `channels_last` memory format, and `compile` runs its
+    forward through torch.compile. Mixed precision and gradient accumulation are set
+    on the pl.Trainer, see training.train_and_predict.
+    """
+    def __init__(self, num_classes: int, pred_path: str, lr: float = 0.01, momentum: float = 0.5, decay: float = 0.01,
+                 grayscale_stem: Optional[str] = None, pretrained: bool = True, channels_last: bool = False,
+                 compile: bool = False):
         super().__init__()
         self.num_classes = num_classes
         self.pred_path = pred_path
         self.lr = lr
         self.momentum = momentum
         self.decay = decay
+        self.grayscale_stem = grayscale_stem
+        # set by profiling.build_profiling_callbacks to time transfers and prediction steps
+        self.step_recorder = None
+        self.last_transfer_sec = 0.0
+        # set by checkpoint_registry.load_checkpoint to warm-start from a previous round
+        self.initial_optimizer_state = None
 
         # Load a pretrained ResNet-50 model
-        self.resnet50 = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
+        self.resnet50 = models.resnet50(weights=models.ResNet50_Weights.DEFAULT if pretrained else None)
         # Replace the final fully connected layer for classification
         num_ftrs = self.resnet50.fc.in_features
         self.resnet50.fc = nn.Linear(num_ftrs, self.num_classes)
 
-    def forward(self, x):
-        x = self.resnet50(x)
-        # Apply softmax to get probabilities
-        x = F.softmax(x, dim=1)
+        if grayscale_stem == "sum":
+            rgb_conv = self.resnet50.conv1
+            gray_conv = nn.Conv2d(1, rgb_conv.out_channels, kernel_size=rgb_conv.kernel_size,
+                                  stride=rgb_conv.stride, padding=rgb_conv.padding, bias=False)
+            with torch.no_grad():
+                gray_conv.weight.copy_(rgb_conv.weight.sum(dim=1, keepdim=True))
+            self.resnet50.conv1 = gray_conv
+        elif grayscale_stem not in (None, "expand"):
+            raise ValueError(f"Unknown grayscale_stem {grayscale_stem!r}, expected None, 'expand' or 'sum'")
+
+        self.channels_last = channels_last
+        if channels_last:
+            self.resnet50 = self.resnet50.to(memory_format=torch.channels_last)
+        # compiles the bound forward rather than the module, so the ResNet-50 stays registered once
+        # and state_dict keys do not change
+        self._compiled_forward = torch.compile(self.resnet50.forward) if compile else None
+
+    def _prepare_input(self, x):
+        """Broadcasts single channel images to the 3 channels of the RGB stem as a view."""
+        if self.grayscale_stem == "expand" and x.shape[1] == 1:
+            return x.expand(-1, 3, -1, -1)
         return x
 
+    def forward(self, x):
+        """Returns the class logits."""
+        x = self._prepare_input(x)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self._compiled_forward is not None:
+            return self._compiled_forward(x)
+        return self.resnet50(x)
+
+    def forward_features(self, x):
+        """Returns the 2048-d pooled features of the penultimate layer."""
+        r = self.resnet50
+        x = self._prepare_input(x)
+        x = r.maxpool(r.relu(r.bn1(r.conv1(x))))
+        x = r.layer4(r.layer3(r.layer2(r.layer1(x))))
+        return torch.flatten(r.avgpool(x), 1)
+
+    def extract_embeddings(self, dataloader: DataLoader, memmap_path: Optional[str] = None
+                           ) -> Tuple[np.ndarray, List[str]]:
+        """
+        Computes penultimate-layer embeddings for every image, e.g. for diversity selection.
+
+        Args:
+            dataloader (DataLoader): The images, over a dataset with a length.
+            memmap_path (str): If given, the float32 embeddings are streamed into a
+            np.memmap at this path instead of being held in RAM, e.g. for the 100k+
+            images of a first selection.
+        Returns:
+            Tuple[np.ndarray, List[str]]: The embeddings (N, 2048), a memmap if
+            memmap_path is given, and the filename of every row.
+        """
+        self.resnet50.eval()
+        embeddings = []
+        filenames = []
+        dataset_filenames = getattr(dataloader.dataset, "filenames", None)
+        out = None
+        if memmap_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(memmap_path)), exist_ok=True)
+            out = np.memmap(memmap_path, dtype=np.float32, mode="w+",
+                            shape=(len(dataloader.dataset), self.resnet50.fc.in_features))
+        with torch.inference_mode():
+            for batch in tqdm(dataloader, desc="Extracting embeddings"):
+                image, _, key = batch
+                features = self.forward_features(image.to(self.device, non_blocking=True)).float().cpu().numpy()
+                if out is not None:
+                    out[len(filenames):len(filenames) + len(features)] = features
+                else:
+                    embeddings.append(features)
+                filenames.extend([dataset_filenames[idx] for idx in key.tolist()] if torch.is_tensor(key) else key)
+        if out is not None:
+            out.flush()
+            return out[:len(filenames)], filenames
+        return np.concatenate(embeddings), filenames
+
+    def freeze_backbone(self):
+        """Freezes every layer except the classification head, so pooled features can
+        be cached, see feature_cache.extract_cached_features."""
+        for name, param in self.resnet50.named_parameters():
+            param.requires_grad = name.startswith("fc.")
+        # keep batch norm statistics fixed as well
+        self.resnet50.eval()
+
+    def fit_head(self, features: npt.NDArray, labels: npt.NDArray, epochs: int, batch_size: int = 256,
+                 seed: int = 42) -> List[float]:
+        """
+        Trains the classification head on cached pooled features.
+
+        Args:
+            features (npt.NDArray): The float32 features (N, 2048) of the labeled samples.
+            labels (npt.NDArray): The one hot labels (N, num_classes).
+            epochs (int): The number of passes over the features.
+            batch_size (int): The minibatch size.
+            seed (int): Seeds the minibatch order.
+        Returns:
+            List[float]: The average training loss per epoch.
+        """
+        fc = self.resnet50.fc
+        optimizer = torch.optim.SGD(fc.parameters(), lr=self.lr, momentum=self.momentum, weight_decay=self.decay)
+        features = torch.as_tensor(features, dtype=torch.float32, device=fc.weight.device)
+        labels = torch.as_tensor(labels, dtype=torch.float32, device=fc.weight.device)
+        generator = torch.Generator().manual_seed(seed)
+        epoch_losses = []
+        for _ in range(epochs):
+            losses = []
+            for batch in torch.randperm(len(features), generator=generator).split(batch_size):
+                loss = F.cross_entropy(fc(features[batch]), labels[batch])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                losses.append(loss.item())
+            epoch_losses.append(float(np.mean(losses)))
+        return epoch_losses
+
+    def predict_from_features(self, features: npt.NDArray) -> npt.NDArray:
+        """Predicts class probabilities from cached pooled features."""
+        fc = self.resnet50.fc
+        with torch.inference_mode():
+            logits = fc(torch.as_tensor(features, dtype=torch.float32, device=fc.weight.device))
+            return F.softmax(logits, dim=1).cpu().numpy()
+
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        """Copies the batch to the device, timing the copy while profiling."""
+        if self.step_recorder is None:
+            return super().transfer_batch_to_device(batch, device, dataloader_idx)
+        start = time.perf_counter()
+        batch = super().transfer_batch_to_device(batch, device, dataloader_idx)
+        synchronize(device)
+        self.last_transfer_sec = time.perf_counter() - start
+        return batch
+
     def configure_optimizers(self):
         optimizer = torch.optim.SGD(self.parameters(), lr=self.lr, momentum=self.momentum, weight_decay=self.decay)
+        if self.initial_optimizer_state is not None:
+            # carry over the momentum buffers, the hyperparameters stay those of this run
+            optimizer.load_state_dict(self.initial_optimizer_state)
+            for group in optimizer.param_groups:
+                group.update(lr=self.lr, momentum=self.momentum, weight_decay=self.decay)
         return optimizer
 
     def training_step(self, batch, batch_idx):
         image, label, filename = batch
-        output = self(image)
-        loss = F.cross_entropy(output, label)
+        logits = self(image)
+        loss = F.cross_entropy(logits, label)
         wandb.log({"train_loss" : loss})
 
         return loss
@@ -57,22 +215,73 @@ class ResNet50Classifier(pl.LightningModule):
         avg_loss = torch.stack([x['loss'] for x in outputs]).mean()
         wandb.log({"avg_train_epoch_loss": avg_loss})
 
-    def predict_active_learning(self, dataloader: DataLoader) -> List[np.ndarray]:
+    def _predict_batches(self, dataloader: DataLoader, backend=None) -> Iterator[Tuple[object, np.ndarray]]:
+        """Runs inference and yields (key, probabilities) per batch, where key is the
+        tensor of dataset indices or the tuple of filenames returned by the dataset.
+        `backend` is an optional InferenceBackend from inference_backends. With a
+        step_recorder every batch is recorded as a "predict" step."""
         self.resnet50.eval()
-        predictions = []
-        filenames = []
-        with torch.no_grad():
+        recorder = self.step_recorder
+        with torch.inference_mode():
+            fetch_start = time.perf_counter()
             for batch in tqdm(dataloader, desc="Predicting on unlabeled data"):
-                image, _, fname = batch
-                image = image.to(self.device)
-                output = self.resnet50(image)
+                fetch_end = time.perf_counter()
+                image, _, key = batch
+                image = image.to(self.device, non_blocking=True)
+                if recorder is not None:
+                    synchronize(self.device)
+                transfer_end = time.perf_counter()
+                if backend is not None:
+                    output = backend(image)
+                else:
+                    output = self(image)
                 # Apply softmax to get probabilities
-                output = F.softmax(output, dim=1)
-                predictions.append(output.cpu().detach().numpy())
+                output = F.softmax(output, dim=1).cpu().numpy()
+                if recorder is not None:
+                    recorder.record("predict", fetch_end - fetch_start, transfer_end - fetch_end,
+                                    time.perf_counter() - transfer_end, len(image), dataloader)
+                yield key, output
+                fetch_start = time.perf_counter()
+        if recorder is not None:
+            recorder.flush("predict")
 
+    def iter_active_learning_predictions(self, dataloader: DataLoader, backend=None) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Yields (filenames, probabilities) per batch so predictions can be streamed to
+        disk, e.g. with dump_lightly_prediction_batches, instead of held in memory."""
+        filenames = getattr(dataloader.dataset, "filenames", None)
+        for key, output in self._predict_batches(dataloader, backend):
+            if torch.is_tensor(key):
+                yield [filenames[idx] for idx in key.tolist()], output
+            else:
                 # unpack fname from tuple b/c of batch size
-                fname_list = [f for f in fname]
+                yield list(key), output
+
+    def predict_active_learning(self, dataloader: DataLoader, backend=None) -> Tuple[np.ndarray, List[str]]:
+        """Predicts class probabilities for every sample of the dataloader.
+
+        For map-style datasets returning dataset indices (see
+        BPSTracksDataModule.active_learn_dataloader) the probabilities are written
+        into a preallocated (N, num_classes) array by dataset position and filenames
+        are taken from the dataset rather than the batches.
+
+        `backend` is an optional InferenceBackend, see build_inference_backend.
+        """
+        dataset = dataloader.dataset
+        if not hasattr(dataset, "filenames"):
+            predictions = []
+            filenames = []
+            for fname_list, output in self.iter_active_learning_predictions(dataloader, backend):
+                predictions.append(output)
                 filenames.extend(fname_list)
+            return np.concatenate(predictions), filenames
 
-        #self.save_predictions(filenames, predictions)
-        return np.concatenate(predictions), filenames
+        predictions = np.empty((len(dataset), self.num_classes), dtype=np.float32)
+        filename_to_idx = None
+        for key, output in self._predict_batches(dataloader, backend):
+            if torch.is_tensor(key):
+                predictions[key.numpy()] = output
+            else:
+                if filename_to_idx is None:
+                    filename_to_idx = {fname: idx for idx, fname in enumerate(dataset.filenames)}
+                predictions[[filename_to_idx[fname] for fname in key]] = output
+        return predictions, list(dataset.filenames)
@@ -0,0 +1,181 @@
+""" Shared setup, training and prediction of an active learning round, used by the
+training scripts and the round pipeline (python -m bps_labeler).
+"""
+import os
+import pathlib
+from typing import Dict, List, Union
+
+import pytorch_lightning as pl
+import wandb
+
+from bps_labeler.bps_utils.prediction_store import export_lightly_predictions, save_predictions
+from bps_labeler.dataloader.dataset import BPSTracksDataModule
+from bps_labeler.model.checkpoint_registry import (CheckpointRegistry, compatibility_key, load_checkpoint,
+                                                   save_checkpoint)
+from bps_labeler.model.feature_cache import predict_with_cached_features, train_head_with_cached_features
+from bps_labeler.model.inference_backends import build_inference_backend
+from bps_labeler.model.profiling import build_profiling_callbacks
+from bps_labeler.model.resnet50 import ResNet50Classifier
+
+
+def build_datamodule(config, annotation_fpath: Union[str, List[str], None] = None) -> BPSTracksDataModule:
+    """
+    Instantiates the BPSTracksDataModule from the configuration.
+
+    Args:
+        config (BPSTracksConfig): The configuration.
+        annotation_fpath (Union[str, List[str]]): The Label Studio export(s), by default
+        config.ls_annotation_fname in config.ls_annotation_dir.
+    Returns:
+        BPSTracksDataModule: The data module, before prepare_data and setup.
+    """
+    if annotation_fpath is None:
+        annotation_fpath = os.path.join(config.ls_annotation_dir, config.ls_annotation_fname)
+    return BPSTracksDataModule(
+        annotation_fpath=annotation_fpath,
+        full_train_fpath=os.path.join(config.data_dir, 'full_train.json'),
+        batch_size=config.batch_size,
+        train_path=config.train_dir,
+        image_size=config.image_size,
+        num_workers=config.num_workers,
+        cache_dir=config.image_cache_dir,
+        cache_max_bytes=config.image_cache_max_bytes,
+        grayscale=config.grayscale,
+        train_shard_dir=config.train_shard_dir,
+        active_learn_shard_dir=config.active_learn_shard_dir,
+        inference_batch_size=config.inference_batch_size,
+        prefetch_factor=config.prefetch_factor,
+        profile=config.profile
+        )
+
+
+def build_model(config, pretrained: bool = True) -> ResNet50Classifier:
+    """Instantiates the ResNet50Classifier from the configuration."""
+    return ResNet50Classifier(
+        config.num_classes,
+        config.save_pred_dir,
+        config.lr,
+        config.momentum,
+        config.decay,
+        grayscale_stem=config.grayscale_stem if config.grayscale else None,
+        pretrained=pretrained,
+        channels_last=config.channels_last,
+        compile=config.compile_model,
+        )
+
+
+def train_and_predict(config, annotation_fpath: Union[str, List[str]], predict: bool = True) -> Dict[str, str]:
+    """
+    Trains the model on the labeled samples, saves and registers its weights and
+    optionally predicts on the full training set, storing and exporting the predictions
+    for Lightly.
+
+    With config.warm_start, training starts from the newest compatible checkpoint
+    trained on a strict subset of the exports' labels, optimizer state included, and every epoch of a
+    full fine-tune covers the samples labeled since plus config.replay_ratio replayed old samples per
+    new one, see checkpoint_registry.py.
+
+    Args:
+        config (BPSTracksConfig): The configuration.
+        annotation_fpath (Union[str, List[str]]): The Label Studio export(s) to train on.
+        predict (bool): Whether to predict on the full training set afterwards.
+    Returns:
+        Dict[str, str]: The saved `model_path`, the `warm_start_path` of the checkpoint
+        training started from, if any, and, if predict, the prediction store `entry_dir`.
+    """
+    pl.seed_everything(config.seed)
+    annotation_fpaths = [annotation_fpath] if isinstance(annotation_fpath, str) else list(annotation_fpath)
+    registry = CheckpointRegistry(config.save_model_dir)
+    parent = None
+    if config.warm_start:
+        parent = registry.latest_compatible(compatibility_key(config), annotation_fpaths,
+                                            os.path.join(config.data_dir, 'full_train.json'))
+
+    wandb.init(
+        project=config.wandb_project_name,
+        dir=config.save_wandb_dir,
+        mode=config.wandb_mode,
+        config=
+        {
+            "architecture":"resnet50",
+            "learning_rate":config.lr,
+            "batch_size":config.batch_size,
+            "accumulate_grad_batches":config.accumulate_grad_batches,
+            "precision":config.precision,
+            "epochs":config.epochs,
+            "warm_start_from":parent.weights_path if parent is not None else None,
+            "replay_ratio":config.replay_ratio
+        }
+    )
+
+    # Instantiate data module
+    bps_tracks_dm = build_datamodule(config, annotation_fpaths)
+    # collect labels and filenames from Label Studio output files
+    bps_tracks_dm.prepare_data()
+    labels = {pathlib.Path(sample["path"]).name: sample["label"] for sample in bps_tracks_dm.sample_list}
+
+    # Instantiate model, from the previous round's checkpoint if there is one
+    model = build_model(config, pretrained=parent is None)
+    num_new = None
+    if parent is not None:
+        previous_labels = load_checkpoint(parent, model)["labels"]
+        new_filenames = [filename for filename, label in labels.items() if previous_labels.get(filename) != label]
+        num_new = len(new_filenames)
+        print(f"Warm-starting from {parent.weights_path}, {num_new} of {len(labels)} samples are new.")
+        bps_tracks_dm.configure_replay(new_filenames, config.replay_ratio, config.seed)
+    # setup data for training from annotations file
+    bps_tracks_dm.setup(config.train_stage)
+    # opt-in step timings and torch.profiler traces
+    callbacks = build_profiling_callbacks(config, bps_tracks_dm, model)
+
+    optimizer_state = None
+    if config.frozen_backbone:
+        # Train only the classification head on cached backbone features
+        for loss in train_head_with_cached_features(model, bps_tracks_dm, config.feature_cache_dir,
+                                                    config.epochs, config.seed):
+            wandb.log({"avg_train_epoch_loss": loss})
+    else:
+        # Instantiate trainer
+        trainer = pl.Trainer(
+            devices=1,
+            max_epochs=config.epochs,
+            accelerator=config.accelerator,
+            precision=config.precision,
+            accumulate_grad_batches=config.accumulate_grad_batches,
+            callbacks=callbacks
+            )
+
+        # Train model
+        trainer.fit(model, bps_tracks_dm)
+        optimizer_state = trainer.optimizers[0].state_dict()
+
+    # Save model weights and the training state, registered for the next round to warm-start from
+    entry = save_checkpoint(registry, model, optimizer_state, labels, config, annotation_fpaths,
+                            bps_tracks_dm.full_train_json_path, parent, num_new)
+    model_path = entry.weights_path
+    outputs = {"model_path": model_path}
+    if parent is not None:
+        outputs["warm_start_path"] = parent.weights_path
+    if not predict:
+        return outputs
+
+    if config.frozen_backbone:
+        # re-score the full training set from cached features, only new images need a forward pass
+        predictions, filenames = predict_with_cached_features(model, bps_tracks_dm, config.feature_cache_dir)
+    else:
+        # Active Learn using trained model on sample on the full training set
+        bps_tracks_dm.setup(config.active_learning_stage)
+
+        # fetch predictions
+        calibration_loader = None
+        if config.inference_backend == 'int8_static':
+            calibration_loader = bps_tracks_dm.calibration_dataloader(config.num_calibration_images, config.seed)
+        backend = build_inference_backend(model, config, calibration_loader)
+        predictions, filenames= model.predict_active_learning(bps_tracks_dm.active_learn_dataloader(), backend)
+    # store predictions under the hashes of the model weights and full_train.json
+    outputs["entry_dir"] = save_predictions(config.prediction_store_dir, filenames, predictions, model_path,
+                                            bps_tracks_dm.full_train_json_path)
+
+    # dump predictions, only files whose predictions changed since the last export are written
+    export_lightly_predictions(outputs["entry_dir"], config.save_pred_dir)
+    return outputs
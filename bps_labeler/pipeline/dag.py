@@ -0,0 +1,191 @@
+""" A small DAG runner with content-hashed step caching.
+
+A Step declares the paths it reads and writes. Before a step runs, its key is
+computed from its name, its parameters, the hashes of its input paths and the output
+hashes of the steps it depends on. If the key and the hashes of its outputs match
+the last successful run recorded in the state file, the step is skipped. Steps whose
+dependencies have finished run concurrently on a thread pool, and the wall time and
+outcome of every step are appended to a JSON-lines log.
+
+Files are hashed by content. Directories, e.g. 100k images, are hashed from their
+listing of names, sizes and modification times.
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+STATE_FNAME = "steps.json"
+LOG_FNAME = "steps.jsonl"
+
+
+@dataclass
+class Step:
+    """ A pipeline step.
+
+    Attributes:
+        name (str): The unique name of the step.
+        run (Callable[[], None]): Does the work, raising on failure.
+        deps (List[str]): The names of the steps that must finish first.
+        inputs (List[str]): The files and directories the step reads.
+        outputs (List[str]): The files and directories the step writes.
+        params (Dict): JSON serializable settings that change the step's result.
+        always_run (bool): Never skip, e.g. for steps with remote side effects only.
+    """
+    name: str
+    run: Callable[[], None]
+    deps: List[str] = field(default_factory=list)
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    params: Dict = field(default_factory=dict)
+    always_run: bool = False
+
+
+@dataclass
+class StepResult:
+    """ The outcome of a step: "ran", "skipped", "failed" or "blocked" by a failed dependency."""
+    name: str
+    status: str
+    wall_sec: float = 0.0
+    error: Optional[str] = None
+
+
+def _hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_dir(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with os.scandir(path) as entries:
+        listing = sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries
+                         if not entry.name.startswith("."))
+    digest.update(json.dumps(listing).encode())
+    return digest.hexdigest()
+
+
+def hash_paths(paths: Sequence[str]) -> str:
+    """Hashes files by content and directories by listing; missing paths hash as missing."""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        if os.path.isdir(path):
+            path_hash = "dir:" + _hash_dir(path)
+        elif os.path.isfile(path):
+            path_hash = "file:" + _hash_file(path)
+        else:
+            path_hash = "missing"
+        digest.update(f"{os.path.abspath(path)}={path_hash}\n".encode())
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """ Runs steps in dependency order, skipping steps whose inputs are unchanged.
+
+    Args:
+        steps (List[Step]): The steps; dependencies must be among them.
+        state_dir (str): The directory for the step state and the timing log.
+        max_workers (int): The maximum number of steps running at once.
+    """
+    def __init__(self, steps: List[Step], state_dir: str, max_workers: int = 4):
+        self.steps = {step.name: step for step in steps}
+        for step in steps:
+            unknown = [dep for dep in step.deps if dep not in self.steps]
+            if unknown:
+                raise ValueError(f"Step {step.name!r} depends on unknown steps {unknown}")
+        self.state_dir = state_dir
+        self.max_workers = max_workers
+        self.state_path = os.path.join(state_dir, STATE_FNAME)
+        self.log_path = os.path.join(state_dir, LOG_FNAME)
+        self.state: Dict[str, Dict] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+
+    def _key(self, step: Step) -> str:
+        upstream = {dep: self.state.get(dep, {}).get("output_hash") for dep in sorted(step.deps)}
+        payload = json.dumps({"name": step.name, "params": step.params, "upstream": upstream}, sort_keys=True)
+        return hashlib.blake2b(f"{payload}|{hash_paths(step.inputs)}".encode(), digest_size=16).hexdigest()
+
+    def _is_fresh(self, step: Step, key: str) -> bool:
+        recorded = self.state.get(step.name)
+        if step.always_run or recorded is None or recorded.get("key") != key:
+            return False
+        return all(os.path.exists(path) for path in step.outputs) and \
+            recorded.get("output_hash") == hash_paths(step.outputs)
+
+    def _execute(self, step: Step, force: bool) -> Tuple[StepResult, Optional[Dict]]:
+        """Runs a step unless it is fresh, returning its result and new state entry."""
+        key = self._key(step)
+        if not force and self._is_fresh(step, key):
+            return StepResult(step.name, "skipped"), None
+        start = time.perf_counter()
+        try:
+            step.run()
+        except Exception as e:
+            return StepResult(step.name, "failed", time.perf_counter() - start, repr(e)), None
+        wall_sec = time.perf_counter() - start
+        return StepResult(step.name, "ran", wall_sec), {
+            "key": key, "output_hash": hash_paths(step.outputs), "wall_sec": wall_sec,
+            "finished": datetime.now().isoformat(timespec="seconds")}
+
+    def _record(self, result: StepResult) -> None:
+        """Appends a result to the log and saves the state, from the main thread only."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps({"time": datetime.now().isoformat(timespec="seconds"), "step": result.name,
+                                "status": result.status, "wall_sec": round(result.wall_sec, 3),
+                                "error": result.error}) + "\n")
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_path, self.state_path)
+
+    def run(self, force: Sequence[str] = ()) -> Dict[str, StepResult]:
+        """
+        Runs all steps, concurrently where dependencies allow.
+
+        Args:
+            force (Sequence[str]): Names of steps to run even if their inputs are unchanged.
+        Returns:
+            Dict[str, StepResult]: The result of every step.
+        Raises:
+            ValueError: If force names a step that is not in the pipeline.
+        """
+        unknown = [name for name in force if name not in self.steps]
+        if unknown:
+            raise ValueError(f"Cannot force unknown steps {unknown}, expected some of {list(self.steps)}")
+        results: Dict[str, StepResult] = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(results) < len(self.steps):
+                num_results = len(results)
+                for name, step in self.steps.items():
+                    if name in results or name in running.values():
+                        continue
+                    dep_results = [results.get(dep) for dep in step.deps]
+                    if any(result is not None and result.status in ("failed", "blocked") for result in dep_results):
+                        results[name] = StepResult(name, "blocked")
+                        self._record(results[name])
+                    elif all(result is not None for result in dep_results):
+                        running[executor.submit(self._execute, step, name in force)] = name
+                if not running:
+                    if len(results) == num_results:
+                        raise ValueError(f"Dependency cycle among {sorted(set(self.steps) - set(results))}")
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], state_entry = future.result()
+                    if state_entry is not None:
+                        self.state[name] = state_entry
+                    self._record(results[name])
+                    print(f"[{results[name].status}] {name} ({results[name].wall_sec:.1f}s)"
+                          + (f": {results[name].error}" if results[name].error else ""))
+        return results
@@ -0,0 +1,133 @@
+""" An active learning round as a DAG of pipeline steps.
+
+Round 0 starts labeling:
+
+    upload_training_set
+    first_selection -> download_selection
+
+Round k >= 1 trains on the Label Studio exports of rounds 0 .. k-1 and selects the
+samples to label next:
+
+    upload_training_set
+    train -> upload_predictions
+    train -> active_learning_selection -> download_selection
+
+Uploads run alongside training and downloads. If the selection service reads the
+uploaded datasource (Lightly), selections wait for the uploads.
+"""
+import json
+import os
+from typing import List
+
+from bps_labeler.bps_utils.download_utils import download_samples
+from bps_labeler.bps_utils.storage_utils import StorageBackend
+from bps_labeler.bps_utils.sync_utils import sync_predictions, sync_training_set
+from bps_labeler.pipeline.dag import Step
+from bps_labeler.pipeline.services import AnnotationDirectory, SelectionService
+
+# config fields that change the result of training
+TRAINING_PARAMS = ("image_size", "grayscale", "grayscale_stem", "num_classes", "batch_size", "lr", "momentum",
+                   "decay", "epochs", "precision", "accumulate_grad_batches", "seed", "frozen_backbone",
+                   "warm_start", "replay_ratio", "inference_backend")
+
+
+def build_round_steps(
+    config,
+    round_idx: int,
+    selection: SelectionService,
+    storage: StorageBackend,
+    destination_name: str,
+    annotations: AnnotationDirectory,
+    n_samples: int = 50
+    ) -> List[Step]:
+    """
+    Builds the steps of an active learning round.
+
+    Args:
+        config (BPSTracksConfig): The configuration.
+        round_idx (int): The round, 0 for the first selection.
+        selection (SelectionService): Selects the samples to label.
+        storage (StorageBackend): The Lightly datasource bucket or a local stand-in.
+        destination_name (str): Names the sync manifests of the storage destination.
+        annotations (AnnotationDirectory): The Label Studio exports of earlier rounds.
+        n_samples (int): The number of samples to select.
+    Returns:
+        List[Step]: The steps, see dag.Pipeline.
+    """
+    full_train_fpath = os.path.join(config.data_dir, 'full_train.json')
+    train_set_dir = os.path.join(config.data_dir, 'train_set')
+    tag_name = f"round-{round_idx}"
+    selection_fpath = os.path.join(config.data_dir, 'selections', f"{tag_name}.json")
+    samples_dir = os.path.join(config.data_dir, 'samples_for_labeling')
+    selection_deps = ["upload_training_set"] if selection.reads_datasource else []
+
+    def download():
+        with open(selection_fpath, "r") as f:
+            download_samples(json.load(f), samples_dir)
+
+    steps = [
+        Step(
+            name="upload_training_set",
+            run=lambda: sync_training_set(storage, config, destination_name),
+            inputs=[os.path.join(train_set_dir, 'data'), os.path.join(train_set_dir, 'metadata'),
+                    os.path.join(config.data_dir, 'schema.json')],
+            params={"destination": destination_name},
+        ),
+        Step(
+            name="download_selection",
+            run=download,
+            deps=["first_selection" if round_idx == 0 else "active_learning_selection"],
+            inputs=[selection_fpath],
+            outputs=[samples_dir],
+        ),
+    ]
+    if round_idx == 0:
+        steps.append(Step(
+            name="first_selection",
+            run=lambda: selection.first_selection(n_samples, tag_name),
+            deps=selection_deps,
+            inputs=[full_train_fpath, os.path.join(train_set_dir, 'metadata')],
+            outputs=[selection_fpath],
+            params={"n_samples": n_samples, "service": type(selection).__name__},
+        ))
+        return steps
+
+    annotation_fpaths = annotations.exports(round_idx)
+    missing = [fpath for fpath in annotation_fpaths if not os.path.exists(fpath)]
+    if missing:
+        raise FileNotFoundError(f"Round {round_idx} trains on the Label Studio exports of all earlier rounds, "
+                                f"missing {missing}")
+    train_record_fpath = os.path.join(config.pipeline_state_dir, tag_name, 'train.json')
+
+    def train():
+        from bps_labeler.model.training import train_and_predict
+        outputs = train_and_predict(config, annotation_fpaths, predict=True)
+        os.makedirs(os.path.dirname(train_record_fpath), exist_ok=True)
+        with open(train_record_fpath, "w") as f:
+            json.dump({"annotation_fpaths": annotation_fpaths, **outputs}, f, indent=4)
+
+    steps += [
+        Step(
+            name="train",
+            run=train,
+            inputs=annotation_fpaths + [full_train_fpath],
+            outputs=[train_record_fpath],
+            params={name: getattr(config, name) for name in TRAINING_PARAMS},
+        ),
+        Step(
+            name="upload_predictions",
+            run=lambda: sync_predictions(storage, config, destination_name),
+            deps=["train"],
+            inputs=[config.save_pred_dir],
+            params={"destination": destination_name},
+        ),
+        Step(
+            name="active_learning_selection",
+            run=lambda: selection.active_learning_selection(n_samples, tag_name, annotation_fpaths),
+            deps=["train"] + (["upload_predictions"] + selection_deps if selection.reads_datasource else []),
+            inputs=annotation_fpaths,
+            outputs=[selection_fpath],
+            params={"n_samples": n_samples, "service": type(selection).__name__},
+        ),
+    ]
+    return steps
@@ -0,0 +1,146 @@
+""" External services used by an active learning round, behind small interfaces so a
+round can run against Lightly and S3 or entirely against local stand-ins.
+
+- SelectionService picks samples to label: LightlySelectionService schedules Lightly
+  worker runs, LocalSelectionService runs the same selections offline.
+- AnnotationDirectory provides the Label Studio exports of previous rounds.
+- Uploads go through a storage_utils.StorageBackend: S3Backend for the Lightly
+  datasource bucket or LocalDirectoryBackend as a stand-in.
+"""
+import os
+from typing import List
+
+from bps_labeler.bps_utils.active_learning_utils import save_selection, select_samples, to_filename_url_mappings
+from bps_labeler.bps_utils.label_studio_utils import load_label_index
+
+
+class SelectionService:
+    """ Interface of a service selecting the samples to label next.
+
+    `reads_datasource` tells whether selections read the uploaded datasource, so the
+    uploads must finish before a selection starts.
+    """
+    reads_datasource = False
+
+    def first_selection(self, n_samples: int, tag_name: str) -> str:
+        """Selects diverse samples balanced on particle_type and returns the path of
+        the saved selection, see active_learning_utils.save_selection."""
+        raise NotImplementedError
+
+    def active_learning_selection(self, n_samples: int, tag_name: str, annotation_fpaths: List[str]) -> str:
+        """Selects uncertain samples from the latest predictions, excluding the samples
+        labeled in annotation_fpaths, and returns the path of the saved selection."""
+        raise NotImplementedError
+
+
+class LocalSelectionService(SelectionService):
+    """ Offline selections with the ImageNet pretrained ResNet-50 embeddings and the
+    prediction store, mirroring the Lightly worker configurations."""
+    def __init__(self, config):
+        self.config = config
+        self.selection_dir = os.path.join(config.data_dir, 'selections')
+
+    def first_selection(self, n_samples: int, tag_name: str) -> str:
+        import torch
+
+        from bps_labeler.bps_utils.coreset_utils import load_metadata_values, select_diverse_balanced
+        from bps_labeler.model.training import build_datamodule, build_model
+
+        config = self.config
+        bps_tracks_dm = build_datamodule(config)
+        bps_tracks_dm.setup(config.active_learning_stage)
+        model = build_model(config)
+        model.to('cuda' if torch.cuda.is_available() else 'cpu')
+        # streamed to disk, so RAM stays bounded for 100k+ images
+        embeddings, filenames = model.extract_embeddings(bps_tracks_dm.active_learn_dataloader(),
+                                                         os.path.join(config.data_dir, 'embeddings.f32'))
+
+        metadata_dir = os.path.join(config.data_dir, 'train_set', 'metadata')
+        selected = select_diverse_balanced(
+            embeddings,
+            filenames,
+            n_samples,
+            metadata_values=load_metadata_values(metadata_dir, filenames, key="particle_type"),
+            balance_target={"Fe": 0.5, "X-ray": 0.5},
+            seed=config.seed
+        )
+        return save_selection(to_filename_url_mappings(selected, config.train_dir), self.selection_dir, tag_name)
+
+    def active_learning_selection(self, n_samples: int, tag_name: str, annotation_fpaths: List[str]) -> str:
+        from bps_labeler.bps_utils.prediction_store import latest_entry_dir, load_predictions
+
+        config = self.config
+        table = load_predictions(latest_entry_dir(config.prediction_store_dir))
+        selected = select_samples(
+            table.filenames.tolist(),
+            table.probs,
+            n_samples,
+            score="uncertainty_entropy",
+            strategy="weights",
+            exclude=load_label_index(annotation_fpaths),
+            seed=config.seed
+        )
+        return save_selection(to_filename_url_mappings(selected, config.train_dir), self.selection_dir, tag_name)
+
+
+class LightlySelectionService(SelectionService):
+    """ Selections by Lightly worker runs on the Lightly datasource, exported from the
+    latest tag afterwards."""
+    reads_datasource = True
+
+    def __init__(self, client, config):
+        self.client = client
+        self.config = config
+        self.selection_dir = os.path.join(config.data_dir, 'selections')
+
+    @classmethod
+    def from_environment(cls, config, dataset_name: str = "nasa-bps-microscopy", create_dataset: bool = False):
+        """Configures the Lightly client and datasources from the `.env` file."""
+        from bps_labeler.bps_utils import lightly_utils
+
+        lightly_utils.load_environment_variables()
+        client = lightly_utils.configure_lightly_client()
+        if create_dataset:
+            lightly_utils.create_lightly_dataset(client, datasetname=dataset_name)
+        else:
+            lightly_utils.set_lightly_dataset(client, datasetname=dataset_name)
+        lightly_utils.configure_input_datasource(client)
+        lightly_utils.configure_lightly_datasource(client)
+        return cls(client, config)
+
+    def _save_latest_tag(self, tag_name: str) -> str:
+        from bps_labeler.bps_utils import lightly_utils
+
+        latest_tag = lightly_utils.get_latest_tag(self.client)
+        return save_selection(lightly_utils.export_filenames_and_urls(self.client, latest_tag.id),
+                              self.selection_dir, tag_name)
+
+    def first_selection(self, n_samples: int, tag_name: str) -> str:
+        from bps_labeler.bps_utils import lightly_utils
+
+        result = lightly_utils.run_lightly_worker(self.client, n_samples, log_path=self.config.worker_run_log_path)
+        if not result.succeeded:
+            raise RuntimeError(f"Lightly worker run ended in state {result.state}: {result.message}")
+        return self._save_latest_tag(tag_name)
+
+    def active_learning_selection(self, n_samples: int, tag_name: str, annotation_fpaths: List[str]) -> str:
+        from bps_labeler.bps_utils import lightly_utils
+
+        result = lightly_utils.run_lightly_worker_active_learning(self.client, n_samples,
+                                                                  log_path=self.config.worker_run_log_path)
+        if not result.succeeded:
+            raise RuntimeError(f"Lightly worker run ended in state {result.state}: {result.message}")
+        return self._save_latest_tag(tag_name)
+
+
+class AnnotationDirectory:
+    """ Label Studio exports saved by hand to a directory, one per labeling round,
+    named by `fname_template`, e.g. annotation-0.json, annotation-1.json."""
+    def __init__(self, annotation_dir: str, fname_template: str = 'annotation-{}.json'):
+        self.annotation_dir = annotation_dir
+        self.fname_template = fname_template
+
+    def exports(self, num_rounds: int) -> List[str]:
+        """Returns the exports of the first num_rounds labeling rounds, in order."""
+        return [os.path.join(self.annotation_dir, self.fname_template.format(round_idx))
+                for round_idx in range(num_rounds)]
@@ -0,0 +1,25 @@
+"""
+This script downloads the high dose (Gy >= 0.82), 4 hour post exposure subset of the
+BPS microscopy training data. meta.csv is filtered in memory and the matching images
+are fetched concurrently over a pooled S3 client. Rerunning the script only
+downloads images that are missing or incomplete.
+"""
+import pyprojroot
+root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+import os
+import sys
+sys.path.append(str(root))
+from bps_labeler.bps_utils.fetch_utils import fetch_filtered_dataset
+from bps_labeler.bps_utils.storage_utils import S3Backend
+
+def main():
+    bucket_name = "nasa-bps-training-data"
+    source_dir = "Microscopy/train"
+    local_dir = os.path.join(root, "data_Gyhi_4hr")
+    filter_expression = "dose_Gy >= 0.82 and hr_post_exposure == 4"
+
+    backend = S3Backend(bucket_name, prefix=source_dir)
+    fetch_filtered_dataset(backend, local_dir, filter_expression, meta_csv_key="meta.csv")
+
+if __name__ == "__main__":
+    main()
@@ -17,37 +17,28 @@ root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
 import sys
 sys.path.append(str(root))
 from bps_labeler.bps_utils.data_utils import (
-    convert_16bit_tif_to_8bit_tif_to_jpg,
+    convert_tif_dir_to_jpg,
     generate_meta_json_per_from_csv,
     generate_lightly_schema_json,
     setup_data
 )
 import os
-import numpy as np
 
 def main():
 
     data_dir = os.path.join(root, 'data_Gyhi_4hr')
-    for file in os.listdir(data_dir):
-        if file.endswith(".tif"):
-            filestem = os.path.splitext(file)[0]
-            jpg_file_name = f'{filestem}.jpg'
-            # call the function to convert the 16-bit tif to 8-bit tif to jpg
-            convert_16bit_tif_to_8bit_tif_to_jpg(tif_file_path=data_dir,
-                                          tif_file_name=file,
-                                          jpg_file_save_path=data_dir,
-                                          jpg_file_save_name=jpg_file_name
-                                          )
-    
+    # convert the 16-bit tifs to 8-bit jpgs in parallel, skipping jpgs left by a
+    # previous run that are already up to date
+    convert_tif_dir_to_jpg(tif_dir=data_dir, jpg_dir=data_dir)
+
     csv_file_name = 'filtered_meta.csv'
 
     generate_meta_json_per_from_csv(csv_file_name=csv_file_name,
                                     csv_file_path=data_dir,
                                     json_file_path=data_dir)
     generate_lightly_schema_json(path_to_save_file=data_dir)
-    SEED = 42
-    np.random.seed(SEED)
-    setup_data(data_dir)
+    # the split is decided by a stable hash of each filestem, stratified by particle type
+    setup_data(data_dir, val_fraction=0.01, stratify_by='particle_type', csv_file_name=csv_file_name)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
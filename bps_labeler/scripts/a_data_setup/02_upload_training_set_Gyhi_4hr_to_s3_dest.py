@@ -0,0 +1,23 @@
+"""
+This script uploads the training images, their Lightly metadata and schema.json to
+the Lightly datasource bucket. Only files that are new or changed since the last
+upload are sent; see bps_labeler/bps_utils/sync_utils.py.
+"""
+import pyprojroot
+root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+import sys
+sys.path.append(str(root))
+from bps_labeler.bps_utils.bps_tracks_config import BPSTracksConfig
+from bps_labeler.bps_utils.storage_utils import S3Backend
+from bps_labeler.bps_utils.sync_utils import sync_training_set
+
+def main():
+    config = BPSTracksConfig()
+    dest_bucket_name = "ai4ls-bps-training-data"
+
+    # Upload train_set/data to the data directory and train_set/metadata and schema.json
+    # to the lightly/.lightly/metadata directory of the S3 destination bucket
+    sync_training_set(S3Backend(dest_bucket_name), config, dest_bucket_name)
+
+if __name__ == "__main__":
+    main()
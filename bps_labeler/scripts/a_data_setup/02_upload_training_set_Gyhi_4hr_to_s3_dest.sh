@@ -1,20 +1,7 @@
 #!/bin/bash
 
-local_dir="data_Gyhi_4hr"
-local_train_dir="train_set"
-local_train_data_dir="data"
-local_train_meta_dir="metadata"
-dest_bucket_name="ai4ls-bps-training-data"
-destination_s3_data_dir="data"
-destination_s3_metadata_dir="lightly/.lightly/metadata"
-
-
-# Upload the train_set/data to the S3 destination bucket in the data directory
-aws s3 cp ${local_dir}/train_set/data s3://${dest_bucket_name}/${destination_s3_data_dir} --recursive --exclude "*" --include "*.jpg"
-
-# Upload the train_set/metadata to the S3 destination bucket in the lightly/.lightly/metadata directory
-aws s3 cp ${local_dir}/train_set/metadata s3://${dest_bucket_name}/${destination_s3_metadata_dir} --recursive --exclude "*" --include "*.json"
-
-# Upload local_dir/schema.json to the S3 destination bucket in the lightly/.lightly/metadata directory
-# with the same filename
-aws s3 cp ${local_dir}/schema.json s3://${dest_bucket_name}/${destination_s3_metadata_dir}/schema.json
\ No newline at end of file
+# Upload train_set/data, train_set/metadata and schema.json of data_Gyhi_4hr to the
+# Lightly datasource bucket, skipping files unchanged since the last upload.
+# See 02_upload_training_set_Gyhi_4hr_to_s3_dest.py.
+script_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+python "${script_dir}/02_upload_training_set_Gyhi_4hr_to_s3_dest.py"
@@ -0,0 +1,37 @@
+"""
+This script packs the images listed in a manifest such as `full_train.json` or a
+`<timestamp>_train.json` written by BPSTracksDataModule.prepare_data into fixed-size
+tar shards with an index, for sequential reads with BPSTracksShardDataset:
+
+    python bps_labeler/scripts/a_data_setup/pack_shards.py \
+        data_Gyhi_4hr/full_train.json data_Gyhi_4hr/shards/full_train
+
+Point BPSTracksConfig.train_shard_dir / active_learn_shard_dir at the output
+directory to train or predict from the shards.
+"""
+import pyprojroot
+root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+import argparse
+import json
+import os
+import sys
+sys.path.append(str(root))
+from bps_labeler.dataloader.shards import write_shards
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="JSON list of samples with a 'path' and an optional 'label'")
+    parser.add_argument("shard_dir", help="directory to write the shards and index.json to")
+    parser.add_argument("--metadata-dir", default=os.path.join(root, "data_Gyhi_4hr", "train_set", "metadata"),
+                        help="directory with the Lightly metadata JSON of each image")
+    parser.add_argument("--max-shard-mb", type=int, default=64)
+    args = parser.parse_args()
+
+    with open(args.manifest, "r") as f:
+        sample_list = json.load(f)
+    index = write_shards(sample_list, args.shard_dir, metadata_dir=args.metadata_dir,
+                         max_shard_bytes=args.max_shard_mb * 1024 * 1024)
+    print(f"Packed {index['num_samples']} samples into {len(index['shards'])} shards in {args.shard_dir}")
+
+if __name__ == "__main__":
+    main()
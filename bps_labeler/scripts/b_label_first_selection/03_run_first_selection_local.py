@@ -0,0 +1,32 @@
+"""
+This module selects the first batch of samples for labeling offline, without the
+Lightly worker. It embeds the training set with the ImageNet pretrained ResNet-50,
+runs k-center greedy selection on the embeddings balanced on the metadata value
+"particle_type", and writes the selection in the format consumed by
+04_download_samples.py:
+
+    python bps_labeler/scripts/b_label_first_selection/04_download_samples.py \
+        --selection data_Gyhi_4hr/selections/first-selection.json
+"""
+import pyprojroot
+root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+import json
+import sys
+sys.path.append(str(root))
+from bps_labeler.bps_utils.bps_tracks_config import BPSTracksConfig
+from bps_labeler.pipeline.services import LocalSelectionService
+
+# Main function to execute the steps
+def main():
+    n_samples = 50
+    tag_name = "first-selection"
+    config = BPSTracksConfig()
+
+    selection_fpath = LocalSelectionService(config).first_selection(n_samples, tag_name)
+    # fewer than n_samples remain selectable once most of the pool is labeled
+    with open(selection_fpath, "r") as f:
+        num_selected = len(json.load(f))
+    print(f"Selected {num_selected} samples, saved to {selection_fpath}")
+
+if __name__ == "__main__":
+    main()
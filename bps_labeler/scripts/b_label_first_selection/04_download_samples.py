@@ -10,22 +10,34 @@ sys.path.append(str(root))
 from bps_labeler.bps_utils.lightly_utils import (
     create_lightly_client,
     get_latest_tag,
-    export_filenames_and_urls,
-    download_files
+    export_filenames_and_urls
 )
+from bps_labeler.bps_utils.download_utils import download_samples
+import argparse
+import json
 import pathlib
 from dotenv import load_dotenv
 load_dotenv(os.path.join(root,".env"))
 
 def main():
-    token = os.environ.get("MY_LIGHTLY_TOKEN")
-    lightly_dataset_name = "nasa-bps-microscopy"
-
-    client = create_lightly_client(token, lightly_dataset_name)
-    latest_tag = get_latest_tag(client)
-    # filename_url_mappings is a list of entries with their filenames and read URLs.
-    # # For example, [{"fileName": "image1.png", "readUrl": "https://..."}]
-    filename_url_mappings = export_filenames_and_urls(client, latest_tag.id)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--selection", default=None,
+                        help="selection JSON written by a local selection instead of the latest Lightly tag")
+    args = parser.parse_args()
+
+    if args.selection is not None:
+        # filename_url_mappings saved by a local selection with file:// read URLs
+        with open(args.selection, "r") as f:
+            filename_url_mappings = json.load(f)
+    else:
+        token = os.environ.get("MY_LIGHTLY_TOKEN")
+        lightly_dataset_name = "nasa-bps-microscopy"
+
+        client = create_lightly_client(token, lightly_dataset_name)
+        latest_tag = get_latest_tag(client)
+        # filename_url_mappings is a list of entries with their filenames and read URLs.
+        # # For example, [{"fileName": "image1.png", "readUrl": "https://..."}]
+        filename_url_mappings = export_filenames_and_urls(client, latest_tag.id)
   
     data_dir = pathlib.Path(os.path.join(root, 'data_Gyhi_4hr'))
     
@@ -33,11 +45,8 @@ def main():
     print(f'output_path to save samples for labeling: {output_path}')
     output_path.mkdir(exist_ok=True)
 
-    for entry in filename_url_mappings:
-        read_url = entry["readUrl"]
-        filename = entry["fileName"]
-        print(f"Downloading {filename}")
-        download_files(read_url, filename, output_path)
+    # download concurrently over a pooled session, skipping samples already present
+    download_samples(filename_url_mappings, output_path)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,22 @@
+"""
+This script uploads the Lightly prediction files to the Lightly datasource bucket.
+Only prediction files that are new or changed since the last upload are sent; see
+bps_labeler/bps_utils/sync_utils.py.
+"""
+import pyprojroot
+root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+import sys
+sys.path.append(str(root))
+from bps_labeler.bps_utils.bps_tracks_config import BPSTracksConfig
+from bps_labeler.bps_utils.storage_utils import S3Backend
+from bps_labeler.bps_utils.sync_utils import sync_predictions
+
+def main():
+    config = BPSTracksConfig()
+    dest_bucket_name = "ai4ls-bps-training-data"
+
+    # Upload the lightly_predictions to the S3 destination bucket in the lightly/.lightly/predictions directory
+    sync_predictions(S3Backend(dest_bucket_name), config, dest_bucket_name)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 #!/bin/bash
 
-local_predictions_dir="lightly_predictions"
-dest_bucket_name="ai4ls-bps-training-data"
-destination_s3_predictions_dir="lightly/.lightly/predictions/bps-classification"
-
-# Upload the lightly_predictions to the S3 destination bucket in the lightly/.lightly/predictions directory
-aws s3 cp ${local_predictions_dir} s3://${dest_bucket_name}/${destination_s3_predictions_dir} --recursive --exclude "*" --include "*.json"
\ No newline at end of file
+# Upload lightly_predictions to the Lightly datasource bucket, skipping prediction files
+# unchanged since the last upload. See 06_upload_predictions_s3.py.
+script_dir="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+python "${script_dir}/06_upload_predictions_s3.py"
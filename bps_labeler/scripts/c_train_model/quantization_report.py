@@ -0,0 +1,61 @@
+""" Compare INT8 quantized predictions of a trained ResNet50 model with fp32 predictions.
+
+Scores the full training set with the fp32 model and with the dynamic and static
+INT8 models, and reports top-k selection overlap, entropy rank correlation and
+argmax agreement for each. Use it to decide whether BPSTracksConfig.inference_backend
+can be set to 'int8_dynamic' or 'int8_static' for the active learning sweep.
+
+    python bps_labeler/scripts/c_train_model/quantization_report.py model_weights/<timestamp>_resnet50.pth
+"""
+import argparse
+import json
+import os
+import sys
+import pyprojroot
+root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+sys.path.append(str(root))
+import torch
+from bps_labeler.dataloader.dataset import BPSTracksDataModule
+from bps_labeler.model.resnet50 import ResNet50Classifier
+from bps_labeler.model.quantization import compare_selection_agreement, quantize_classifier
+from bps_labeler.bps_utils.bps_tracks_config import BPSTracksConfig
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("weights", help="state dict saved by 05_train_model_01_resnet.py")
+    args = parser.parse_args()
+
+    config = BPSTracksConfig()
+    bps_tracks_dm = BPSTracksDataModule(
+        annotation_fpath=os.path.join(config.ls_annotation_dir, config.ls_annotation_fname),
+        full_train_fpath=os.path.join(config.data_dir, 'full_train.json'),
+        batch_size=config.batch_size,
+        train_path=config.train_dir,
+        image_size=config.image_size,
+        num_workers=config.num_workers,
+        grayscale=config.grayscale,
+        inference_batch_size=config.inference_batch_size
+        )
+    bps_tracks_dm.setup(config.active_learning_stage)
+
+    model = ResNet50Classifier(config.num_classes, config.save_pred_dir,
+                               grayscale_stem=config.grayscale_stem if config.grayscale else None,
+                               pretrained=False)
+    model.load_state_dict(torch.load(args.weights, map_location='cpu'))
+    reference, _ = model.predict_active_learning(bps_tracks_dm.active_learn_dataloader())
+
+    report = {}
+    calibration_loader = bps_tracks_dm.calibration_dataloader(config.num_calibration_images, config.seed)
+    for mode in ("dynamic", "static"):
+        backend = quantize_classifier(model, mode, calibration_loader, config.quantization_engine)
+        quantized, _ = model.predict_active_learning(bps_tracks_dm.active_learn_dataloader(), backend)
+        report[f"int8_{mode}"] = compare_selection_agreement(reference, quantized)
+
+    print(json.dumps(report, indent=4))
+    with open(os.path.join(config.save_pred_dir, 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,6 @@ In this code we assume that the AWS bucket contains two directories:
 - data: where the raw data is stored
 @Author Nadia Ahmed
 """
-from dotenv import load_dotenv
-from lightly.api import ApiWorkflowClient
-from lightly.openapi_generated.swagger_client import (
-    DatasetType,
-    DatasourcePurpose
-)
 import pyprojroot
 root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
 import os
@@ -24,6 +18,7 @@ from bps_labeler.bps_utils.lightly_utils import (
     configure_lightly_datasource,
     run_lightly_worker_active_learning
 )
+from bps_labeler.bps_utils.bps_tracks_config import BPSTracksConfig
 
 # Main function to execute the steps
 def main():
@@ -34,7 +29,7 @@ def main():
     set_lightly_dataset(client, datasetname=lightly_dataset_name)
     configure_input_datasource(client)
     configure_lightly_datasource(client)
-    run_lightly_worker_active_learning(client, num_samples=n_samples)
+    run_lightly_worker_active_learning(client, num_samples=n_samples, log_path=BPSTracksConfig().worker_run_log_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
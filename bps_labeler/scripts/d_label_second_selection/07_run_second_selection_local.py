@@ -0,0 +1,36 @@
+"""
+This module selects the second batch of samples for labeling offline. It computes
+the same uncertainty scores the Lightly worker uses from the latest predictions saved
+to the prediction store by 05_train_model_01_resnet.py and writes the selection in
+the format consumed by 04_download_samples.py:
+
+    python bps_labeler/scripts/b_label_first_selection/04_download_samples.py \
+        --selection data_Gyhi_4hr/selections/second-selection.json
+"""
+import pyprojroot
+root = pyprojroot.find_root(pyprojroot.has_dir(".git"))
+import json
+import os
+import sys
+sys.path.append(str(root))
+from bps_labeler.bps_utils.bps_tracks_config import BPSTracksConfig
+from bps_labeler.pipeline.services import LocalSelectionService
+
+# Main function to execute the steps
+def main():
+    n_samples = 50
+    tag_name = "second-selection"
+    config = BPSTracksConfig()
+
+    selection_fpath = LocalSelectionService(config).active_learning_selection(
+        n_samples,
+        tag_name,
+        [os.path.join(config.ls_annotation_dir, config.ls_annotation_fname)]
+    )
+    # fewer than n_samples remain selectable once most of the pool is labeled
+    with open(selection_fpath, "r") as f:
+        num_selected = len(json.load(f))
+    print(f"Selected {num_selected} samples, saved to {selection_fpath}")
+
+if __name__ == "__main__":
+    main()
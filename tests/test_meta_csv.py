@@ -0,0 +1,45 @@
+""" Regression checks of the metadata CSV loading in bps_utils/data_utils.py and
+filtering in bps_utils/fetch_utils.py.
+
+    python -m pytest -q tests
+"""
+import json
+import os
+
+import pytest
+
+from bps_labeler.bps_utils.data_utils import generate_meta_json_per_from_csv, load_meta_csv_columns
+from bps_labeler.bps_utils.fetch_utils import filter_mask, write_filtered_meta_csv
+
+HEADER = "filename,dose_Gy,particle_type,hr_post_exposure\n"
+
+
+def write_csv(tmp_path, content: str) -> str:
+    csv_path = tmp_path / "filtered_meta.csv"
+    csv_path.write_text(content)
+    return str(csv_path)
+
+
+def test_blank_lines_are_skipped(tmp_path):
+    csv_path = write_csv(tmp_path, HEADER + "x.tif,0.82,Fe,4\n\ny.tif,0.3,Fe,24\n\n")
+    columns = load_meta_csv_columns(csv_path)
+    assert columns["filename"].tolist() == ["x.tif", "y.tif"]
+    assert columns["hr_post_exposure"].tolist() == [4, 24]
+
+    generate_meta_json_per_from_csv(csv_file_path=str(tmp_path), json_file_path=str(tmp_path))
+    with open(os.path.join(tmp_path, "x.json")) as f:
+        assert json.load(f)["metadata"]["dose_Gy"] == 0.82
+
+
+def test_short_row_names_its_line(tmp_path):
+    csv_path = write_csv(tmp_path, HEADER + "x.tif,0.82,Fe,4\ny.tif,0.3,Fe\n")
+    with pytest.raises(ValueError, match="line 3"):
+        load_meta_csv_columns(csv_path)
+
+
+def test_filtered_csv_skips_blank_lines(tmp_path):
+    csv_path = write_csv(tmp_path, HEADER + "x.tif,0.82,Fe,4\n\ny.tif,0.3,Fe,24\nz.tif,0.1,Fe,4\n")
+    columns = load_meta_csv_columns(csv_path)
+    filtered_path = str(tmp_path / "filtered.csv")
+    write_filtered_meta_csv(csv_path, filter_mask(columns, "hr_post_exposure == 4"), filtered_path)
+    assert load_meta_csv_columns(filtered_path)["filename"].tolist() == ["x.tif", "z.tif"]